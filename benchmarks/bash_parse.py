@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""compare the streaming bash parser against the old recursive one
+
+    PYTHONPATH=src python benchmarks/bash_parse.py
+
+the old parser copies the remaining list of lines on every call, so it's
+quadratic, and it recurses once per line, so it needs the recursion limit
+raised to get anywhere at all. it is only run on the smaller sizes.
+"""
+
+from __future__ import print_function
+
+import gc
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from schist import bash
+from schist.common import _utf8
+from schist.db import Row
+
+
+_TS_RE = re.compile(r"""^#\d+$""")
+
+
+def legacy_history_iter(fp):
+  """bash.history_iter as it was before it was made iterative"""
+  def mkrow(ts, ary):
+    return Row(timestamp=ts, command='\n'.join(ary))
+
+  def parse(lines, ts=None, cmds=None, rows=None):
+    if len(lines) == 0:
+      if ts and cmds:
+        rows.append(mkrow(ts, cmds))
+      return rows
+
+    if _TS_RE.match(lines[0]):
+      if ts is None:
+        return parse(lines[1:], int(lines[0][1:]), cmds=None, rows=rows)
+      else:
+        rows = rows or []
+        rows.append(mkrow(ts, cmds))
+        return parse(lines[1:], ts=int(lines[0][1:]), cmds=None, rows=rows)
+    else:
+      cmds = cmds or []
+      cmds.append(lines[0])
+      return parse(lines[1:], ts=ts, cmds=cmds, rows=rows)
+
+  for row in parse([_utf8(line).rstrip("\n") for line in fp]):
+    yield row
+
+
+COMMANDS = [
+  'git status',
+  'ls -la',
+  'cd ~/src/schist',
+  'kubectl get pods -n prod',
+  'for f in *.py; do\n  flake8 "$f"\ndone',
+  'tox -e py36',
+]
+
+
+def write_history(path, nlines):
+  """write a bash history of roughly nlines lines to path"""
+  rnd = random.Random(nlines)
+  ts = 1500000000
+  n = 0
+  with open(path, 'w') as fp:
+    while n < nlines:
+      cmd = rnd.choice(COMMANDS)
+      ts += rnd.randint(1, 120)
+      fp.write('#{0}\n{1}\n'.format(ts, cmd))
+      n += 2 + cmd.count('\n')
+
+
+def measure(fn, path):
+  """returns (seconds, peak traced bytes, rows) for parsing path with fn"""
+  gc.collect()
+  tracemalloc.start()
+  t0 = time.time()
+  rows = 0
+  with open(path, 'rb') as fp:
+    for _ in fn(fp):
+      rows += 1
+  elapsed = time.time() - t0
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return elapsed, peak, rows
+
+
+def report(name, nlines, elapsed, peak, rows):
+  print("{name:>10s} {nlines:>9d} lines {rows:>8d} rows {t:>9.3f}s {rate:>12.0f} lines/s {mb:>9.2f} MB peak".format(
+    name=name, nlines=nlines, rows=rows, t=elapsed, rate=nlines / elapsed, mb=peak / 1e6))
+
+
+def main():
+  sys.setrecursionlimit(100000)
+
+  tmpdir = tempfile.mkdtemp()
+  path = os.path.join(tmpdir, 'bash_history')
+
+  try:
+    for nlines in (1000, 2000, 4000, 8000):
+      write_history(path, nlines)
+      report('legacy', nlines, *measure(legacy_history_iter, path))
+      report('streaming', nlines, *measure(bash.history_iter, path))
+
+    for nlines in (100000, 1000000):
+      write_history(path, nlines)
+      report('streaming', nlines, *measure(bash.history_iter, path))
+  finally:
+    if os.path.exists(path):
+      os.unlink(path)
+    os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,160 @@
+"""synthetic shell histories for the benchmarks
+
+they're meant to look like the real thing rather than a handful of commands on
+repeat: a pool of distinct commands, picked from with a long tail (a few get
+run all the time, most only once or twice), some of them multi-line and some
+non-ascii, typed in bursts with the odd overnight gap. zsh histories get
+elapsed times and metafied bytes, like zsh writes them.
+
+    write_zsh(path, nentries)
+    write_bash(path, nentries)
+
+both are deterministic for a given nentries and seed, and stream to the file, so
+5M entries is fine.
+"""
+
+from __future__ import print_function
+
+import bisect
+import random
+
+import six
+
+
+START = 1500000000
+
+HOSTS = ['web1', 'web2', 'db-prod', 'bastion', 'build.local']
+BRANCHES = ['master', 'develop', 'fix-parser', 'release-1.2', 'wip']
+FILES = ['src/schist/db.py', 'README.md', 'setup.py', 'tests/schist/db_test.py', 'Makefile',
+  'notes/todo.txt', u'docs/résumé.md']
+TARGETS = ['test', 'lint', 'dist', 'clean', '-j8 all']
+WORDS = ['fix', 'parser', 'speed', 'up', 'restore', 'typo', 'bump', 'version', u'café',
+  u'привет', u'日本']
+
+TEMPLATES = [
+  # (weight, template), {n} and friends are filled in by _fill()
+  (30, u'git status'),
+  (10, u'git diff {file}'),
+  (8, u'git checkout {branch}'),
+  (6, u'git commit -am "{msg}"'),
+  (4, u'git log --oneline -n {n}'),
+  (20, u'ls -la'),
+  (12, u'cd {dir}'),
+  (10, u'vim {file}'),
+  (6, u'make {target}'),
+  (5, u'ssh {host}'),
+  (5, u'kubectl get pods -n {ns}'),
+  (4, u'docker run --rm -it {image}:{n} sh'),
+  (4, u'grep -rn "{word}" src'),
+  (3, u'python -m pytest -q tests -k {word}'),
+  (2, u'echo "{msg}"'),
+  (2, u'for f in *.py; do\n  flake8 "$f"\ndone'),
+  (1, u'cat <<EOF > {file}\n{msg}\n{msg}\nEOF'),
+  (1, u'while true; do\n  curl -s http://{host}:{port}/health\n  sleep {n}\ndone'),
+]
+
+# commands that tend to run for a while, for the zsh elapsed field
+_SLOW = ('make', 'python -m pytest', 'docker', 'ssh', 'while')
+
+
+def _fill(rnd, template):
+  return template.format(
+    file=rnd.choice(FILES),
+    dir=u'~/src/project{0}/{1}'.format(rnd.randint(0, 40), rnd.choice(['src', 'tests', 'docs', ''])),
+    branch=rnd.choice(BRANCHES),
+    msg=u' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 6))),
+    n=rnd.randint(1, 500),
+    target=rnd.choice(TARGETS),
+    host=rnd.choice(HOSTS),
+    ns=rnd.choice(['prod', 'staging', 'dev', 'kube-system']),
+    image=rnd.choice(['alpine', 'python', 'postgres']),
+    word=rnd.choice(WORDS),
+    port=rnd.choice([80, 8080, 9090]),
+  )
+
+
+def command_pool(rnd, size):
+  """size commands, mostly distinct"""
+  weights, templates = zip(*TEMPLATES)
+  cum = _accumulate(weights)
+  return [
+    _fill(rnd, templates[bisect.bisect(cum, rnd.random() * cum[-1])]) for _ in range(size)]
+
+
+def _accumulate(xs):
+  out, total = [], 0
+  for x in xs:
+    total += x
+    out.append(total)
+  return out
+
+
+def entries(nentries, seed=0, distinct=None):
+  """yields (timestamp, elapsed, command) nentries times
+
+  commands are picked from a pool of distinct ones (nentries / 20 by default)
+  with zipf-ish weights, so the top few make up a good chunk of the history
+  """
+  rnd = random.Random(seed * 1000003 + nentries)
+  pool = command_pool(rnd, distinct or max(50, nentries // 20))
+  cum = _accumulate(1.0 / (i + 1) ** 1.1 for i in range(len(pool)))
+
+  ts = START
+  for _ in range(nentries):
+    r = rnd.random()
+    if r < 0.002:
+      # overnight, or the weekend
+      ts += rnd.randint(8 * 3600, 60 * 3600)
+    elif r < 0.05:
+      ts += rnd.randint(300, 3600)
+    else:
+      ts += rnd.randint(0, 45)
+
+    cmd = pool[bisect.bisect(cum, rnd.random() * cum[-1])]
+    if cmd.startswith(_SLOW):
+      elapsed = int(rnd.lognormvariate(3, 1.5))
+    else:
+      elapsed = 0 if rnd.random() < 0.9 else rnd.randint(1, 5)
+    yield ts, elapsed, cmd
+
+
+# the bytes zsh metafies: NUL and Meta itself up to the last of its tokens
+_IMETA = frozenset([0] + list(range(0x83, 0xa3)))
+
+
+def _metafy(b):
+  if not any(six.indexbytes(b, i) in _IMETA for i in range(len(b))):
+    return b
+  out = bytearray()
+  for c in six.iterbytes(b):
+    if c in _IMETA:
+      out.append(0x83)
+      out.append(c ^ 0x20)
+    else:
+      out.append(c)
+  return bytes(out)
+
+
+def write_zsh(path, nentries, seed=0, distinct=None):
+  """write an EXTENDED_HISTORY zsh histfile of nentries entries to path"""
+  cache = {}
+  with open(path, 'wb') as fp:
+    for ts, elapsed, cmd in entries(nentries, seed, distinct):
+      body = cache.get(cmd)
+      if body is None:
+        body = cache[cmd] = _metafy(cmd.encode('utf-8')).replace(b'\n', b'\\\n')
+      fp.write(b': %d:%d;%s\n' % (ts, elapsed, body))
+
+
+def write_bash(path, nentries, seed=0, distinct=None):
+  """write a bash histfile, with HISTTIMEFORMAT timestamps, of nentries
+  entries to path"""
+  with open(path, 'wb') as fp:
+    for ts, _, cmd in entries(nentries, seed, distinct):
+      fp.write(b'#%d\n%s\n' % (ts, cmd.encode('utf-8')))
+
+
+WRITERS = {
+  'zsh': write_zsh,
+  'bash': write_bash,
+}
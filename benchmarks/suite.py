@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""time the main operations on synthetic histories, and catch regressions
+
+    PYTHONPATH=src python benchmarks/suite.py --save results.json
+    PYTHONPATH=src python benchmarks/suite.py --baseline results.json
+
+for each shell and size (see histgen) this times:
+
+  * parse: history_iter over the whole histfile
+  * insert: HistConfig.insert into an empty db
+  * search: a handful of search() terms
+  * rows: reading every row back with rows()
+  * restore: restore() to /dev/null
+  * cmds_since: cmds_since() for a spread of times
+  * count: count(), a full table scan
+
+each one runs in a fresh process, so the peak memory reported is that case's
+own (max rss, which takes in sqlite's memory as well as python's). the time is
+the best of --repeat runs.
+
+with --baseline, any case that got more than --tolerance slower (or used more
+than --memory-tolerance more memory) than it did in the baseline is reported,
+and the exit status is 1.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import histgen
+
+from schist import bash, zsh
+
+
+CONFIGS = {
+  'zsh': zsh.CONFIG,
+  'bash': bash.CONFIG,
+}
+
+SIZES = (10000, 100000, 1000000)
+
+SEARCH_TERMS = [u'git status', u'%pytest%', u'%résumé%', u'kubectl get pods -n prod', u'%nope%']
+
+# the format of the json results, bumped if it changes incompatibly
+SCHEMA = 1
+
+
+def _hist(ctx):
+  return CONFIGS[ctx['shell']].evolve(db_path=ctx['db_path'], histfile=ctx['histfile'])
+
+
+def bench_parse(ctx):
+  with open(ctx['histfile'], 'rb') as fp:
+    return sum(1 for _ in CONFIGS[ctx['shell']].history_iter_fn(fp))
+
+
+def setup_insert(ctx):
+  for suffix in ('', '-wal', '-shm'):
+    if os.path.exists(ctx['db_path'] + suffix):
+      os.unlink(ctx['db_path'] + suffix)
+
+
+def bench_insert(ctx):
+  with _hist(ctx).open() as hist:
+    hist.init_db()
+    hist.insert()
+    return ctx['entries']
+
+
+def bench_search(ctx):
+  with _hist(ctx).open() as hist:
+    for term in SEARCH_TERMS:
+      list(hist.search(term, limit=25))
+    return len(SEARCH_TERMS)
+
+
+def bench_rows(ctx):
+  with _hist(ctx).open() as hist:
+    return sum(1 for _ in hist.rows())
+
+
+def bench_restore(ctx):
+  with _hist(ctx).open() as hist:
+    with open(os.devnull, 'w') as out:
+      hist.restore(out)
+    return hist.count()
+
+
+def bench_cmds_since(ctx):
+  n = 200
+  with _hist(ctx).open() as hist:
+    lo, hi = histgen.START, hist.last_cmd().timestamp
+    for i in range(n):
+      hist.cmds_since(lo + (hi - lo) * i // n)
+    return n
+
+
+def bench_count(ctx):
+  n = 10
+  with _hist(ctx).open() as hist:
+    for _ in range(n):
+      hist.count()
+    return n
+
+
+# (name, setup, fn, unit), in the order they run. everything after insert
+# uses the db it leaves behind
+CASES = [
+  ('parse', None, bench_parse, 'rows/s'),
+  ('insert', setup_insert, bench_insert, 'rows/s'),
+  ('search', None, bench_search, 'queries/s'),
+  ('rows', None, bench_rows, 'rows/s'),
+  ('restore', None, bench_restore, 'rows/s'),
+  ('cmds_since', None, bench_cmds_since, 'calls/s'),
+  ('count', None, bench_count, 'calls/s'),
+]
+
+DEPENDS_ON_INSERT = set(['search', 'rows', 'restore', 'cmds_since', 'count'])
+
+
+def _max_rss():
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes, except on macs
+  return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _run_case(args):
+  setup, fn, ctx = args
+  if setup is not None:
+    setup(ctx)
+  t0 = time.time()
+  ops = fn(ctx)
+  return time.time() - t0, ops, _max_rss()
+
+
+def run_case(setup, fn, ctx):
+  """(seconds, ops, peak rss bytes) for fn(ctx), run in a process of its own"""
+  pool = multiprocessing.Pool(1, maxtasksperchild=1)
+  try:
+    return pool.apply(_run_case, ((setup, fn, ctx),))
+  finally:
+    pool.close()
+    pool.join()
+
+
+def run(shells, sizes, cases, repeat, tmpdir, log=print):
+  results = {}
+  for shell in shells:
+    for size in sizes:
+      ctx = {
+        'shell': shell,
+        'entries': size,
+        'histfile': os.path.join(tmpdir, '{0}_history'.format(shell)),
+        'db_path': os.path.join(tmpdir, 'schist.sq3'),
+      }
+      histgen.WRITERS[shell](ctx['histfile'], size)
+      mb = os.path.getsize(ctx['histfile']) / 1e6
+
+      for name, setup, fn, unit in CASES:
+        if name not in cases and not (name == 'insert' and cases & DEPENDS_ON_INSERT):
+          continue
+        runs = [run_case(setup, fn, ctx) for _ in range(repeat)]
+        seconds = min(r[0] for r in runs)
+        ops = runs[0][1]
+        result = {
+          'seconds': seconds,
+          'ops': ops,
+          'rate': ops / seconds if seconds else None,
+          'unit': unit,
+          'peak_rss_mb': min(r[2] for r in runs) / 1e6,
+          'histfile_mb': mb,
+        }
+        key = '{0}/{1}/{2}'.format(shell, size, name)
+        if name in cases:
+          results[key] = result
+        log("{key:<28s} {t:>9.3f}s {rate:>12.0f} {unit:<9s} {mem:>8.1f} MB peak".format(
+          key=key, t=seconds, rate=result['rate'] or 0, unit=unit, mem=result['peak_rss_mb']))
+
+      setup_insert(ctx)
+      os.unlink(ctx['histfile'])
+
+  return results
+
+
+def environment():
+  return {
+    'created': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+    'python': platform.python_version(),
+    'sqlite': sqlite3.sqlite_version,
+    'platform': platform.platform(),
+    'cpus': multiprocessing.cpu_count(),
+  }
+
+
+def compare(results, baseline, tolerance, memory_tolerance, min_delta=0.01):
+  """(key, what, before, after) for every case in both that regressed. times
+  within min_delta seconds of the baseline don't count, the smallest cases
+  are mostly noise"""
+  regressions = []
+  for key in sorted(set(results) & set(baseline)):
+    new, old = results[key], baseline[key]
+    if new['seconds'] > max(old['seconds'] * (1 + tolerance), old['seconds'] + min_delta):
+      regressions.append((key, 'seconds', old['seconds'], new['seconds']))
+    if new['peak_rss_mb'] > old['peak_rss_mb'] * (1 + memory_tolerance):
+      regressions.append((key, 'peak_rss_mb', old['peak_rss_mb'], new['peak_rss_mb']))
+  return regressions
+
+
+def _csv(conv):
+  return lambda s: [conv(x) for x in s.split(',') if x]
+
+
+def main(argv=None):
+  ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  ap.add_argument('--shells', type=_csv(str), default=sorted(CONFIGS),
+    help='comma separated, default: bash,zsh')
+  ap.add_argument('--sizes', type=_csv(int), default=list(SIZES),
+    help='comma separated numbers of entries, default: {0}'.format(
+      ','.join(str(s) for s in SIZES)))
+  ap.add_argument('--cases', type=_csv(str), default=[c[0] for c in CASES],
+    help='comma separated, default: all of {0}'.format(','.join(c[0] for c in CASES)))
+  ap.add_argument('--repeat', type=int, default=3,
+    help='take the best of this many runs of each case, default: 3')
+  ap.add_argument('--save', metavar='PATH', help='write the results here as json')
+  ap.add_argument('--baseline', metavar='PATH',
+    help='compare against the results saved here, exit 1 on regressions')
+  ap.add_argument('--tolerance', type=float, default=0.25,
+    help='how much slower a case can get before it counts as a regression, default: 0.25')
+  ap.add_argument('--memory-tolerance', type=float, default=0.25,
+    help='the same for peak memory, default: 0.25')
+  ap.add_argument('--min-delta', type=float, default=0.01,
+    help="don't count a case as slower unless it's this many seconds slower, default: 0.01")
+  req = ap.parse_args(argv)
+
+  unknown = set(req.cases) - set(c[0] for c in CASES)
+  if unknown:
+    ap.error('unknown cases: {0}'.format(', '.join(sorted(unknown))))
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    results = run(req.shells, req.sizes, set(req.cases), req.repeat, tmpdir)
+  finally:
+    shutil.rmtree(tmpdir)
+
+  doc = {'schema': SCHEMA, 'environment': environment(), 'results': results}
+  if req.save:
+    with open(req.save, 'w') as fp:
+      json.dump(doc, fp, indent=2, sort_keys=True)
+
+  if req.baseline:
+    with open(req.baseline) as fp:
+      base = json.load(fp)
+    if base.get('schema') != SCHEMA:
+      print("{0} is from a different version of this script".format(req.baseline), file=sys.stderr)
+      return 2
+    if base['environment'].get('platform') != doc['environment']['platform']:
+      print("warning: the baseline was run on {0}".format(base['environment'].get('platform')),
+        file=sys.stderr)
+
+    regressions = compare(results, base['results'], req.tolerance, req.memory_tolerance,
+      req.min_delta)
+    for key, what, before, after in regressions:
+      print("REGRESSION {key} {what}: {before:.3f} -> {after:.3f} ({pct:+.0f}%)".format(
+        key=key, what=what, before=before, after=after, pct=100.0 * (after - before) / before))
+    if regressions:
+      return 1
+    print("no regressions against {0}".format(req.baseline))
+
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""compare the zsh parsers
+
+    PYTHONPATH=src python benchmarks/zsh_parse.py
+
+  * legacy: the original parser, building the original attrs Row (an Arrow
+    timestamp, validated and converted) with two _utf8() calls per line
+  * regex: a str regex match per line, which is what it turned into later
+  * lines: zsh.history_iter, bytes regex over pieces of lines
+  * mmap: zsh.history_range, the same over an mmap of the file
+
+the histories have the odd multi-line and non-ascii command in them, which the
+line based parsers get wrong but are still timed on.
+"""
+
+from __future__ import print_function
+
+import gc
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+
+from schist import zsh
+from schist.common import _utf8
+from schist.db import Row
+
+import arrow
+import attr
+import six
+
+from attr.validators import instance_of
+
+
+log = logging.getLogger(__name__)
+
+
+def _legacy_ib(conv, validator):
+  # attrs renamed convert to converter
+  try:
+    return attr.ib(validator=validator, converter=conv)
+  except TypeError:
+    return attr.ib(validator=validator, convert=conv)
+
+
+@attr.s(frozen=True, slots=True)
+class LegacyRow(object):
+  """db.Row as it was originally"""
+  timestamp = _legacy_ib(lambda s: arrow.get(s), instance_of(arrow.arrow.Arrow))
+  command = _legacy_ib(_utf8, instance_of(six.string_types))
+
+
+_ZSH_REGEX = re.compile(r"""^: (?P<ts>\d+):\d+;(?P<cmd>.*)$""")
+
+
+def legacy_history_iter(fp):
+  """zsh.history_iter as it was originally"""
+  for line in fp:
+    m = _ZSH_REGEX.match(_utf8(line))
+    if m:
+      ts = arrow.get(int(m.group('ts')))
+      # the original worked this out too, and didn't use it
+      ts.timestamp
+      yield LegacyRow(timestamp=ts, command=_utf8(m.group('cmd')))
+    else:
+      log.debug("BAD LINE: %r", line)
+
+
+def regex_history_iter(fp):
+  """zsh.history_iter before it worked on bytes"""
+  for line in fp:
+    m = _ZSH_REGEX.match(_utf8(line))
+    if m:
+      yield Row._make((int(m.group('ts')), m.group('cmd'), None))
+
+
+def mmap_history_iter(fp):
+  return zsh.history_range(fp, 0, os.fstat(fp.fileno()).st_size)
+
+
+COMMANDS = [
+  b'git status',
+  b'ls -la',
+  b'cd ~/src/schist',
+  b'kubectl get pods -n prod',
+  b'for f in *.py; do\\\n  flake8 "$f"\\\ndone',
+  b'tox -e py36',
+  b'echo \xc5\x83\xa4',
+  b'make -j8 test 2>&1 | tee build.log',
+]
+
+
+def write_history(path, nentries):
+  rnd = random.Random(nentries)
+  ts = 1500000000
+  with open(path, 'wb') as fp:
+    for _ in range(nentries):
+      ts += rnd.randint(1, 120)
+      fp.write(b': ' + str(ts).encode('ascii') + b':0;' + rnd.choice(COMMANDS) + b'\n')
+
+
+def measure(fn, path):
+  """returns (best of 3 seconds, rows) for parsing path with fn"""
+  best = None
+  for _ in range(3):
+    gc.collect()
+    t0 = time.time()
+    rows = 0
+    with open(path, 'rb') as fp:
+      for _ in fn(fp):
+        rows += 1
+    elapsed = time.time() - t0
+    best = elapsed if best is None else min(best, elapsed)
+  return best, rows
+
+
+def main():
+  tmpdir = tempfile.mkdtemp()
+  path = os.path.join(tmpdir, 'zsh_history')
+
+  parsers = [
+    ('legacy', legacy_history_iter),
+    ('regex', regex_history_iter),
+    ('lines', zsh.history_iter),
+    ('mmap', mmap_history_iter),
+  ]
+
+  try:
+    for nentries in (100000, 1000000):
+      write_history(path, nentries)
+      mb = os.path.getsize(path) / 1e6
+      base = None
+      for name, fn in parsers:
+        elapsed, rows = measure(fn, path)
+        base = base or elapsed
+        print("{name:>8s} {n:>8d} entries {rows:>8d} rows {t:>8.3f}s {rate:>8.1f} MB/s {x:>6.1f}x".format(
+          name=name, n=nentries, rows=rows, t=elapsed, rate=mb / elapsed, x=base / elapsed))
+  finally:
+    if os.path.exists(path):
+      os.unlink(path)
+    os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+  main()
@@ -38,7 +38,8 @@ setup(
   ],
   entry_points={
     'console_scripts': [
-      'schist=schist:app'
+      'schist=schist:app',
+      'schist-client=schist.client:main',
     ]
   }
 )
@@ -5,38 +5,203 @@ from __future__ import print_function
 import argparse
 import errno
 import logging
-import logging.config
 import os
 import os.path
+import re
+import sqlite3
 import sys
+import time
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from textwrap import dedent
 
-import arrow
+from . import instrument
+from .common import _compile_regex
 
-from . import zsh, bash
+# everything else (arrow, the shell modules, multiprocessing...) is imported
+# where it's used, so `schist search` from a key binding starts quickly. see
+# tests/schist/startup_test.py
 
 
 log = logging.getLogger(__name__)
 
 
-def cmd_backup(req, conf):
-  # change this to pass the HistConfig object instead of the parsed cmdline opts
+@contextmanager
+def _locked(confs, wait):
+  """take the backup lock for each of confs, yields the ones we got"""
+  if not confs:
+    yield []
+    return
+  with confs[0].backup_lock(wait=wait) as locked:
+    with _locked(confs[1:], wait) as rest:
+      yield ([confs[0]] if locked else []) + rest
+
+
+# how long import, merge and archive wait for a backup to finish, by default
+LOCK_WAIT = 30
+
+
+@contextmanager
+def _exclusive(conf, wait):
+  """the backup lock for conf, waiting up to wait seconds for it. exits with an
+  error if it's still held after that, e.g. by `schist watch`, which holds it
+  for as long as it runs"""
+  with conf.backup_lock() as locked:
+    if locked:
+      yield
+      return
+
+  log.info("waiting up to {0:g}s for another backup of {1} to finish".format(
+    wait, conf.table_name))
+  with conf.backup_lock(wait=wait) as locked:
+    if not locked:
+      log.error("{0} is still being backed up, or `schist watch` is running. "
+        "stop it and try again".format(conf.table_name))
+      sys.exit(1)
+    yield
+
+
+def _backup_files(req, confs):
+  """(conf, histfile) for everything `backup --glob`/`backup all` should do"""
+  if not req.glob:
+    return [(c, c.histfile) for c in confs]
+
+  import glob
+  from . import parallel
+
+  paths = sorted(set(
+    p for pattern in req.glob
+    for p in glob.glob(os.path.expanduser(pattern))
+    if os.path.isfile(p)))
+
+  if len(confs) == 1:
+    return [(confs[0], p) for p in paths]
+
+  files = []
+  for p in paths:
+    conf = parallel.detect(p, confs)
+    if conf is None:
+      log.warning("{0} doesn't look like a zsh or bash history file, skipping it".format(p))
+    else:
+      files.append((conf, p))
+  return files
 
-  with conf.open() as hist:
-    if not hist.table_exists():
-      hist.create_table()
 
-    initial_count = hist.count()
-    hist.insert()
-    log.info("inserted {0} rows".format(hist.count() - initial_count))
+def cmd_backup_many(req, confs):
+  with _locked(list(confs), req.lock_wait) as ours:
+    for c in confs:
+      if c not in ours:
+        log.info("another backup of {0} is already running, skipping it".format(c.table_name))
+
+    files = [(c, p) for c, p in _backup_files(req, confs) if c in ours]
+    if not files:
+      return
+
+    with ours[0].open() as hist:
+      hists = []
+      for c in ours:
+        h = c.evolve(conn=hist.conn)
+        if not h.table_exists():
+          h.create_table()
+        hists.extend(h.evolve(histfile=p) for conf, p in files if conf is c)
+
+      from . import parallel
+      added = parallel.backup(hists, full=req.full, processes=req.jobs)
+
+      for h, n in zip(hists, added):
+        log.debug("inserted {0} rows from {1}".format(n, h.histfile))
+      log.info("inserted {0} rows from {1} files".format(sum(added), len(hists)))
+
+
+def cmd_backup(req, *confs):
+  if req.glob or len(confs) > 1:
+    return cmd_backup_many(req, confs)
+
+  conf, = confs
+  with conf.backup_lock(wait=req.lock_wait) as locked:
+    if not locked:
+      log.info("another backup of {0} is already running, nothing to do".format(conf.table_name))
+      return
+
+    with conf.open() as hist:
+      if not hist.table_exists():
+        hist.create_table()
+
+      log.info("inserted {0} rows".format(hist.insert(full=req.full, processes=req.jobs)))
+
+
+def cmd_import(req, conf):
+  def progress(read, added, elapsed):
+    log.info("read {0} rows, {1} new ({2:.0f} rows/s)".format(
+      read, added, read / elapsed if elapsed else 0))
+
+  with _exclusive(conf, req.lock_wait):
+    with conf.open() as hist:
+      hist.init_db()
+      t0 = time.time()
+      added = hist.bulk_import(
+        req.paths,
+        batch_size=req.batch_size,
+        rebuild_indexes=req.rebuild_indexes,
+        progress=progress,
+        processes=req.jobs,
+      )
+      log.info("imported {0} new rows in {1:.1f}s".format(added, time.time() - t0))
+
+
+def cmd_merge(req, conf):
+  from .merge import MergeError
+
+  with _exclusive(conf, req.lock_wait):
+    with conf.open() as hist:
+      hist.init_db()
+      for path in req.paths:
+        try:
+          added = hist.merge(path, record_host=req.record_host)
+        except MergeError as e:
+          log.error(str(e))
+          sys.exit(1)
+        log.info("merged {0} new rows from {1}".format(added, path))
+
+
+def cmd_watch(req, conf):
+  import signal
+  from . import watch
+
+  stopping = []
+  signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+
+  # holding the backup lock the whole time turns any cron/launchd backups into
+  # no-ops while we're running
+  with conf.backup_lock() as locked:
+    if not locked:
+      log.info("{0} is already being backed up or watched".format(conf.table_name))
+      return
+
+    with conf.open() as hist:
+      hist.init_db()
+      watcher = watch.mk_watcher(conf.histfile, poll=req.poll, poll_interval=req.interval)
+      log.info("watching {0} ({1})".format(conf.histfile, type(watcher).__name__))
+
+      def on_insert(added):
+        if added:
+          log.debug("inserted {0} rows".format(added))
+
+      try:
+        watch.watch(
+          hist, watcher, interval=req.interval, stop=lambda: bool(stopping), on_insert=on_insert)
+      except KeyboardInterrupt:
+        pass
+      finally:
+        watcher.close()
 
 
 def cmd_restore(req, conf):
   with conf.open() as hist:
     hist.init_db()
     try:
-      hist.restore(req.output)
+      hist.restore(req.output, since=req.since, last=req.last, unique=req.unique)
     except IOError as e:
       if e.errno == errno.EPIPE:
         return
@@ -44,10 +209,103 @@ def cmd_restore(req, conf):
         raise
 
 
+HISTOGRAM_WIDTH = 50
+
+HISTOGRAM_DEFAULT_RANGE = {
+  'day': {'days': -30},
+  'week': {'weeks': -12},
+  'month': {'months': -12},
+}
+
+
+def _local_date(s):
+  import arrow
+  return arrow.get(s).replace(tzinfo='local')
+
+
+def print_histogram(hist, req):
+  import arrow
+  until = req.until or arrow.now()
+  since = req.since or until.shift(**HISTOGRAM_DEFAULT_RANGE[req.histogram])
+
+  counts = hist.histogram(since, until, req.histogram)
+  peak = max(counts.values()) if counts else 0
+  date_fmt = '%Y-%m' if req.histogram == 'month' else '%Y-%m-%d'
+
+  for d, n in counts.items():
+    bar = '#' * int(round(HISTOGRAM_WIDTH * float(n) / peak)) if peak else ''
+    print(u"{date:<10s} {n:>7d} {bar}".format(date=d.strftime(date_fmt), n=n, bar=bar))
+
+
+def _duration(seconds):
+  """e.g. 1h02m03s, 4m05s or 6s"""
+  seconds = int(seconds or 0)
+  h, rest = divmod(seconds, 3600)
+  m, s = divmod(rest, 60)
+  if h:
+    return u"{0}h{1:02d}m{2:02d}s".format(h, m, s)
+  if m:
+    return u"{0}m{1:02d}s".format(m, s)
+  return u"{0}s".format(s)
+
+
+def print_slowest(hist, req):
+  import arrow
+  for ts, elapsed, command in hist.slowest(req.slowest, since=req.since, like=req.like):
+    print(u"{date} {t:>10s}  {cmd}".format(
+      date=arrow.get(ts).to('local').format('YYYY-MM-DD HH:mm:ss'),
+      t=_duration(elapsed), cmd=command))
+
+
+def print_by_command(hist, req):
+  print(u"{0:>6s} {1:>10s} {2:>8s} {3:>8s} {4:>8s} {5:>10s}  {6}".format(
+    'runs', 'total', 'p50', 'p90', 'p99', 'max', 'command'))
+  for command, runs, total, p50, p90, p99, worst in hist.by_command(
+      req.limit, since=req.since, like=req.like):
+    print(u"{0:>6d} {1:>10s} {2:>8s} {3:>8s} {4:>8s} {5:>10s}  {6}".format(
+      runs, _duration(total), _duration(p50), _duration(p90), _duration(p99),
+      _duration(worst), command))
+
+
+def print_time_spent(hist, req):
+  import arrow
+  until = req.until or arrow.now()
+  since = req.since or until.shift(**HISTOGRAM_DEFAULT_RANGE[req.time_spent])
+
+  spent = hist.time_spent(since, until, req.time_spent, like=req.like)
+  peak = max(total for _, total in spent.values()) if spent else 0
+  date_fmt = '%Y-%m' if req.time_spent == 'month' else '%Y-%m-%d'
+
+  for d, (n, total) in spent.items():
+    bar = '#' * int(round(HISTOGRAM_WIDTH * float(total) / peak)) if peak else ''
+    print(u"{date:<10s} {n:>7d} {t:>10s} {bar}".format(
+      date=d.strftime(date_fmt), n=n, t=_duration(total), bar=bar))
+
+
 def cmd_stats(req, conf):
   with conf.open() as hist:
     hist.init_db()
+    hist.update_rollups()
+
+    if req.histogram:
+      print_histogram(hist, req)
+      return
+
+    timing_reports = [
+      (req.slowest, print_slowest),
+      (req.by_command, print_by_command),
+      (req.time_spent, print_time_spent),
+    ]
+    for wanted, report in timing_reports:
+      if wanted:
+        if not hist.has_elapsed_column():
+          log.error("{0} has no elapsed times yet, run `schist migrate {1} --elapsed` "
+            "to add them".format(hist.table_name, req.shell))
+          sys.exit(1)
+        report(hist, req)
+        return
 
+    import arrow
     now = arrow.now()
 
     last_cmd_t = hist.last_cmd()
@@ -65,81 +323,634 @@ def cmd_stats(req, conf):
           hr=hist.cmds_since(now.shift(hours=-1)),
           day=hist.cmds_since(now.shift(hours=-24)),
           week=hist.cmds_since(now.shift(days=-7)),
-          total=hist.count(),
+          total=hist.total_count(),
           last=last_cmd_t.format("YYYY-MM-DD HH:mm:ss"),
           min=int(delta.total_seconds()/60),
           s=int(delta.total_seconds() % 60),
       )))
 
 
-DATE_FMT = 'YYYY-MM-DD HH:mm:ss\t'
+# search results are in UTC, via time rather than arrow, which takes longer to
+# import than the search does to run
+DATE_FMT = '%Y-%m-%d %H:%M:%S\t'
 RESULT_FMT = "{date}{command}"
 
 
+HIGHLIGHT = (u'\x1b[1m', u'\x1b[0m')
+
+
 def cmd_search(req, conf):
+  if req.fts and req.rank != 'recent':
+    print("--fts results are ranked by the full text index, --rank can't be used with it",
+      file=sys.stderr)
+    sys.exit(2)
+
   with conf.open() as hist:
     hist.init_db()
+
+    if req.regex:
+      try:
+        _compile_regex(req.term)
+      except re.error as e:
+        print("bad regex {0!r}: {1}".format(req.term, e), file=sys.stderr)
+        sys.exit(2)
+
+    if req.fts:
+      hl_open, hl_close = HIGHLIGHT if sys.stdout.isatty() else (u'', u'')
+      found = hist.search_fts(req.term, req.limit, hl_open=hl_open, hl_close=hl_close)
+    elif req.rank == 'frecency':
+      found = ((row, row.command) for row in hist.search_frecent(
+        req.term, req.limit, regex=req.regex))
+    elif req.regex:
+      found = ((row, row.command) for row in hist.search_regex(req.term, req.limit))
+    else:
+      found = ((row, row.command) for row in hist.search(req.term, req.limit))
+
     results = 0
-    for row in hist.search(req.term, req.limit):
-      rs = RESULT_FMT.format(
-        date=row.timestamp.format(DATE_FMT) if req.include_date else '',
-        command=row.command
-      )
-      print(rs)
-      results += 1
+    try:
+      for row, command in found:
+        rs = RESULT_FMT.format(
+          date=time.strftime(DATE_FMT, time.gmtime(row.timestamp)) if req.include_date else '',
+          command=command
+        )
+        print(rs)
+        results += 1
+    except sqlite3.OperationalError as e:
+      # match_query() quotes the words, but fts5 can still find fault with them
+      if not req.fts:
+        raise
+      print("bad full text query {0!r}: {1}".format(req.term, e), file=sys.stderr)
+      sys.exit(2)
 
     if results == 0:
       print("no results", file=sys.stderr)
       sys.exit(1)
 
 
+def cmd_pick(req, conf):
+  from . import pick
+
+  with conf.open() as hist:
+    hist.init_db()
+    commands = hist.recent_commands()
+
+  if req.filter is not None:
+    picker = pick.Picker(commands, limit=req.limit)
+    picker.set_query(req.filter)
+    for command in picker.results():
+      print(command)
+    if not picker.count():
+      print("no results", file=sys.stderr)
+      sys.exit(1)
+    return
+
+  chosen = pick.interactive(commands, query=req.query, height=req.height)
+  if chosen is None:
+    sys.exit(1)
+  print(chosen)
+
+
+def cmd_serve(req, *confs):
+  import signal
+  from . import serve
+
+  # exit through the finally blocks, which remove the socket
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    serve.serve(confs, path=req.socket)
+  except KeyboardInterrupt:
+    pass
+
+
+def cmd_index(req, conf):
+  with conf.open() as hist:
+    hist.init_db()
+
+    if req.drop:
+      hist.drop_fts()
+      hist.drop_trigram()
+      log.info("dropped search indexes for {0}".format(hist.table_name))
+      return
+
+    if not hist.fts_available():
+      log.error("this sqlite library was built without FTS5, can't build search indexes")
+      sys.exit(1)
+
+    hist.build_fts()
+    log.info("built full text index over {0} rows".format(hist.count()))
+
+    if hist.trigram_available():
+      hist.build_trigram()
+      log.info("built trigram index over {0} rows".format(hist.count()))
+    else:
+      log.warning("this sqlite library has no trigram tokenizer (needs 3.34+), "
+        "LIKE searches will scan the whole table")
+
+
+def cmd_migrate(req, conf):
+  with conf.open() as hist:
+    if req.intern:
+      hist.migrate_to_interned()
+      log.info("{0} now stores each distinct command once".format(hist.table_name))
+    if req.elapsed:
+      backfilled = hist.add_elapsed_column()
+      log.info("{0} now records how long commands ran for, filled in {1} rows from {2}".format(
+        hist.table_name, backfilled, hist.histfile))
+
+
+def cmd_archive(req, conf):
+  import arrow
+  before = req.before or arrow.now().shift(days=-req.older_than)
+
+  with _exclusive(conf, req.lock_wait):
+    with conf.open() as hist:
+      hist.init_db()
+      moved = hist.archive(before)
+      blocks, rows, size = hist.archive_totals()
+      log.info("archived {0} rows from before {1}, the archive has {2} rows in {3} blocks "
+        "({4})".format(moved, before.format('YYYY-MM-DD'), rows, blocks, _size(size)))
+
+
+def _size(n):
+  """e.g. 1.2 MiB, 34.0 KiB or 512 B"""
+  for unit, scale in (('GiB', 1 << 30), ('MiB', 1 << 20), ('KiB', 1 << 10)):
+    if n >= scale:
+      return u"{0:.1f} {1}".format(float(n) / scale, unit)
+  return u"{0} B".format(n)
+
+
+def print_space(report):
+  page = report['page_size']
+  print(u"{0:<24s} {1:>10s}".format('pages', _size(report['pages'] * page)))
+  print(u"{0:<24s} {1:>10s}".format('free pages', _size(report['free_pages'] * page)))
+  print(u"{0:<24s} {1:>10s}".format('auto_vacuum', report['auto_vacuum']))
+  if report['sizes'] is None:
+    print(u"(this sqlite has no dbstat table, so no sizes per table and index)")
+    return
+  print()
+  for name, n in report['sizes']:
+    print(u"{0:<40s} {1:>10s}".format(name, _size(n)))
+
+
+def cmd_maintain(req, *confs):
+  from . import maintain
+
+  with confs[0].open() as first:
+    hists = [c.evolve(conn=first.conn) for c in confs]
+    hists = [h for h in hists if h.table_exists()]
+
+    if not req.report:
+      if hists and maintain.enable_incremental(hists):
+        log.info("switched to incremental auto_vacuum, which rebuilt the whole db")
+
+      freed = maintain.incremental_vacuum(first.conn, req.pages)
+      analyzed = maintain.analyze(first.conn, req.drift)
+      with instrument.span('optimize'):
+        first.conn.execute("PRAGMA optimize")
+      log.info("freed {0} pages, analyzed {1}".format(
+        freed, ', '.join(t for t, _, _ in analyzed) or 'nothing'))
+
+    print_space(maintain.space(first.conn))
+
+
+@contextmanager
+def _profiling(out_path=None):
+  """time the phases of whatever runs inside, and log them at the end. with
+  out_path, the whole thing runs under cProfile too"""
+  instrument.enable()
+  prof = None
+  if out_path:
+    import cProfile
+    prof = cProfile.Profile()
+    prof.enable()
+  try:
+    yield
+  finally:
+    if prof is not None:
+      prof.disable()
+      prof.dump_stats(out_path)
+      log.info("wrote cProfile stats to {0}".format(out_path))
+    instrument.emit(instrument.disable())
+
+
 def logging_setup(level):
-  logging.config.dictConfig({
-    'version': 1,
-    'disable_existing_loggers': False,  # this fixes the problem
-    'formatters': {
-      'standard': {
-        'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
-      },
-    },
-    'handlers': {
-      'default': {
-        'level': level,
-        'class': 'logging.StreamHandler',
-      },
-    },
-    'loggers': {
-      '': {
-        'handlers': ['default'],
-        'level': level,
-        'propagate': True
-      },
-      'twitter.git': {'level': 'CRITICAL'},
-      'requests_kerberos': {'level': 'CRITICAL'}
-    }
-  })
+  # what logging.config.dictConfig used to do here, without importing it (and
+  # socket, pickle...) on every run
+  handler = logging.StreamHandler()
+  handler.setLevel(level)
+
+  root = logging.getLogger()
+  for h in root.handlers[:]:
+    root.removeHandler(h)
+  root.addHandler(handler)
+  root.setLevel(level)
+
+  for name in ('twitter.git', 'requests_kerberos'):
+    logging.getLogger(name).setLevel(logging.CRITICAL)
 
 
 def cmd_help(req, conf):
   req.print_help()
 
 
-def common_args(ap, hist_path=True):
+def common_args(ap, hist_path=True, all_shells=False):
   ap.add_argument(
       'shell',
-      choices=['z', 'zsh', 'b', 'bash'],
-      help="the shell history to process"
+      choices=['z', 'zsh', 'b', 'bash'] + (['all'] if all_shells else []),
+      help="the shell history to process" + (", or all for both" if all_shells else "")
     )
 
   if hist_path:
     ap.add_argument(
         '-p', '--hist-path', dest='histfile',
-        help='path to shell history file (defaults, bash: {bash}, zsh: {zsh})'.format(
-          bash=bash._DEFAULT_BASH_HIST, zsh=zsh._DEFAULT_ZSH_HIST
+        help='path to shell history file (defaults, bash: ~/.bash_history, zsh: ~/.zsh_history)',
       )
+
+
+def backup_args(p):
+  p.set_defaults(func=cmd_backup)
+  common_args(p, all_shells=True)
+  p.add_argument(
+      '--glob',
+      action='append',
+      metavar='PATTERN',
+      help=('back up every file matching PATTERN (quote it) instead of the history file. '
+        'can be given more than once. with all, each file is checked for which shell '
+        'it belongs to'),
+    )
+  p.add_argument(
+      '-j', '--jobs',
+      type=int,
+      metavar='N',
+      help=('worker processes for parsing with --glob or all, or for splitting up a big '
+        'history file (default: number of cpus)'),
+    )
+  p.add_argument(
+      '--full',
+      action='store_true',
+      default=False,
+      help='reparse the whole history file instead of resuming from the last checkpoint',
+    )
+  p.add_argument(
+      '--lock-wait',
+      type=float,
+      default=0,
+      metavar='SECONDS',
+      help=('if another backup of the same shell is running, wait this long for it '
+        'to finish before exiting without doing anything (default: 0)'),
+    )
+
+
+def lock_wait_args(p):
+  p.add_argument(
+      '--lock-wait',
+      type=float,
+      default=LOCK_WAIT,
+      metavar='SECONDS',
+      help=('if a backup or `schist watch` of the same shell is running, wait this long '
+        'for it to finish before giving up (default: {0})'.format(LOCK_WAIT)),
+    )
+
+
+def import_args(p):
+  p.set_defaults(func=cmd_import)
+  common_args(p, hist_path=False)
+  lock_wait_args(p)
+  p.add_argument(
+      'paths',
+      nargs='+',
+      metavar='HISTFILE',
+      help='history files to load, e.g. old backups of your histfile',
+    )
+  p.add_argument(
+      '--batch-size',
+      type=int,
+      default=50000,
+      help='rows per transaction (default: 50000)',
+    )
+  p.add_argument(
+      '--rebuild-indexes',
+      action='store_true',
+      default=False,
+      help='drop secondary and search indexes during the load and rebuild them after',
+    )
+  p.add_argument(
+      '-j', '--jobs',
+      type=int,
+      metavar='N',
+      help='worker processes for parsing big history files (default: number of cpus)',
     )
 
 
+def watch_args(p):
+  p.set_defaults(func=cmd_watch)
+  common_args(p)
+  p.add_argument(
+      '--poll',
+      action='store_true',
+      default=False,
+      help='stat the history file every --interval seconds instead of using inotify',
+    )
+  p.add_argument(
+      '--interval',
+      type=float,
+      default=1.0,
+      metavar='SECONDS',
+      help='how often to poll (and to check whether we should exit), default: 1',
+    )
+
+
+def merge_args(p):
+  p.set_defaults(func=cmd_merge)
+  common_args(p, hist_path=False)
+  lock_wait_args(p)
+  p.add_argument(
+      'paths',
+      nargs='+',
+      metavar='DB',
+      help='schist databases (e.g. from other machines) to merge into this one',
+    )
+  p.add_argument(
+      '--record-host',
+      action='store_true',
+      default=False,
+      help=("keep track of where merged rows came from, in a host column. that's the "
+        "source's own host column if it has one, or the source's file name without "
+        "its extension (laptop.sq3 -> laptop)"),
+    )
+
+
+def restore_args(p):
+  p.set_defaults(func=cmd_restore)
+  p.add_argument("output", type=argparse.FileType('w'), nargs='?', default='-')
+  common_args(p)
+  p.add_argument(
+      '--since',
+      type=_local_date,
+      help='only restore commands run on or after this date/time',
+    )
+  p.add_argument(
+      '--last',
+      type=int,
+      metavar='N',
+      help='only restore the last N commands (after applying --unique)',
+    )
+  p.add_argument(
+      '--unique',
+      action='store_true',
+      default=False,
+      help='only keep the latest occurrence of each command',
+    )
+
+
+def stats_args(p):
+  p.set_defaults(func=cmd_stats)
+  common_args(p)
+  report = p.add_mutually_exclusive_group()
+  report.add_argument(
+      '--histogram',
+      choices=['day', 'week', 'month'],
+      help='print the number of commands per day, week or month instead',
+    )
+  report.add_argument(
+      '--slowest',
+      type=int,
+      nargs='?',
+      const=20,
+      metavar='N',
+      help='print the N (default: 20) longest running commands instead',
+    )
+  report.add_argument(
+      '--by-command',
+      action='store_true',
+      default=False,
+      help='print run counts, total time and p50/p90/p99 run time for the commands '
+        'that took the most time altogether',
+    )
+  report.add_argument(
+      '--time-spent',
+      choices=['day', 'week', 'month'],
+      help='print how long commands ran for altogether per day, week or month',
+    )
+  p.add_argument(
+      '--since',
+      type=_local_date,
+      help='start of the range, e.g. 2018-01-01 (default for --histogram and '
+        '--time-spent: 30 days/12 weeks/12 months ago, otherwise everything)',
+    )
+  p.add_argument(
+      '--until',
+      type=_local_date,
+      help='end of the histogram range (default: now)',
+    )
+  p.add_argument(
+      '--like',
+      metavar='PATTERN',
+      help='only count commands matching this LIKE pattern, e.g. "make %%"',
+    )
+  p.add_argument(
+      '--limit',
+      type=int,
+      default=20,
+      help='max number of commands --by-command prints, default: 20',
+    )
+
+
+def index_args(p):
+  p.set_defaults(func=cmd_index)
+  common_args(p, hist_path=False)
+  p.add_argument(
+      '--drop',
+      action='store_true',
+      default=False,
+      help='remove the search indexes instead of building them',
+    )
+
+
+def migrate_args(p):
+  p.set_defaults(func=cmd_migrate)
+  common_args(p)
+  p.add_argument(
+      '--intern',
+      action='store_true',
+      default=False,
+      help=('store each distinct command once and refer to it by id, which makes '
+        'databases with lots of repeated commands much smaller'),
+    )
+  p.add_argument(
+      '--elapsed',
+      action='store_true',
+      default=False,
+      help=('add a column for how long each command ran for, filling it in from '
+        'the histfile where it can (zsh with EXTENDED_HISTORY)'),
+    )
+
+
+def archive_args(p):
+  p.set_defaults(func=cmd_archive)
+  common_args(p, hist_path=False)
+  lock_wait_args(p)
+  when = p.add_mutually_exclusive_group()
+  when.add_argument(
+      '--older-than',
+      type=int,
+      default=365,
+      metavar='DAYS',
+      help='archive the commands run more than this many days ago, default: 365',
+    )
+  when.add_argument(
+      '--before',
+      type=_local_date,
+      help='archive the commands run before this date/time',
+    )
+
+
+def maintain_args(p):
+  from .maintain import DRIFT, PAGE_BUDGET
+  p.set_defaults(func=cmd_maintain)
+  common_args(p, hist_path=False, all_shells=True)
+  p.add_argument(
+      '--pages',
+      type=int,
+      default=PAGE_BUDGET,
+      metavar='N',
+      help='give at most N free pages back to the filesystem, 0 for all of them, '
+        'default: {0}'.format(PAGE_BUDGET),
+    )
+  p.add_argument(
+      '--drift',
+      type=float,
+      default=DRIFT,
+      metavar='FRACTION',
+      help='ANALYZE the tables whose row counts changed by more than this since they '
+        'were last analyzed, default: {0}'.format(DRIFT),
+    )
+  p.add_argument(
+      '--report',
+      action='store_true',
+      default=False,
+      help="only print how much space there is and where it's going",
+    )
+
+
+def search_args(p):
+  p.set_defaults(func=cmd_search)
+  common_args(p, hist_path=False)
+  p.add_argument('--limit',
+      type=int,
+      default=25,
+      help='max number of rows to return, default: 25'
+    )
+
+  p.add_argument(
+      '--no-date',
+      action='store_false',
+      dest='include_date',
+      default=True,
+      help='suppress timestamp in search results',
+    )
+
+  mode = p.add_mutually_exclusive_group()
+  mode.add_argument(
+      '--fts',
+      action='store_true',
+      default=False,
+      help=('rank results using the full text index (see `schist index`). '
+        'term is then a list of words that must all match, word* matches a prefix'),
+    )
+
+  mode.add_argument(
+      '--regex',
+      action='store_true',
+      default=False,
+      help='term is a python regular expression, matched anywhere in the command',
+    )
+
+  p.add_argument(
+      '--rank',
+      choices=['recent', 'frecency'],
+      default='recent',
+      help=('recent lists every match, newest first. frecency lists each matching '
+        'command once, the ones run most often and most recently first. default: recent'),
+    )
+
+  p.add_argument('term',
+      help=('search term used in LIKE clause. '
+        'Use %% to wildcard multiple characters, _ to wildcard one character')
+    )
+
+
+def pick_args(p):
+  p.set_defaults(func=cmd_pick)
+  common_args(p, hist_path=False)
+  p.add_argument(
+      '-q', '--query',
+      default=u'',
+      help='start with this query, e.g. what was already typed at the prompt',
+    )
+  p.add_argument(
+      '--height',
+      type=int,
+      default=15,
+      help='how many matches to show at once, default: 15',
+    )
+  p.add_argument(
+      '--filter',
+      metavar='QUERY',
+      help="don't be interactive, just print the best matches for QUERY",
+    )
+  p.add_argument(
+      '--limit',
+      type=int,
+      default=25,
+      help='how many matches --filter prints, default: 25',
+    )
+
+
+def serve_args(p):
+  from .client import DEFAULT_SOCKET
+  p.set_defaults(func=cmd_serve)
+  common_args(p, hist_path=False, all_shells=True)
+  p.add_argument(
+      '-s', '--socket',
+      default=DEFAULT_SOCKET,
+      help='the unix socket to listen on, default: ~/.schist.sock',
+    )
+
+
+# subcommand -> the function that sets up its parser
+SUBCOMMANDS = OrderedDict([
+  ('backup', backup_args),
+  ('import', import_args),
+  ('watch', watch_args),
+  ('merge', merge_args),
+  ('restore', restore_args),
+  ('stats', stats_args),
+  ('index', index_args),
+  ('migrate', migrate_args),
+  ('archive', archive_args),
+  ('maintain', maintain_args),
+  ('search', search_args),
+  ('s', search_args),
+  ('pick', pick_args),
+  ('serve', serve_args),
+])
+
+# global options that take a value, for _subcommand()
+_GLOBAL_OPTS_WITH_VALUE = frozenset(['--log-level', '-d', '--dbpath', '--busy-timeout', '--profile-out'])
+
+
+def _subcommand(args):
+  """the subcommand in args, if it's one we know, or None"""
+  args = iter(args)
+  for a in args:
+    if a in _GLOBAL_OPTS_WITH_VALUE:
+      next(args, None)
+    elif not a.startswith('-'):
+      return a if a in SUBCOMMANDS else None
+  return None
+
+
 def main(*args):
   ap = argparse.ArgumentParser(prog='schist')
 
@@ -160,47 +971,43 @@ def main(*args):
     help='path to the sqlite db file'
   )
 
+  ap.add_argument(
+    '--busy-timeout', dest='busy_timeout',
+    type=float,
+    metavar='SECONDS',
+    help='how long to wait on another process writing to the db (default: 30)'
+  )
 
-  sub = ap.add_subparsers()
-  backup_p = sub.add_parser('backup')
-  backup_p.set_defaults(func=cmd_backup)
-  common_args(backup_p)
-
-  restore_p = sub.add_parser('restore')
-  restore_p.set_defaults(func=cmd_restore)
-  restore_p.add_argument("output", type=argparse.FileType('w'), nargs='?', default='-')
-  common_args(restore_p)
-
-  stats_p = sub.add_parser('stats')
-  stats_p.set_defaults(func=cmd_stats)
-  common_args(stats_p)
-
-  def search_args(p):
-    p.set_defaults(func=cmd_search)
-    common_args(p, hist_path=False)
-    p.add_argument('--limit',
-        type=int,
-        default=25,
-        help='max number of rows to return, default: 25'
-      )
-
-    p.add_argument(
-        '--no-date',
-        action='store_false',
-        dest='include_date',
-        default=True,
-        help='suppress timestamp in search results',
-      )
+  ap.add_argument(
+    '--profile',
+    action='store_true',
+    default=False,
+    help=('log how long each phase (parsing, inserting, committing...) took, and how '
+      'many rows it handled, as json'),
+  )
 
-    p.add_argument('term',
-        help=('search term used in LIKE clause. '
-          'Use %% to wildcard multiple characters, _ to wildcard one character')
-      )
+  ap.add_argument(
+    '--profile-out',
+    metavar='PATH',
+    help='also run under cProfile and write its stats here, for pstats or snakeviz',
+  )
 
+  ap.add_argument(
+    '--trace-sql',
+    action='store_true',
+    default=False,
+    help='log every sql statement and how long it took',
+  )
 
-  search_args(sub.add_parser('search'))
-  search_args(sub.add_parser('s'))
+  sub = ap.add_subparsers()
 
+  # building every subcommand's parser takes a few ms, which matters when
+  # search is bound to a key, so only build the one we're running if we can
+  # tell which that is
+  wanted = _subcommand(args)
+  for name, setup in SUBCOMMANDS.items():
+    if wanted is None or name == wanted:
+      setup(sub.add_parser(name))
 
   ap.set_defaults(func=cmd_help)
 
@@ -215,21 +1022,39 @@ def main(*args):
   req = ap.parse_args(list(args))
   logging_setup(req.log_lvl)
 
+  # only the shells we're using get imported
   if req.shell == 'zsh' or req.shell == 'z':
-    mod = zsh
+    from . import zsh
+    mods = [zsh]
   elif req.shell == 'bash' or req.shell == 'b':
-    mod = bash
+    from . import bash
+    mods = [bash]
+  elif req.shell == 'all':
+    if req.histfile:
+      ap.error("-p/--hist-path can't be used with all, try --glob")
+    from . import bash, zsh
+    mods = [zsh, bash]
   else:
     req.print_help()
     sys.exit(0)
 
-  d = {'histfile': req.histfile, 'db_path': req.db_path}
+  d = {'histfile': req.histfile, 'db_path': req.db_path, 'busy_timeout': req.busy_timeout}
 
-  conf = mod.CONFIG.evolve(
-    **{k: v for k, v in d.items() if v is not None}
-  )
+  confs = [
+    mod.CONFIG.evolve(**{k: v for k, v in d.items() if v is not None})
+    for mod in mods
+  ]
 
-  req.func(req, conf)
+  if req.trace_sql:
+    instrument.trace_sql()
+  try:
+    if req.profile or req.profile_out:
+      with _profiling(req.profile_out):
+        req.func(req, *confs)
+    else:
+      req.func(req, *confs)
+  finally:
+    instrument.trace_sql(False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,262 @@
+"""cold storage for old history: a zlib compressed block per month
+
+move() takes the rows from before some time out of the history table and puts
+them in {table}_archive, one row (a block) per calendar month (UTC), along with
+the block's first and last timestamps and its row count. reads that only want
+some range of time can skip the blocks outside it without decompressing them.
+
+a block is json, with its columns stored one after the other, which
+compresses a lot better than row by row. the timestamps are deltas from the
+one before. elapsed times and hosts are kept where the table has them.
+
+the rollups and usage table already counted the rows before they were moved,
+so they keep covering them. a row from an archived month that comes back later
+(a merge, a `backup --full`) is dropped by drop_archived() if the block already
+has it, and otherwise waits in the history table for the next move().
+"""
+
+from __future__ import print_function
+
+import datetime
+import itertools
+import logging
+import sqlite3
+
+from .common import _watermark, _set_watermark
+
+
+log = logging.getLogger(__name__)
+
+# bumped if the format of a block changes
+VERSION = 1
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+_temp_names = itertools.count()
+
+
+def archive_table(table):
+  return '{0}_archive'.format(table)
+
+
+def create(conn, table):
+  conn.execute("""\
+      CREATE TABLE IF NOT EXISTS {archive} (
+        start BIGINT NOT NULL PRIMARY KEY,
+        min_ts BIGINT NOT NULL,
+        max_ts BIGINT NOT NULL,
+        count BIGINT NOT NULL,
+        data BLOB NOT NULL
+      )
+    """.format(archive=archive_table(table)))
+
+
+def exists(conn, table):
+  return conn.execute(
+      "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+      (archive_table(table),)
+    ).fetchone() is not None
+
+
+def _unix(d):
+  return int((d - _EPOCH).total_seconds())
+
+
+def month_start(ts):
+  """the first second of the UTC month ts is in"""
+  d = datetime.datetime.utcfromtimestamp(ts)
+  return _unix(d.replace(day=1, hour=0, minute=0, second=0, microsecond=0))
+
+
+def next_month(start):
+  d = datetime.datetime.utcfromtimestamp(start)
+  return _unix((d.replace(day=1) + datetime.timedelta(days=32)).replace(day=1))
+
+
+def encode(rows):
+  """a block for rows of (timestamp, command, elapsed, host)"""
+  # json and zlib are only imported once there's a block to read or write,
+  # search imports this module and mustn't pay for them when there isn't one
+  import json
+  import zlib
+
+  ts = [r[0] for r in rows]
+  doc = {
+    'v': VERSION,
+    'ts': [t - p for t, p in zip(ts, [0] + ts[:-1])],
+    'command': [r[1] for r in rows],
+  }
+  for i, name in ((2, 'elapsed'), (3, 'host')):
+    col = [r[i] for r in rows]
+    if any(x is not None for x in col):
+      doc[name] = col
+
+  data = json.dumps(doc, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+  return zlib.compress(data, 9)
+
+
+def decode(block):
+  """the (timestamp, command, elapsed, host) rows in a block, in order"""
+  import json
+  import zlib
+
+  doc = json.loads(zlib.decompress(bytes(block)).decode('utf-8'))
+  if doc.get('v') != VERSION:
+    raise ValueError("can't read version {0} archive blocks".format(doc.get('v')))
+
+  ts = []
+  t = 0
+  for delta in doc['ts']:
+    t += delta
+    ts.append(t)
+  n = len(ts)
+  return list(zip(
+    ts, doc['command'], doc.get('elapsed') or [None] * n, doc.get('host') or [None] * n))
+
+
+def blocks(conn, table, since=None, until=None, newest_first=False):
+  """(start, min_ts, max_ts, count) for the blocks with rows in [since, until)"""
+  if not exists(conn, table):
+    return []
+  return [tuple(r) for r in conn.execute("""\
+      SELECT start, min_ts, max_ts, count FROM {archive}
+        WHERE max_ts >= coalesce(:since, max_ts) AND min_ts < coalesce(:until, min_ts + 1)
+        ORDER BY start {order}
+    """.format(archive=archive_table(table), order='DESC' if newest_first else 'ASC'),
+    {'since': since, 'until': until})]
+
+
+def read(conn, table, start):
+  """the rows in the block for the month starting at start"""
+  r = conn.execute(
+    "SELECT data FROM {archive} WHERE start = ?".format(archive=archive_table(table)),
+    (start,)).fetchone()
+  return decode(r[0]) if r is not None else []
+
+
+def _write(conn, table, start, rows):
+  conn.execute("""\
+      REPLACE INTO {archive} (start, min_ts, max_ts, count, data)
+        VALUES (?, ?, ?, ?, ?)
+    """.format(archive=archive_table(table)),
+    (start, min(r[0] for r in rows), max(r[0] for r in rows), len(rows),
+      sqlite3.Binary(encode(rows))))
+
+
+def move(conn, table, before, source=None, elapsed=False, host=False):
+  """move the rows from before the unix time before into the archive, a month
+  at a time, each in its own transaction. source is the FROM clause yielding
+  timestamp and command (see HistConfig._source), elapsed and host say whether
+  the table has those columns. returns the number of rows moved"""
+  create(conn, table)
+  source = source or table
+  columns = 'timestamp, command, {0}, {1}'.format(
+    'elapsed' if elapsed else 'NULL', 'host' if host else 'NULL')
+
+  # the newest row always stays put: sqlite gives a new row the biggest rowid
+  # in the table plus one, and the rollups' and usage table's watermarks only
+  # work if that never goes down
+  keep = conn.execute("SELECT max(rowid) FROM {table}".format(table=table)).fetchone()[0]
+  if keep is None:
+    return 0
+
+  first = conn.execute(
+    "SELECT min(timestamp) FROM {table} WHERE timestamp < ?".format(table=table),
+    (before,)).fetchone()[0]
+  if first is None:
+    return 0
+
+  moved = 0
+  start = month_start(first)
+  while start < before:
+    end = min(next_month(start), before)
+    params = {'lo': start, 'hi': end, 'keep': keep}
+    where = "timestamp >= :lo AND timestamp < :hi AND {table}.rowid != :keep".format(table=table)
+
+    with conn:
+      rows = [tuple(r) for r in conn.execute(
+        "SELECT {columns} FROM {source} WHERE {where} ORDER BY {table}.rowid".format(
+          columns=columns, source=source, where=where, table=table), params)]
+
+      if rows:
+        old = read(conn, table, start)
+        have = set((r[0], r[1]) for r in old)
+        _write(conn, table, start, old + [r for r in rows if (r[0], r[1]) not in have])
+        conn.execute("DELETE FROM {table} WHERE {where}".format(table=table, where=where), params)
+        moved += len(rows)
+        log.debug("archived %d rows from %s", len(rows), datetime.datetime.utcfromtimestamp(start))
+
+    start = next_month(start)
+
+  return moved
+
+
+def drop_archived(conn, table, source=None):
+  """delete the rows added to the history table since the last call that are
+  already in the archive. returns how many there were"""
+  if not exists(conn, table):
+    return 0
+
+  name = archive_table(table)
+  since = _watermark(conn, name)
+  last = conn.execute("SELECT max(rowid) FROM {table}".format(table=table)).fetchone()[0]
+  if last is None or last <= since:
+    return 0
+
+  # only rows from months that have a block can be in one
+  candidates = conn.execute("""\
+      SELECT {table}.rowid, timestamp, command FROM {source}
+        WHERE {table}.rowid > :since AND {table}.rowid <= :last
+          AND timestamp <= (SELECT max(max_ts) FROM {archive})
+    """.format(table=table, source=source or table, archive=name),
+    {'since': since, 'last': last}).fetchall()
+
+  by_month = {}
+  for rowid, ts, command in candidates:
+    by_month.setdefault(month_start(ts), []).append((rowid, ts, command))
+
+  dupes = []
+  for start, rows in by_month.items():
+    have = set((r[0], r[1]) for r in read(conn, table, start))
+    dupes.extend(rowid for rowid, ts, command in rows if (ts, command) in have)
+
+  conn.executemany(
+    "DELETE FROM {table} WHERE rowid = ?".format(table=table), ((r,) for r in dupes))
+  _set_watermark(conn, name, last)
+  return len(dupes)
+
+
+def load(conn, table, starts):
+  """copy the rows from the blocks starting at starts into a new temp table,
+  with a rid column that sorts them in order, before anything in the history
+  table. returns its name, drop it when done"""
+  name = 'schist_cold_{0}'.format(next(_temp_names))
+  conn.execute("""\
+      CREATE TEMP TABLE {name} (
+        rid INTEGER PRIMARY KEY,
+        timestamp BIGINT NOT NULL,
+        command text NOT NULL,
+        elapsed INTEGER
+      )
+    """.format(name=name))
+
+  rids = itertools.count(-(1 << 62))
+  for start in starts:
+    conn.executemany(
+      "INSERT INTO temp.{name} (rid, timestamp, command, elapsed) VALUES (?, ?, ?, ?)".format(
+        name=name),
+      ((next(rids), r[0], r[1], r[2]) for r in read(conn, table, start)))
+  return name
+
+
+def drop(conn, name):
+  conn.execute("DROP TABLE IF EXISTS temp.{name}".format(name=name))
+
+
+def totals(conn, table):
+  """(blocks, rows, compressed bytes) in the archive"""
+  if not exists(conn, table):
+    return 0, 0, 0
+  return tuple(conn.execute(
+    "SELECT count(*), coalesce(sum(count), 0), coalesce(sum(length(data)), 0) FROM {0}".format(
+      archive_table(table))).fetchone())
@@ -6,56 +6,43 @@ import re
 
 from collections import defaultdict
 
-from .common import _utf8, _mk_conn
+from .common import _utf8, _mk_conn, _write_lines
 from .db import HistConfig, Row
 
-import arrow
-
 log = logging.getLogger(__name__)
 
 _TS_RE = re.compile(r"""^#\d+$""")
 
+# what the first line of a record looks like, for splitting the file up
+_RECORD_START = re.compile(br'^#\d+$')
+
 def history_iter(fp):
-  def mkrow(ts, ary):
-    return Row(
-      timestamp=ts,
-      command='\n'.join(ary)
-    )
-
-  # this solution kinda sucks because it requires reading the whole file into
-  # a list.
-
-  def parse(lines, ts=None, cmds=None, rows=None):
-    if len(lines) == 0:
-      if ts and cmds:
-        rows.append(mkrow(ts, cmds))
-      return rows
-
-    if _TS_RE.match(lines[0]):
-      if ts is None:
-        # we don't have a timestamp, so this is a new record
-        return parse(lines[1:], arrow.get(lines[0][1:]), cmds=None, rows=rows)
-      else:
-        # we have a timestamp, so this is the start of a new record, so we
-        # create a Row, capture the new ts, and reset cmds for the next iteration
-        assert cmds is not None
-        rows = rows or []
-        rows.append(mkrow(ts, cmds))
-
-        return parse(lines[1:], ts=arrow.get(lines[0][1:]), cmds=None, rows=rows)
-    else:
-      cmds = cmds or []
-      cmds.append(lines[0])
-      return parse(lines[1:], ts=ts, cmds=cmds, rows=rows)
-
-  for row in parse([_utf8(line).rstrip("\n") for line in fp]):
-    yield row
+  """yields a Row for each record in fp, reading it one line at a time
+
+  a record is a '#<unix ts>' line followed by the line(s) of the command. lines
+  before the first timestamp, and timestamps with no command, are skipped.
+  """
+  ts = None
+  cmds = []
+
+  for line in fp:
+    line = _utf8(line).rstrip("\n")
+
+    if _TS_RE.match(line):
+      if ts is not None and cmds:
+        yield Row._make((ts, '\n'.join(cmds), None))
+      ts = int(line[1:])
+      cmds = []
+    elif ts is not None:
+      cmds.append(line)
+
+  if ts is not None and cmds:
+    yield Row._make((ts, '\n'.join(cmds), None))
 
 
 def history_output(row_iter, fp):
-  for row in row_iter:
-    print(_utf8("#{0}".format(row.unix)), file=fp)
-    print(row.command, file=fp)
+  fmt = u"#{0}\n{1}\n".format
+  _write_lines(fp, (fmt(row[0], row[1]) for row in row_iter))
 
 
 _DEFAULT_BASH_HIST = os.path.expanduser("~/.bash_history")
@@ -66,4 +53,5 @@ CONFIG = HistConfig(
   history_iter_fn=history_iter,
   output_fn=history_output,
   db_conn_factory=_mk_conn,
+  record_start=_RECORD_START,
 )
@@ -0,0 +1,141 @@
+"""a thin client for `schist serve`, and the line protocol it speaks
+
+a request is one line, its words separated by tabs:
+
+    VERB<tab>SHELL[<tab>ARG...]
+
+and the response is a status line, either `ok N` followed by N lines of
+tab separated fields, or `error MESSAGE`. tabs, newlines and backslashes in
+words and fields are escaped as \\t, \\n and \\\\, so a multi-line command is
+still one line. everything is utf-8.
+
+see serve.Service for the verbs. this only imports what it has to, since it
+gets run on every keystroke:
+
+    $ schist-client suggest zsh 'git st'
+"""
+
+from __future__ import print_function
+
+import os
+import socket
+import sys
+
+
+DEFAULT_SOCKET = os.path.expanduser('~/.schist.sock')
+
+_ESCAPES = {u'\\': u'\\\\', u'\t': u'\\t', u'\n': u'\\n', u'\r': u'\\r'}
+_UNESCAPES = dict((v[1], k) for k, v in _ESCAPES.items())
+
+
+class ServerError(Exception):
+  """the server answered with an error"""
+
+
+def escape(s):
+  return u''.join(_ESCAPES.get(c, c) for c in s)
+
+
+def unescape(s):
+  if u'\\' not in s:
+    return s
+  out = []
+  chars = iter(s)
+  for c in chars:
+    if c == u'\\':
+      c = next(chars, u'\\')
+      out.append(_UNESCAPES.get(c, c))
+    else:
+      out.append(c)
+  return u''.join(out)
+
+
+def encode_line(words):
+  return (u'\t'.join(escape(w) for w in words) + u'\n').encode('utf-8')
+
+
+def decode_line(line):
+  """the words in a line of bytes, without its newline"""
+  line = line.decode('utf-8', 'replace').rstrip(u'\r\n')
+  return [unescape(w) for w in line.split(u'\t')]
+
+
+def read_response(fp):
+  """the rows in the response waiting on binary file fp, each a list of fields"""
+  status = fp.readline().decode('utf-8', 'replace').rstrip(u'\r\n')
+  if status.startswith(u'ok '):
+    return [decode_line(fp.readline()) for _ in range(int(status[3:]))]
+  elif status.startswith(u'error '):
+    raise ServerError(status[6:])
+  else:
+    raise ServerError(u'bad response: {0!r}'.format(status))
+
+
+class Client(object):
+  """a connection to a server, which can be used for any number of requests"""
+
+  def __init__(self, path=DEFAULT_SOCKET, timeout=5.0):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(timeout)
+    try:
+      self.sock.connect(path)
+    except Exception:
+      self.sock.close()
+      raise
+    self._fp = self.sock.makefile('rb')
+
+  def request(self, *words):
+    self.sock.sendall(encode_line(words))
+    return read_response(self._fp)
+
+  def close(self):
+    self._fp.close()
+    self.sock.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+def request(*words, **kw):
+  """send one request to the server at kw['path'] (default: DEFAULT_SOCKET)"""
+  with Client(kw.get('path', DEFAULT_SOCKET)) as c:
+    return c.request(*words)
+
+
+USAGE = "usage: schist-client [-s SOCKET] VERB SHELL [ARG...]"
+
+
+def main(argv=None):
+  args = list(sys.argv[1:] if argv is None else argv)
+  path = os.environ.get('SCHIST_SOCKET', DEFAULT_SOCKET)
+  if args[:1] in (['-s'], ['--socket']) and len(args) > 1:
+    path = args[1]
+    args = args[2:]
+  if not args or args[0] in ('-h', '--help'):
+    print(USAGE, file=sys.stderr)
+    return 2
+
+  if sys.version_info[0] < 3:
+    args = [a.decode('utf-8') for a in args]
+
+  try:
+    rows = request(*args, path=path)
+  except ServerError as e:
+    print(u'schist-client: {0}'.format(e), file=sys.stderr)
+    return 2
+  except socket.error as e:
+    print(u"schist-client: can't talk to {0}: {1}".format(path, e), file=sys.stderr)
+    return 2
+
+  out = getattr(sys.stdout, 'buffer', sys.stdout)
+  for row in rows:
+    out.write((u'\t'.join(row) + u'\n').encode('utf-8'))
+  out.flush()
+  return 0 if rows else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,7 +1,33 @@
+import errno
+import hashlib
+import itertools
+import math
+import re
 import sqlite3
+import struct
+import time
+
+from contextlib import contextmanager
+
+from . import instrument
 
 import six
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+try:
+  from functools import lru_cache
+except ImportError:
+  from backports.functools_lru_cache import lru_cache
+
+try:
+  from re import _parser as sre_parse
+except ImportError:
+  import sre_parse
+
 
 def _utf8(x):
   if isinstance(x, six.binary_type):
@@ -11,8 +37,227 @@ def _utf8(x):
   else:
     raise TypeError("unknown type of {0!r}: {1!r}".format(x, type(x)))
 
-def _mk_conn(path, *a):
-  conn = sqlite3.connect(path, *a)
+
+def _read_lines(fp, end):
+  """yield lines from fp's current position up to the offset end"""
+  remaining = end - fp.tell()
+  while remaining > 0:
+    line = fp.readline(remaining)
+    if not line:
+      return
+    remaining -= len(line)
+    yield line
+
+
+def _iter_range(fp, start, end, history_iter_fn, range_iter_fn=None):
+  """the rows in the bytes from start to end of fp, a binary file, from
+  range_iter_fn if there is one, otherwise history_iter_fn over those lines"""
+  if range_iter_fn is not None:
+    return range_iter_fn(fp, start, end)
+  fp.seek(start)
+  return history_iter_fn(_read_lines(fp, end))
+
+
+OUTPUT_CHUNK = 4096
+
+
+def _write_lines(fp, lines, chunk_size=OUTPUT_CHUNK):
+  """write lines (each with its own newline) to fp, chunk_size lines per write()"""
+  it = iter(lines)
+  while True:
+    chunk = u''.join(itertools.islice(it, chunk_size))
+    if not chunk:
+      return
+    fp.write(chunk)
+
+
+@lru_cache(maxsize=128)
+def _compile_regex(pattern):
+  return re.compile(pattern)
+
+
+def _regexp(pattern, value):
+  """implements 'value REGEXP pattern' in sql, with python's re.search semantics"""
+  if value is None:
+    return False
+  return _compile_regex(pattern).search(value) is not None
+
+
+def _log2_add(a, b):
+  """log2(2 ** a + 2 ** b), without overflowing. NULLs are ignored, as sum() would"""
+  if a is None:
+    return b
+  if b is None:
+    return a
+  hi, lo = (a, b) if a >= b else (b, a)
+  return hi + math.log1p(2.0 ** (lo - hi)) / math.log(2)
+
+
+class _Log2Sum(object):
+  """the sql aggregate schist_log2sum(x), log2 of the sum of 2 ** x"""
+
+  def __init__(self):
+    self.total = None
+
+  def step(self, x):
+    self.total = _log2_add(self.total, x)
+
+  def finalize(self):
+    return self.total
+
+
+# these only exist in 3.11+
+_POSSESSIVE_REPEAT = getattr(sre_parse, 'POSSESSIVE_REPEAT', None)
+_ATOMIC_GROUP = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
+
+def _required_runs(seq, icase, runs):
+  cur = []
+
+  def flush():
+    if cur:
+      s = u''.join(cur)
+      # LIKE only folds ascii case, so under re.I anything else could miss rows
+      if not icase or all(ord(c) < 128 for c in s):
+        runs.append(s)
+      del cur[:]
+
+  for op, av in seq:
+    if op == sre_parse.LITERAL:
+      cur.append(six.unichr(av))
+      continue
+
+    flush()
+
+    if op == sre_parse.SUBPATTERN:
+      # (group, add_flags, del_flags, pattern) on py3, (group, pattern) on py2
+      sub_icase = icase
+      if len(av) == 4:
+        sub_icase = (icase or av[1] & re.IGNORECASE) and not av[2] & re.IGNORECASE
+      _required_runs(av[-1], sub_icase, runs)
+    elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, _POSSESSIVE_REPEAT):
+      lo, _, sub = av
+      if lo >= 1:
+        _required_runs(sub, icase, runs)
+    elif op == _ATOMIC_GROUP:
+      _required_runs(av, icase, runs)
+    # anything else (alternation, classes, anchors, backrefs...) just ends the run
+
+  flush()
+
+
+def _regex_literals(pattern):
+  """substrings that anything pattern matches has to contain, for prefiltering
+  rows with LIKE or an index before running the regex itself"""
+  try:
+    parsed = sre_parse.parse(pattern)
+  except (re.error, TypeError):
+    return []
+
+  state = getattr(parsed, 'state', None) or parsed.pattern
+  runs = []
+  _required_runs(parsed, bool(state.flags & re.IGNORECASE), runs)
+  return runs
+
+
+def _command_hash(command):
+  """a signed 64 bit hash of command's text, for interning commands"""
+  return struct.unpack('>q', hashlib.sha1(command.encode('utf-8')).digest()[:8])[0]
+
+
+WATERMARK_TABLE = 'schist_watermarks'
+
+
+def _watermark(conn, name):
+  """the last rowid of its source table that the derived table name has seen"""
+  conn.execute("""\
+      CREATE TABLE IF NOT EXISTS {table} (
+        name text NOT NULL PRIMARY KEY,
+        last_rowid BIGINT NOT NULL
+      )
+    """.format(table=WATERMARK_TABLE))
+
+  r = conn.execute(
+      "SELECT last_rowid FROM {table} WHERE name = ?".format(table=WATERMARK_TABLE),
+      (name,)
+    ).fetchone()
+  return r[0] if r is not None else 0
+
+
+def _set_watermark(conn, name, rowid):
+  conn.execute(
+      "REPLACE INTO {table} (name, last_rowid) VALUES (?, ?)".format(table=WATERMARK_TABLE),
+      (name, rowid))
+
+
+@contextmanager
+def _write_transaction(conn):
+  """BEGIN IMMEDIATE ... COMMIT (or ROLLBACK on an exception). the write lock is
+  taken up front, so nothing another connection commits can change what's read
+  inside before it's written"""
+  level = conn.isolation_level
+  # with None the sqlite3 module leaves BEGIN and COMMIT to us (and commits
+  # anything it already had open)
+  conn.isolation_level = None
+  try:
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+      yield conn
+    except BaseException:
+      conn.execute("ROLLBACK")
+      raise
+    conn.execute("COMMIT")
+  finally:
+    conn.isolation_level = level
+
+
+@contextmanager
+def _advisory_lock(path, wait=0, poll_interval=0.1):
+  """hold an exclusive flock on path, waiting up to wait seconds for it (None
+  waits forever). yields True if we got the lock, False if we gave up.
+
+  on platforms without fcntl this always "succeeds" without locking anything.
+  """
+  if fcntl is None:
+    yield True
+    return
+
+  with open(path, 'a') as fp:
+    deadline = None if wait is None else time.time() + wait
+    while True:
+      try:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        break
+      except (IOError, OSError) as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+          raise
+        if deadline is not None and time.time() >= deadline:
+          yield False
+          return
+        time.sleep(poll_interval)
+
+    try:
+      yield True
+    finally:
+      fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def _mk_conn(path, *a, **kw):
+  if instrument.tracing_sql():
+    kw['factory'] = instrument.TracingConnection
+  conn = sqlite3.connect(path, *a, **kw)
   conn.text_factory = sqlite3.OptimizedUnicode
   conn.row_factory = sqlite3.Row
+  # so `schist maintain` can give free pages back without rewriting the whole
+  # file. this only takes effect in a new db, before the line below writes its
+  # first page. older ones get switched over by maintain.
+  conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+  # readers see the last committed state instead of waiting on a writer, and
+  # the writer doesn't wait on readers. this sticks to the db file, so it only
+  # really does anything the first time.
+  conn.execute("PRAGMA journal_mode=WAL")
+  conn.create_function('regexp', 2, _regexp)
+  conn.create_function('schist_hash', 1, _command_hash)
+  conn.create_function('schist_log2add', 2, _log2_add)
+  conn.create_aggregate('schist_log2sum', 1, _Log2Sum)
   return conn
@@ -1,17 +1,22 @@
 from __future__ import print_function
 
+import itertools
 import logging
+import os
 import os.path
 import re
 import sqlite3
+import time
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from contextlib import contextmanager
 from textwrap import dedent
 
-from .common import _utf8
+from . import archive, frecency, fts, instrument, rollup, timing
+from .common import (
+  _utf8, _advisory_lock, _command_hash, _compile_regex, _iter_range, _regex_literals,
+  _write_transaction)
 
-import arrow
 import attr
 import six
 
@@ -22,29 +27,115 @@ log = logging.getLogger(__name__)
 
 DEFAULT_DB_PATH = os.path.expanduser("~/.schist.sq3")
 
+CHECKPOINT_TABLE = 'schist_checkpoints'
+
+# how many bytes before the checkpoint offset we hash to decide whether the
+# histfile was rewritten underneath us
+FINGERPRINT_LEN = 256
+
+# rows per fetchmany() when streaming query results
+FETCH_SIZE = 1000
+
+
+def _unix(ts):
+  """coerce an Arrow (or anything arrow.get understands) to unix epoch seconds"""
+  if isinstance(ts, six.integer_types):
+    return ts
+  elif isinstance(ts, (six.binary_type, six.text_type)):
+    return int(ts)
+  else:
+    # arrow is slow to import, and a search never needs it
+    import arrow
+    return arrow.get(ts).timestamp
 
-@attr.s(frozen=True, slots=True)
-class Row(object):
-  timestamp = attr.ib(
-      validator=instance_of(arrow.arrow.Arrow),
-      convert=lambda s: arrow.get(s)
-    )
-  command = attr.ib(
-      validator=instance_of(six.string_types),
-      convert=_utf8
-    )
+
+_RowBase = namedtuple('Row', ['timestamp', 'command', 'elapsed'])
+
+
+class Row(_RowBase):
+  """a single history entry, timestamp is in unix epoch seconds, elapsed is
+  how many seconds the command ran for, or None if the shell didn't say
+
+  this is a plain tuple underneath, so it can be handed straight to
+  executemany. parsers that already have an int and a unicode string should
+  use Row._make((ts, cmd, elapsed)), which skips the coercion done here.
+  """
+  __slots__ = ()
+
+  def __new__(cls, timestamp, command, elapsed=None):
+    return _RowBase.__new__(
+      cls, _unix(timestamp), _utf8(command), None if elapsed is None else int(elapsed))
 
   def as_sql_dict(self):
-    d = attr.asdict(self)
-    d['timestamp'] = self.timestamp.timestamp
-    return d
+    return {'timestamp': self.timestamp, 'command': self.command, 'elapsed': self.elapsed}
 
   @property
   def unix(self):
-    return self.timestamp.timestamp
+    return self.timestamp
+
+  @property
+  def arrow(self):
+    import arrow
+    return arrow.get(self.timestamp)
+
+
+@attr.s(frozen=True, slots=True)
+class Checkpoint(object):
+  """where we stopped reading a histfile on the last backup"""
+  inode = attr.ib()
+  size = attr.ib()
+  mtime = attr.ib()
+  offset = attr.ib()
+  fingerprint = attr.ib()
+
+
+def _fingerprint(fp, offset):
+  import hashlib
+  start = max(0, offset - FINGERPRINT_LEN)
+  fp.seek(start)
+  return hashlib.sha1(fp.read(offset - start)).hexdigest()
+
+
+def _newline_end(fp, size, chunk=4096):
+  """returns the offset just past the last newline in the first size bytes of fp"""
+  pos = size
+  while pos > 0:
+    start = max(0, pos - chunk)
+    fp.seek(start)
+    i = fp.read(pos - start).rfind(b'\n')
+    if i >= 0:
+      return start + i + 1
+    pos = start
+  return 0
+
+
+def _last_line_end(fp, size, continuation=None, chunk=4096):
+  """returns the offset just past the last newline in the first size bytes of
+  fp that isn't preceded by continuation, i.e. the end of the last complete
+  entry"""
+  while True:
+    end = _newline_end(fp, size, chunk)
+    if continuation is None or end < 2:
+      return end
+    fp.seek(end - 2)
+    if fp.read(1) != continuation:
+      return end
+    size = end - 1
+
+
+def _regex_where(pattern):
+  """(predicates on command that together match the python regex pattern, the
+  params they use). the LIKEs on the literal parts of the pattern come first,
+  so the regex only runs on rows that have them. raises re.error for a bad
+  pattern"""
+  _compile_regex(pattern)
+  where, params = [], {'pattern': pattern}
+  for i, lit in enumerate(_regex_literals(pattern)):
+    where.append('command LIKE :lit{0}'.format(i))
+    params['lit{0}'.format(i)] = u'%{0}%'.format(lit)
+  where.append('command REGEXP :pattern')
+  return where, params
 
-  def __iter__(self):
-    return iter(attr.astuple(self))
 
 class AlreadyOpenException(Exception):
   pass
@@ -78,6 +169,22 @@ class HistConfig(object):
     default=DEFAULT_DB_PATH,
     validator=instance_of(six.string_types))
 
+  # how many seconds to wait for another connection's write lock before giving
+  # up with 'database is locked'
+  busy_timeout = attr.ib(default=30.0)
+
+  # a compiled bytes regex matching the first line of each record in the
+  # histfile, which lets big histfiles be split up and parsed in parallel
+  record_start = attr.ib(default=None)
+
+  # optional, a function that takes a binary file and a start and end offset
+  # and yields the same rows as history_iter_fn would for those bytes, faster
+  range_iter_fn = attr.ib(default=None)
+
+  # the byte that, at the end of a line, means the entry goes on to the next
+  # one, if the histfile has such a thing
+  continuation = attr.ib(default=None)
+
   @contextmanager
   def open(self):
     if self._conn is not None:
@@ -96,13 +203,30 @@ class HistConfig(object):
       #   as-needed basis. The recommended practice is for applications to invoke the PRAGMA optimize
       #   statement just before closing each database connection.
       #
-      self._conn.execute("PRAGMA optimize")
+      # but only after writing. a search shouldn't pay for it, and `schist
+      # maintain` does a proper ANALYZE now and then
+      if self._conn.total_changes:
+        with instrument.span('optimize'):
+          self._conn.execute("PRAGMA optimize")
       self._conn.close()
 
   def _open(self):
     conn = self.db_conn_factory(self.db_path)
+    conn.execute("PRAGMA busy_timeout = {0:d}".format(int(self.busy_timeout * 1000)))
     return self.evolve(conn=conn)
 
+  @contextmanager
+  def backup_lock(self, wait=0):
+    """an advisory lock so only one backup of this table runs at a time. yields
+    False if another one still held it after wait seconds (None waits forever)"""
+    if self.db_path == ':memory:':
+      yield True
+      return
+
+    path = '{0}.{1}.lock'.format(self.db_path, self.table_name)
+    with _advisory_lock(path, wait=wait) as locked:
+      yield locked
+
   @property
   def conn(self):
     if self._conn is None:
@@ -115,43 +239,665 @@ class HistConfig(object):
       self.create_table()
 
   def count(self):
+    """the number of rows, archived ones included"""
     return self.conn.execute(
         "select count(*) as c from {table}".format(table=self.table_name)
-      ).fetchone()[0]
+      ).fetchone()[0] + archive.totals(self.conn, self.table_name)[1]
 
-  def create_table(self):
-    return self.conn.execute("""\
+  def create_table(self, interned=False):
+    """create the history table. if interned is True, each distinct command is
+    stored once in {table}_commands and the history table refers to it by id"""
+    if interned:
+      return self._create_interned_table()
+
+    self.conn.execute("""\
         CREATE TABLE IF NOT EXISTS {table} (
           timestamp BIGINT NOT NULL,
           command text NOT NULL,
+          elapsed INTEGER,
           PRIMARY KEY (timestamp, command)
         )
       """.format(
         table=self.table_name,
         ))
+    return timing.create_index(self.conn, self.table_name)
+
+  @property
+  def commands_table(self):
+    return '{0}_commands'.format(self.table_name)
+
+  def _create_interned_table(self):
+    # hash is _command_hash(command). it's what new rows are looked up by, and
+    # is a lot smaller in an index than the command text.
+    self.conn.execute("""\
+        CREATE TABLE IF NOT EXISTS {commands} (
+          id INTEGER PRIMARY KEY,
+          hash BIGINT NOT NULL UNIQUE,
+          command text NOT NULL
+        )
+      """.format(commands=self.commands_table))
+
+    self.conn.execute("""\
+        CREATE TABLE IF NOT EXISTS {table} (
+          timestamp BIGINT NOT NULL,
+          command_id INTEGER NOT NULL REFERENCES {commands} (id),
+          elapsed INTEGER,
+          PRIMARY KEY (timestamp, command_id)
+        )
+      """.format(table=self.table_name, commands=self.commands_table))
+
+    self.conn.execute(
+        "CREATE INDEX IF NOT EXISTS {table}_command_id ON {table} (command_id)".format(
+          table=self.table_name))
+    return timing.create_index(self.conn, self.table_name)
+
+  def has_host_column(self):
+    return any(
+      r[1] == 'host'
+      for r in self.conn.execute("PRAGMA table_info({0})".format(self.table_name)))
+
+  def add_host_column(self):
+    """add a column recording which machine a row was merged from (NULL for the
+    rows backed up here)"""
+    if not self.has_host_column():
+      with self.conn:
+        self.conn.execute("ALTER TABLE {0} ADD COLUMN host text".format(self.table_name))
+
+  def has_elapsed_column(self):
+    return timing.has_column(self.conn, self.table_name)
 
-  def insert(self):
+  def add_elapsed_column(self, backfill=True):
+    """add the elapsed column (and its index) to a table from before there was
+    one, then fill it in for the rows still in the histfile. returns how many
+    rows got an elapsed time"""
     with self.conn:
-      cur = self.conn.cursor()
+      timing.add_column(self.conn, self.table_name)
 
-      q = u"""\
-        REPLACE INTO {table} ('timestamp', 'command')
-          VALUES(:timestamp, :command)
-      """.format(table=self.table_name)
+    if not backfill or not os.path.exists(self.histfile):
+      return 0
 
+    with self.conn:
       with self.open_histfile() as fp:
-        cur.executemany(q, (r.as_sql_dict() for r in self.history_iter_fn(fp)))
+        size = os.fstat(fp.fileno()).st_size
+        return timing.backfill(
+          self.conn, self.table_name, _iter_range(
+            fp, 0, size, self.history_iter_fn, self.range_iter_fn),
+          commands=self.commands_table if self.is_interned() else None)
+
+  def merge(self, path, record_host=False):
+    """add the rows from the schist db at path that aren't already in this one,
+    returns how many there were"""
+    from . import merge
+    added = merge.merge(self, path, record_host=record_host)
+    self.update_rollups()
+    return added
+
+  def is_interned(self):
+    xs = self.conn.execute(
+        "SELECT name from sqlite_master WHERE type='table' and name=:name",
+        dict(name=self.commands_table)
+      ).fetchall()
+    return len(xs) > 0
+
+  def _source(self):
+    """returns (FROM clause that yields timestamp and command, the expression in
+    it the search indexes' rowids refer to)"""
+    if self.is_interned():
+      return (
+        '{table} JOIN {commands} ON {commands}.id = {table}.command_id'.format(
+          table=self.table_name, commands=self.commands_table),
+        '{0}.id'.format(self.commands_table))
+    else:
+      return self.table_name, '{0}.rowid'.format(self.table_name)
+
+  def _index_content(self):
+    """(table, key column) the search indexes are built from"""
+    if self.is_interned():
+      return self.commands_table, 'id'
+    else:
+      return self.table_name, 'rowid'
+
+  def migrate_to_interned(self):
+    """convert a plain history table to the interned layout (or create an
+    interned one if there's no table yet), keeping rowids so everything keyed
+    on them stays valid. search indexes are rebuilt over the commands table."""
+    if self.is_interned():
+      return
+
+    if not self.table_exists():
+      with self.conn:
+        self._create_interned_table()
+      return
+
+    had_fts, had_trigram = self.fts_exists(), self.trigram_exists()
+    had_host = self.has_host_column()
+    self.drop_fts()
+    self.drop_trigram()
+
+    old = '{0}_plain'.format(self.table_name)
+
+    with self.conn:
+      self.conn.execute("ALTER TABLE {table} RENAME TO {old}".format(
+        table=self.table_name, old=old))
+
+      self._create_interned_table()
+      if had_host:
+        self.conn.execute("ALTER TABLE {0} ADD COLUMN host text".format(self.table_name))
+
+      self.conn.execute("""\
+          INSERT INTO {commands} (hash, command)
+            SELECT schist_hash(command), command FROM {old}
+              GROUP BY command ORDER BY min(rowid)
+        """.format(commands=self.commands_table, old=old))
+
+      self.conn.execute("""\
+          INSERT INTO {table} (rowid, timestamp, command_id, elapsed{host})
+            SELECT o.rowid, o.timestamp, c.id, {elapsed}{host_val} FROM {old} o
+              JOIN {commands} c ON c.hash = schist_hash(o.command)
+              ORDER BY o.rowid
+        """.format(
+          table=self.table_name, commands=self.commands_table, old=old,
+          elapsed='o.elapsed' if timing.has_column(self.conn, old) else 'NULL',
+          host=', host' if had_host else '', host_val=', o.host' if had_host else ''))
+
+      self.conn.execute("DROP TABLE {old}".format(old=old))
+      # the old table's index had the name we wanted
+      timing.create_index(self.conn, self.table_name)
+
+    if had_fts:
+      self.build_fts()
+    if had_trigram:
+      self.build_trigram()
+
+  def create_checkpoint_table(self):
+    return self.conn.execute("""\
+        CREATE TABLE IF NOT EXISTS {table} (
+          table_name text NOT NULL,
+          histfile text NOT NULL,
+          inode BIGINT NOT NULL,
+          size BIGINT NOT NULL,
+          mtime REAL NOT NULL,
+          offset BIGINT NOT NULL,
+          fingerprint text NOT NULL,
+          PRIMARY KEY (table_name, histfile)
+        )
+      """.format(table=CHECKPOINT_TABLE))
+
+  @property
+  def _histfile_key(self):
+    return os.path.abspath(self.histfile)
+
+  def read_checkpoint(self):
+    q = u"""\
+      SELECT inode, size, mtime, offset, fingerprint FROM {table}
+        WHERE table_name = :table_name AND histfile = :histfile
+    """.format(table=CHECKPOINT_TABLE)
+
+    r = self.conn.execute(
+        q, {'table_name': self.table_name, 'histfile': self._histfile_key}).fetchone()
+
+    return Checkpoint(**r) if r is not None else None
+
+  def write_checkpoint(self, cp):
+    q = u"""\
+      REPLACE INTO {table} (table_name, histfile, inode, size, mtime, offset, fingerprint)
+        VALUES (:table_name, :histfile, :inode, :size, :mtime, :offset, :fingerprint)
+    """.format(table=CHECKPOINT_TABLE)
+
+    d = attr.asdict(cp)
+    d.update(table_name=self.table_name, histfile=self._histfile_key)
+    self.conn.execute(q, d)
+
+  def _resume_offset(self, fp, st, cp):
+    """returns the offset to start parsing from, or None if nothing changed
+    since the checkpoint cp was taken"""
+    if cp is None:
+      return 0
+
+    if cp.inode != st.st_ino or st.st_size < cp.offset:
+      log.info("%s was replaced or truncated, doing a full scan", self.histfile)
+      return 0
+
+    if cp.size == st.st_size and cp.mtime == st.st_mtime:
+      return None
+
+    if _fingerprint(fp, cp.offset) != cp.fingerprint:
+      log.info("%s was rewritten, doing a full scan", self.histfile)
+      return 0
+
+    return cp.offset
+
+  def insert(self, full=False, processes=1):
+    """parse the histfile and add its rows to the db, returns the number of new rows
+
+    only the part of the histfile appended since the last checkpoint is parsed,
+    unless full is True or the file no longer looks like the one we checkpointed.
+    see parse_range() for processes.
+    """
+    with self.conn:
+      self.create_checkpoint_table()
+
+      with self.open_histfile() as fp:
+        with instrument.span('pending'):
+          pending = self.pending(fp, full=full)
+        if pending is None:
+          return 0
+
+        offset, end, cp = pending
+        added = self.insert_rows(self.parse_range(fp, offset, end, processes=processes))
+        self.write_checkpoint(cp)
+
+      with instrument.span('commit'):
+        self.conn.commit()
+
+      self.update_rollups()
+      return added
+
+  def parse_range(self, fp, offset, end, processes=1):
+    """the rows in the bytes from offset to end of fp, a histfile opened in
+    binary mode
+
+    if there's more than a couple of parallel.CHUNK_SIZE of them, they're
+    split up and parsed in up to processes worker processes (None for one per
+    cpu), which gives exactly the same rows in the same order.
+    """
+    if processes != 1 and self.record_start is not None:
+      # multiprocessing takes a while to import, only pay for it when it's used
+      from . import parallel
+      if end - offset >= 2 * parallel.CHUNK_SIZE:
+        return instrument.timed_iter('parse', parallel.parse_chunked(
+          fp.name, self.history_iter_fn, self.record_start, offset, end, processes=processes,
+          range_iter_fn=self.range_iter_fn))
+
+    return instrument.timed_iter(
+      'parse', _iter_range(fp, offset, end, self.history_iter_fn, self.range_iter_fn))
+
+  def pending(self, fp, full=False):
+    """work out what part of the histfile, open as fp, insert() has to parse
+
+    returns None if nothing changed since the last checkpoint, otherwise
+    (offset, end, the Checkpoint to write once those bytes are in the db)
+    """
+    st = os.fstat(fp.fileno())
+    offset = self._resume_offset(fp, st, None if full else self.read_checkpoint())
+
+    if offset is None:
+      log.debug("%s unchanged since last checkpoint", self.histfile)
+      return None
+
+    # a trailing partial line (or entry) may still be being written, so we
+    # leave it for the next run
+    end = _last_line_end(fp, st.st_size, self.continuation)
+
+    log.debug("parsing %s from offset %d to %d", self.histfile, offset, end)
+
+    cp = Checkpoint(
+      inode=st.st_ino,
+      size=st.st_size,
+      mtime=st.st_mtime,
+      offset=end,
+      fingerprint=_fingerprint(fp, end),
+    )
+    return offset, end, cp
+
+  def insert_rows(self, rows):
+    """add an iterable of Rows (or plain (timestamp, command[, elapsed]) tuples)
+    to the db, returns how many weren't already there"""
+    with instrument.span('insert_rows') as sp:
+      added = sp.rows = self._insert_rows(rows)
+    return added
+
+  def _insert_rows(self, rows):
+    rows = timing.with_elapsed(rows, self.has_elapsed_column())
+
+    if self.is_interned():
+      return self._insert_interned(rows)
+
+    # the primary key covers the timestamp and command, so an existing row is
+    # the one we'd insert. IGNORE leaves it (and its rowid) alone, REPLACE
+    # would delete and re-add it.
+    q = u"""\
+      INSERT OR IGNORE INTO {table} (timestamp, command{elapsed}) VALUES (?, ?{param})
+    """.format(table=self.table_name, **timing.insert_columns(self.has_elapsed_column()))
+
+    return self.conn.executemany(q, rows).rowcount
+
+  @contextmanager
+  def _relaxed_durability(self):
+    """trade crash safety for speed while bulk loading. if the machine dies
+    halfway through, the db may need restoring, but the load can just be re-run"""
+    conn = self.conn
+    synchronous = conn.execute("PRAGMA synchronous").fetchone()[0]
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+
+    conn.execute("PRAGMA synchronous = OFF")
+    # leaving WAL needs the db to ourselves, if someone else has it open we
+    # just stay in WAL
+    try:
+      conn.execute("PRAGMA journal_mode = MEMORY")
+    except sqlite3.OperationalError as e:
+      log.debug("couldn't change journal mode: %s", e)
+
+    try:
+      yield
+    finally:
+      conn.execute("PRAGMA journal_mode = {0}".format(journal_mode))
+      conn.execute("PRAGMA synchronous = {0:d}".format(synchronous))
+
+  def _secondary_indexes(self):
+    """(name, sql) of the indexes on our tables we could drop and recreate"""
+    tables = [self.table_name]
+    if self.is_interned():
+      tables.append(self.commands_table)
+
+    q = u"""\
+      SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({0})
+    """.format(', '.join('?' * len(tables)))
+
+    return self.conn.execute(q, tables).fetchall()
+
+  def bulk_import(self, paths, batch_size=50000, rebuild_indexes=False, progress=None,
+      processes=1):
+    """load every histfile in paths, committing every batch_size rows, and
+    returns the number of rows that were new. big files are parsed in up to
+    processes worker processes, see parse_range().
+
+    if rebuild_indexes is True the secondary and search indexes are dropped for
+    the load and built again afterwards, which is much faster than updating
+    them row by row for a big import. progress, if given, is called after each
+    batch with (rows read, rows added, seconds elapsed).
+    """
+    read = added = 0
+    t0 = time.time()
+
+    indexes = []
+    had_fts = had_trigram = False
+
+    with self._relaxed_durability():
+      if rebuild_indexes:
+        indexes = self._secondary_indexes()
+        had_fts, had_trigram = self.fts_exists(), self.trigram_exists()
+        with self.conn:
+          for name, _ in indexes:
+            self.conn.execute("DROP INDEX {0}".format(name))
+        self.drop_fts()
+        self.drop_trigram()
+
+      try:
+        for path in paths:
+          with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            rows = iter(self.parse_range(fp, 0, size, processes=processes))
+            while True:
+              batch = list(itertools.islice(rows, batch_size))
+              if not batch:
+                break
+              with self.conn:
+                added += self.insert_rows(batch)
+              read += len(batch)
+              if progress is not None:
+                progress(read, added, time.time() - t0)
+      finally:
+        if rebuild_indexes:
+          with self.conn:
+            for _, sql in indexes:
+              self.conn.execute(sql)
+          if had_fts:
+            self.build_fts()
+          if had_trigram:
+            self.build_trigram()
+
+      self.update_rollups()
+
+    return added
+
+  def _insert_interned(self, rows):
+    self.conn.execute("""\
+        CREATE TEMP TABLE IF NOT EXISTS schist_staging (
+          timestamp BIGINT NOT NULL,
+          hash BIGINT NOT NULL,
+          command text NOT NULL,
+          elapsed INTEGER
+        )
+      """)
+    self.conn.execute("DELETE FROM temp.schist_staging")
+
+    self.conn.executemany(
+      "INSERT INTO temp.schist_staging (timestamp, hash, command, elapsed) VALUES (?, ?, ?, ?)",
+      ((r[0], _command_hash(r[1]), r[1], r[2] if len(r) > 2 else None) for r in rows))
+
+    self.conn.execute("""\
+        INSERT OR IGNORE INTO {commands} (hash, command)
+          SELECT hash, command FROM temp.schist_staging ORDER BY rowid
+      """.format(commands=self.commands_table))
+
+    # the command check means a hash collision drops the row rather than
+    # recording the wrong command for it
+    added = self.conn.execute("""\
+        INSERT OR IGNORE INTO {table} (timestamp, command_id{elapsed})
+          SELECT s.timestamp, c.id{value} FROM temp.schist_staging s
+            JOIN {commands} c ON c.hash = s.hash AND c.command = s.command
+            ORDER BY s.rowid
+      """.format(
+        table=self.table_name, commands=self.commands_table,
+        **timing.insert_columns(self.has_elapsed_column(), value='s.elapsed'))).rowcount
+
+    self.conn.execute("DELETE FROM temp.schist_staging")
+    return added
+
+  def _select_rows(self, q, *a):
+    """run q, which must select (timestamp, command[, elapsed]), and yield Rows"""
+    cur = self.conn.cursor()
+    cur.row_factory = None
+    cur.arraysize = FETCH_SIZE
+    cur.execute(q, *a)
+    if len(cur.description) == 3:
+      make = Row._make
+    else:
+      make = lambda r: Row._make(r + (None,))
+    while True:
+      chunk = cur.fetchmany()
+      if not chunk:
+        return
+      for r in chunk:
+        yield make(r)
 
   def search(self, term, limit=25):
-    """do a text search for a command"""
+    """do a text search for a command
+
+    term is a LIKE pattern. if there's a trigram index, and term has literal
+    parts of 3 or more characters, they're used to find the candidate rows
+    rather than scanning the whole table.
+    """
     with self.conn:
-      q = u"""\
-        SELECT * from {table} where command LIKE :term ORDER BY timestamp DESC LIMIT :limit
-      """.format(table=self.table_name)
+      params = {'term': term, 'limit': int(limit)}
+
+      source, doc_id = self._source()
+
+      runs = fts.literal_runs(term)
+      if runs and self.trigram_exists():
+        q = fts.trigram_search_sql(self.table_name, source=source, doc_id=doc_id)
+        params['query'] = fts.trigram_query(runs)
+      else:
+        q = u"""\
+          SELECT timestamp, command from {source} where command LIKE :term
+            ORDER BY timestamp DESC LIMIT :limit
+        """.format(source=source)
+
+      found = list(self._select_rows(q, params))
+
+    for row in self._search_archive(found, 'command LIKE :term', params):
+      yield row
+
+  def _search_archive(self, found, predicate, params):
+    """merge the archive's matches for predicate into found, the history
+    table's (newest first, at most params['limit'] of them). the blocks are
+    read newest first, and only until none of what's left could make the cut"""
+    limit = params['limit']
+    for start, _, max_ts, _ in archive.blocks(self.conn, self.table_name, newest_first=True):
+      if len(found) >= limit and max_ts < found[limit - 1].timestamp:
+        break
+
+      name = archive.load(self.conn, self.table_name, [start])
+      try:
+        found.extend(self._select_rows(u"""\
+          SELECT timestamp, command FROM temp.{name} WHERE {predicate}
+            ORDER BY timestamp DESC LIMIT :limit
+        """.format(name=name, predicate=predicate), params))
+      finally:
+        archive.drop(self.conn, name)
+
+      # sort is stable, so of rows with the same timestamp the newer ones stay first
+      found.sort(key=lambda r: r.timestamp, reverse=True)
+      del found[limit:]
+
+    return found
+
+  def search_regex(self, pattern, limit=25):
+    """yields Rows whose command matches the python regex pattern (anywhere, as
+    with re.search), most recent first
+
+    the regex is only run on rows that contain every literal substring it
+    requires. those are found with the trigram index if there is one, and with
+    LIKE otherwise, which is still much cheaper than calling back into python
+    for every row. raises re.error for a bad pattern.
+    """
+    where, params = _regex_where(pattern)
+    where = ' AND '.join(where)
+    params['limit'] = int(limit)
+    runs = [l for l in _regex_literals(pattern) if len(l) >= 3]
+
+    with self.conn:
+      source, doc_id = self._source()
+
+      if runs and self.trigram_exists():
+        q = fts.trigram_search_sql(
+          self.table_name, predicate='command REGEXP :pattern', source=source, doc_id=doc_id)
+        params['query'] = fts.trigram_query(runs)
+      else:
+        q = u"""\
+          SELECT timestamp, command from {source} WHERE {where}
+            ORDER BY timestamp DESC LIMIT :limit
+        """.format(source=source, where=where)
+
+      found = list(self._select_rows(q, params))
+
+    for row in self._search_archive(found, where, params):
+      yield row
 
-      for r in self.conn.execute(q, {'term': term, 'limit': int(limit)}):
-        yield Row(**r)
+  def search_frecent(self, term, limit=25, regex=False):
+    """each command matching term once, the ones run most often and most
+    recently first (see frecency), as Rows with the last time they were run
 
+    term is a LIKE pattern, or with regex a python regex as for search_regex().
+    this reads the usage table that update_rollups() keeps, so it's as of the
+    last backup, and creates it if it's not there yet.
+    """
+    if regex:
+      where, params = _regex_where(term)
+    else:
+      where, params = ['command LIKE :term'], {'term': term}
+    params['limit'] = int(limit)
+
+    if not frecency.exists(self.conn, self.table_name):
+      self.update_rollups()
+
+    return self._select_rows(frecency.search_sql(self.table_name, ' AND '.join(where)), params)
+
+  def suggest(self, prefix):
+    """the most recently run command that starts with prefix (and is more than
+    just prefix), or None. as of the last update_rollups(), like search_frecent()"""
+    if not prefix:
+      return None
+
+    if not frecency.exists(self.conn, self.table_name):
+      self.update_rollups()
+
+    params = {'lo': prefix, 'n': len(prefix)}
+    try:
+      # everything starting with prefix sorts before this
+      params['hi'] = prefix[:-1] + six.unichr(ord(prefix[-1]) + 1)
+    except ValueError:
+      # prefix ends in the last character there is (U+10FFFF, or U+FFFF on a
+      # narrow python 2)
+      pass
+    r = self.conn.execute(
+      frecency.suggest_sql(self.table_name, bounded='hi' in params), params).fetchone()
+    return None if r is None else r[0]
+
+  def fts_available(self):
+    return fts.fts5_available(self.conn)
+
+  def fts_exists(self):
+    return fts.exists(self.conn, self.table_name)
+
+  def build_fts(self):
+    """create or rebuild the full text index for this table"""
+    content, key = self._index_content()
+    fts.build(self.conn, self.table_name, content=content, key=key)
+
+  def drop_fts(self):
+    fts.drop(self.conn, self.table_name)
+
+  def trigram_available(self):
+    return fts.fts5_available(self.conn, fts.TRIGRAM)
+
+  def trigram_exists(self):
+    return fts.exists(self.conn, self.table_name, fts.TRIGRAM)
+
+  def build_trigram(self):
+    """create or rebuild the trigram index used by search()"""
+    content, key = self._index_content()
+    fts.build(self.conn, self.table_name, fts.TRIGRAM, content=content, key=key)
+
+  def drop_trigram(self):
+    fts.drop(self.conn, self.table_name, fts.TRIGRAM)
+
+  def search_fts(self, term, limit=25, hl_open='', hl_close=''):
+    """ranked full text search, yields (Row, snippet) pairs, best match first.
+    the archive isn't indexed, so this only covers the history table
+
+    if this db has no full text index (or sqlite has no FTS5) this falls back to
+    a LIKE search for the words in term, in order, most recent first.
+    """
+    # nothing but whitespace and '*'s, which would be an fts5 syntax error
+    if not fts.match_query(term):
+      return
+
+    if self.fts_available() and self.fts_exists():
+      source, doc_id = self._source()
+      for ts, cmd, snip in fts.search(
+          self.conn, self.table_name, term, limit,
+          hl_open=hl_open, hl_close=hl_close, source=source, doc_id=doc_id):
+        yield Row._make((ts, cmd, None)), snip
+    else:
+      log.warning("no full text index for %s, falling back to LIKE", self.table_name)
+      like = u'%{0}%'.format(u'%'.join(w.rstrip('*') for w in term.split()))
+      for row in self.search(like, limit):
+        yield row, row.command
+
+  def recent_commands(self):
+    """every distinct command, most recently run first. that goes by timestamp,
+    with rowid to break ties, since an import or merge can add old rows last"""
+    if self.is_interned():
+      q = """\
+        SELECT command FROM (
+          SELECT command_id, max(timestamp) AS ts, max(rowid) AS rid FROM {table}
+            GROUP BY command_id
+        ) m JOIN {commands} ON {commands}.id = m.command_id
+          ORDER BY m.ts DESC, m.rid DESC
+      """.format(table=self.table_name, commands=self.commands_table)
+    else:
+      q = """\
+        SELECT command FROM {table} GROUP BY command
+          ORDER BY max(timestamp) DESC, max(rowid) DESC
+      """.format(table=self.table_name)
+
+    cur = self.conn.cursor()
+    cur.row_factory = None
+    cur.arraysize = FETCH_SIZE
+    return [r[0] for r in cur.execute(q)]
 
   def table_exists(self):
     xs = self.conn.execute(
@@ -165,31 +911,197 @@ class HistConfig(object):
     with open(self.histfile, 'rb') as fp:
       yield fp
 
-  _ROWS_SQL = "select timestamp, command from {table} order by rowid {limit}"
+  _ROWS_SQL = "select timestamp, command{elapsed} from {source} order by {table}.rowid {limit}"
+
+  def _elapsed_sql(self):
+    return ', elapsed' if self.has_elapsed_column() else ''
 
   def rows(self, limit=None):
+    """every row, oldest first: the archived ones, then the history table"""
     q = self._ROWS_SQL.format(
+      elapsed=self._elapsed_sql(),
+      source=self._source()[0],
       table=self.table_name,
       limit=' LIMIT %d' % (limit,) if limit is not None else ''
     )
 
-    for r in self.conn.execute(q):
-      yield Row(**r)
+    rows = itertools.chain(self._archived_rows(), self._select_rows(q))
+    return rows if limit is None else itertools.islice(rows, limit)
+
+  def _archived_rows(self):
+    for start, _, _, _ in archive.blocks(self.conn, self.table_name):
+      for ts, command, elapsed, _ in archive.read(self.conn, self.table_name, start):
+        yield Row._make((ts, command, elapsed))
+
+  def archive(self, before):
+    """move the rows from before `before` into the compressed archive (see
+    archive.py), returns how many were moved"""
+    # so the rollups and usage table have counted them before they go
+    self.update_rollups()
+
+    with instrument.span('archive') as sp:
+      moved = sp.rows = archive.move(
+        self.conn, self.table_name, _unix(before), source=self._source()[0],
+        elapsed=self.has_elapsed_column(), host=self.has_host_column())
+
+    if moved and self.is_interned():
+      with self.conn:
+        self.conn.execute(
+          "DELETE FROM {commands} WHERE id NOT IN (SELECT command_id FROM {table})".format(
+            commands=self.commands_table, table=self.table_name))
+    return moved
+
+  def archive_totals(self):
+    """(blocks, rows, compressed bytes) in the archive"""
+    return archive.totals(self.conn, self.table_name)
+
+  def update_rollups(self):
+    """bring the per-hour/day counts and the per-command usage up to date with
+    rows added since the last call, and drop the new rows the archive already
+    has"""
+    with instrument.span('rollups'):
+      with _write_transaction(self.conn):
+        source = self._source()[0]
+        archive.drop_archived(self.conn, self.table_name, source=source)
+        rollup.update(self.conn, self.table_name)
+        frecency.update(self.conn, self.table_name, source=source)
 
   def cmds_since(self, ts):
-    q = "select count(*) as c from {table} where timestamp > :ts".format(table=self.table_name)
-    return self.conn.execute(q, {'ts': ts.timestamp}).fetchone()[0]
+    """the number of commands after ts, as of the last update_rollups()"""
+    return rollup.count_between(self.conn, self.table_name, _unix(ts) + 1)
+
+  def total_count(self):
+    """count(), but from the rollups rather than a table scan"""
+    return rollup.count_between(self.conn, self.table_name, 0)
+
+  def histogram(self, since, until, unit='day'):
+    """an OrderedDict of local date -> number of commands for each day, week or
+    month between since and until"""
+    return rollup.histogram(self.conn, self.table_name, _unix(since), _unix(until), unit)
+
+  def slowest(self, limit=20, since=None, like=None):
+    """(timestamp, elapsed, command) for the longest running commands"""
+    return timing.slowest(
+      self.conn, self._source()[0], limit,
+      since=None if since is None else _unix(since), like=like)
+
+  def by_command(self, limit=20, since=None, like=None):
+    """per command run counts, total and percentile seconds, see timing.by_command"""
+    key = '{0}.command_id'.format(self.table_name) if self.is_interned() else 'command'
+    return timing.by_command(
+      self.conn, self._source()[0], key, limit,
+      since=None if since is None else _unix(since), like=like)
+
+  def time_spent(self, since, until, unit='day', like=None):
+    """an OrderedDict of local date -> (commands, seconds they ran for) for each
+    day, week or month between since and until"""
+    return timing.time_spent(
+      self.conn, self._source()[0], _unix(since), _unix(until), unit, like=like)
 
   def last_cmd(self):
     q = "select timestamp as ts from {table} order by rowid DESC limit 1".format(
         table=self.table_name)
 
     last_ts = self.conn.execute(q).fetchone()['ts']
+    import arrow
     return arrow.get(last_ts).to('local')
 
   def evolve(self, **kw):
     return attr.evolve(self, **kw)
 
-  def restore(self, out_fp):
-    """dump the contents of the db to out_fp in the correct format"""
-    self.output_fn(self.rows(), out_fp)
+  def restore_rows(self, since=None, last=None, unique=False):
+    """the rows restore() writes out, oldest first
+
+    since drops rows from before that time, unique keeps only the latest
+    occurrence of each command, and last keeps only the last N of what's left.
+    latest goes by timestamp, then rowid, since an import or merge can add
+    rows from long ago after recent ones. it's all done in sql, so e.g. the
+    last 10k unique commands of a 1M row table never go through python. only
+    the archive blocks after since get decompressed.
+    """
+    cold = archive.blocks(self.conn, self.table_name, since=None if since is None else _unix(since))
+    if cold:
+      return self._restore_with_archive([b[0] for b in cold], since, last, unique)
+
+    table = self.table_name
+    source = self._source()[0]
+    elapsed = self._elapsed_sql()
+    params = {}
+
+    where = ''
+    if since is not None:
+      where = 'WHERE timestamp >= :since'
+      params['since'] = _unix(since)
+
+    if unique:
+      # find the latest rowids first and only then join in the commands, which
+      # for an interned table can be answered from the command_id index and
+      # the primary key alone
+      key = 'command_id' if self.is_interned() else 'command'
+      q = """\
+        SELECT m.rid AS rid, timestamp, command{elapsed} FROM (
+          SELECT max(h.rowid) AS rid FROM {table} h JOIN (
+            SELECT {key} AS k, max(timestamp) AS ts FROM {table} {where} GROUP BY {key}
+          ) l ON h.{key} = l.k AND h.timestamp = l.ts
+          GROUP BY h.{key}
+        ) m, {source} WHERE {table}.rowid = m.rid
+      """.format(table=table, source=source, where=where, key=key, elapsed=elapsed)
+    else:
+      q = "SELECT {table}.rowid AS rid, timestamp, command{elapsed} FROM {source} {where}".format(
+        table=table, source=source, where=where, elapsed=elapsed)
+
+    if last is not None:
+      q = "SELECT * FROM ({q}) ORDER BY timestamp DESC, rid DESC LIMIT :last".format(q=q)
+      params['last'] = int(last)
+
+    return self._select_rows(
+      "SELECT timestamp, command{elapsed} FROM ({q}) ORDER BY timestamp, rid".format(
+        q=q, elapsed=elapsed), params)
+
+  def _restore_with_archive(self, starts, since, last, unique):
+    """restore_rows() over the blocks at starts and the history table"""
+    elapsed = self._elapsed_sql()
+    params = {}
+
+    where = ''
+    if since is not None:
+      where = 'WHERE timestamp >= :since'
+      params['since'] = _unix(since)
+
+    if unique:
+      q = """\
+        SELECT * FROM everything WHERE rid IN (
+          SELECT max(e.rid) FROM everything e JOIN (
+            SELECT command, max(timestamp) AS ts FROM everything {where} GROUP BY command
+          ) l ON e.command = l.command AND e.timestamp = l.ts
+          GROUP BY e.command)
+      """.format(where=where)
+    else:
+      q = "SELECT * FROM everything {where}".format(where=where)
+
+    if last is not None:
+      q = "SELECT * FROM ({q}) ORDER BY timestamp DESC, rid DESC LIMIT :last".format(q=q)
+      params['last'] = int(last)
+
+    name = archive.load(self.conn, self.table_name, starts)
+    try:
+      # the archived rows' rids are all negative, so they sort before the
+      # history table's rows from the same second
+      for row in self._select_rows("""\
+          WITH everything AS (
+            SELECT rid, timestamp, command{elapsed} FROM temp.{name}
+            UNION ALL
+            SELECT {table}.rowid, timestamp, command{elapsed} FROM {source}
+          )
+          SELECT timestamp, command{elapsed} FROM ({q}) ORDER BY timestamp, rid
+        """.format(
+          name=name, table=self.table_name, source=self._source()[0], elapsed=elapsed, q=q),
+          params):
+        yield row
+    finally:
+      archive.drop(self.conn, name)
+
+  def restore(self, out_fp, since=None, last=None, unique=False):
+    """dump the contents of the db to out_fp in the correct format, see
+    restore_rows() for the arguments"""
+    self.output_fn(self.restore_rows(since=since, last=last, unique=unique), out_fp)
@@ -0,0 +1,117 @@
+"""per-command usage, so search can rank by frecency without a GROUP BY
+
+{table}_usage has a row for every distinct command: how many times it was run,
+when it was first and last run, and its score. update() folds in only the rows
+added since it last ran, tracked by rowid, the same as the rollups.
+
+a command's frecency at time t is the sum, over every time it was run, of
+2 ** -((t - timestamp) / HALF_LIFE), so each run counts half as much per
+HALF_LIFE since it happened. the score stored is log2 of that at t = 0, i.e.
+log2(sum(2 ** (timestamp / HALF_LIFE))). the frecency at any t is then
+2 ** (score - t / HALF_LIFE), which ranks commands the same way the score does,
+so nothing needs decaying as time passes, and new runs just get log2-added in.
+search reads the table in score order through an index.
+"""
+
+from __future__ import print_function
+
+import logging
+
+from .common import _watermark, _set_watermark
+
+
+log = logging.getLogger(__name__)
+
+HALF_LIFE = 7 * 86400
+
+
+def usage_table(table):
+  return '{0}_usage'.format(table)
+
+
+def create(conn, table):
+  usage = usage_table(table)
+  conn.execute("""\
+      CREATE TABLE IF NOT EXISTS {usage} (
+        command text NOT NULL PRIMARY KEY,
+        count BIGINT NOT NULL,
+        first_seen BIGINT NOT NULL,
+        last_seen BIGINT NOT NULL,
+        score REAL NOT NULL
+      )
+    """.format(usage=usage))
+  conn.execute("CREATE INDEX IF NOT EXISTS {usage}_score ON {usage} (score)".format(usage=usage))
+
+
+def exists(conn, table):
+  return conn.execute(
+      "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+      (usage_table(table),)
+    ).fetchone() is not None
+
+
+def update(conn, table, source=None):
+  """add the rows inserted since the last update to the usage table. source is
+  the FROM clause to read them from (table, joined to its interned commands if
+  it has them). run it in a _write_transaction, as for rollup.update()"""
+  create(conn, table)
+
+  usage = usage_table(table)
+  since = _watermark(conn, usage)
+
+  last = conn.execute(
+      "SELECT max(rowid) FROM {table}".format(table=table)).fetchone()[0]
+
+  if last is None or last <= since:
+    return
+
+  found = conn.execute("""\
+      SELECT command, count(*), min(timestamp), max(timestamp),
+          schist_log2sum(timestamp * 1.0 / :half_life)
+        FROM {source}
+        WHERE {table}.rowid > :since AND {table}.rowid <= :last
+        GROUP BY command
+    """.format(source=source or table, table=table),
+    {'half_life': HALF_LIFE, 'since': since, 'last': last}).fetchall()
+
+  # not an upsert (INSERT ... ON CONFLICT), that needs sqlite 3.24. the
+  # commands already there get updated, and then the rest inserted
+  conn.executemany("""\
+      UPDATE {usage} SET
+          count = count + ?,
+          first_seen = min(first_seen, ?),
+          last_seen = max(last_seen, ?),
+          score = schist_log2add(score, ?)
+        WHERE command = ?
+    """.format(usage=usage),
+    ((n, first, last_seen, score, cmd) for cmd, n, first, last_seen, score in found))
+  conn.executemany("""\
+      INSERT OR IGNORE INTO {usage} (command, count, first_seen, last_seen, score)
+        VALUES (?, ?, ?, ?, ?)
+    """.format(usage=usage), found)
+
+  _set_watermark(conn, usage, last)
+
+
+def search_sql(table, predicate='command LIKE :term'):
+  """selects (last_seen, command) for the commands matching predicate, best
+  score first. the score index gives the order, so this stops as soon as it
+  has :limit matches"""
+  return u"""\
+    SELECT last_seen, command FROM {usage} WHERE {predicate}
+      ORDER BY score DESC LIMIT :limit
+  """.format(usage=usage_table(table), predicate=predicate)
+
+
+def suggest_sql(table, bounded=True):
+  """selects the most recently run command in [:lo, :hi), apart from :lo itself,
+  using the index on command. without bounded, there's no :hi, and the
+  commands after :lo are checked for starting with it (the first :n chars)"""
+  if bounded:
+    predicate = 'command < :hi'
+  else:
+    predicate = 'substr(command, 1, :n) = :lo'
+  return u"""\
+    SELECT command FROM {usage} WHERE command > :lo AND {predicate}
+      ORDER BY last_seen DESC LIMIT 1
+  """.format(usage=usage_table(table), predicate=predicate)
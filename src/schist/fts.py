@@ -0,0 +1,182 @@
+"""optional FTS5 indexes over a history table's commands
+
+there are two kinds of index, both external content fts5 tables kept in sync
+with the history table by triggers:
+
+  * FTS, {table}_fts, a regular word index used for ranked `search --fts`
+  * TRIGRAM, {table}_trigram, using the trigram tokenizer, which lets plain
+    LIKE searches look up candidate rows by the literal parts of the pattern
+
+neither is created by default: `schist index` builds them, and rebuilds them
+from scratch if they already exist (e.g. after a VACUUM has renumbered the
+history table's rowids).
+
+the indexed content is whatever table holds the command text: the history table
+itself, keyed by rowid, or for an interned history table its {table}_commands
+table, keyed by id, so each distinct command is only indexed once. searches take
+a FROM clause (source) that yields timestamp and command, and the expression in
+it (doc_id) that the index's rowids correspond to.
+"""
+
+from __future__ import print_function
+
+import logging
+import re
+import sqlite3
+
+
+log = logging.getLogger(__name__)
+
+FTS = 'fts'
+TRIGRAM = 'trigram'
+
+_TOKENIZE = {
+  FTS: '',
+  # the trigram tokenizer arrived in sqlite 3.34
+  TRIGRAM: ", tokenize='trigram'",
+}
+
+
+def fts5_available(conn, kind=FTS):
+  """True if the sqlite library conn is using can build an index of this kind"""
+  try:
+    conn.execute(
+      "CREATE VIRTUAL TABLE temp.schist_fts5_probe USING fts5(x{0})".format(_TOKENIZE[kind]))
+  except sqlite3.OperationalError:
+    return False
+  conn.execute("DROP TABLE temp.schist_fts5_probe")
+  return True
+
+
+def fts_table(table, kind=FTS):
+  return '{0}_{1}'.format(table, kind)
+
+
+def exists(conn, table, kind=FTS):
+  xs = conn.execute(
+      "SELECT name from sqlite_master WHERE type='table' and name=:name",
+      dict(name=fts_table(table, kind))
+    ).fetchall()
+  return len(xs) > 0
+
+
+_CREATE_SQL = [
+  """\
+    CREATE VIRTUAL TABLE IF NOT EXISTS {fts}
+      USING fts5(command, content='{content}', content_rowid='{key}'{tokenize})
+  """,
+  """\
+    CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {content} BEGIN
+      INSERT INTO {fts} (rowid, command) VALUES (new.{key}, new.command);
+    END
+  """,
+  """\
+    CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {content} BEGIN
+      INSERT INTO {fts} ({fts}, rowid, command) VALUES ('delete', old.{key}, old.command);
+    END
+  """,
+  """\
+    CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON {content} BEGIN
+      INSERT INTO {fts} ({fts}, rowid, command) VALUES ('delete', old.{key}, old.command);
+      INSERT INTO {fts} (rowid, command) VALUES (new.{key}, new.command);
+    END
+  """,
+]
+
+
+def build(conn, table, kind=FTS, content=None, key='rowid'):
+  """create the index and its triggers if needed, then (re)build it from the
+  content table (table by default), whose key column is the index's rowid"""
+  fts = fts_table(table, kind)
+  content = content or table
+  with conn:
+    for q in _CREATE_SQL:
+      conn.execute(q.format(fts=fts, content=content, key=key, tokenize=_TOKENIZE[kind]))
+    conn.execute("INSERT INTO {fts} ({fts}) VALUES ('rebuild')".format(fts=fts))
+
+
+def drop(conn, table, kind=FTS):
+  fts = fts_table(table, kind)
+  with conn:
+    for suffix in ('ai', 'ad', 'au'):
+      conn.execute("DROP TRIGGER IF EXISTS {fts}_{s}".format(fts=fts, s=suffix))
+    conn.execute("DROP TABLE IF EXISTS {fts}".format(fts=fts))
+
+
+def match_query(term):
+  """turn a search term into an fts5 MATCH expression
+
+  each whitespace separated word is quoted, so things like 'kubectl-prod' or
+  'a.b' aren't parsed as fts5 syntax, and all of them have to match. a
+  trailing '*' on a word is kept as a prefix match.
+  """
+  words = []
+  for w in term.split():
+    prefix = w.endswith('*')
+    w = w.rstrip('*')
+    if not w:
+      continue
+    words.append(u'"{0}"{1}'.format(w.replace('"', '""'), '*' if prefix else ''))
+  return u' '.join(words)
+
+
+_SEARCH_SQL = u"""\
+  SELECT timestamp, command, f.snip FROM (
+    SELECT rowid, bm25({fts}) AS score,
+           snippet({fts}, 0, :hl_open, :hl_close, '...', 64) AS snip
+      FROM {fts} WHERE {fts} MATCH :query
+      ORDER BY score LIMIT :limit
+  ) f, {source} WHERE {doc_id} = f.rowid
+  ORDER BY f.score, timestamp DESC LIMIT :limit
+"""
+
+
+def search(conn, table, term, limit=25, hl_open='', hl_close='', source=None, doc_id=None):
+  """yields (timestamp, command, snippet) tuples, best match first"""
+  q = _SEARCH_SQL.format(
+    fts=fts_table(table),
+    source=source or table,
+    doc_id=doc_id or '{0}.rowid'.format(table))
+  params = {
+    'query': match_query(term),
+    'limit': int(limit),
+    'hl_open': hl_open,
+    'hl_close': hl_close,
+  }
+
+  cur = conn.cursor()
+  cur.row_factory = None
+  for r in cur.execute(q, params):
+    yield r
+
+
+_LIKE_WILDCARDS = re.compile(u'[%_]+')
+
+
+def literal_runs(pattern, min_len=3):
+  """the literal parts of a LIKE pattern that are long enough to look up in a
+  trigram index"""
+  return [r for r in _LIKE_WILDCARDS.split(pattern) if len(r) >= min_len]
+
+
+def trigram_query(runs):
+  """a MATCH expression for rows containing every one of runs"""
+  return u' AND '.join(u'"{0}"'.format(r.replace('"', '""')) for r in runs)
+
+
+_TRIGRAM_SEARCH_SQL = u"""\
+  SELECT timestamp, command FROM {source}
+    WHERE {doc_id} IN (SELECT rowid FROM {tri} WHERE {tri} MATCH :query)
+      AND {predicate}
+    ORDER BY timestamp DESC LIMIT :limit
+"""
+
+
+def trigram_search_sql(table, predicate='command LIKE :term', source=None, doc_id=None):
+  """the trigram index only narrows things down to candidate rows (it's case
+  insensitive beyond ascii, for one), predicate still decides what matches"""
+  return _TRIGRAM_SEARCH_SQL.format(
+    source=source or table,
+    doc_id=doc_id or '{0}.rowid'.format(table),
+    tri=fts_table(table, TRIGRAM),
+    predicate=predicate)
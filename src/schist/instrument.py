@@ -0,0 +1,268 @@
+"""timing spans and sql tracing, for `schist --profile` and `--trace-sql`
+
+the interesting bits of a backup are wrapped in span('name'), which adds the
+time spent in it to that phase (and the rows it handled, if it sets them).
+nested spans are charged to their parent too, so each phase also gets a
+self_seconds of the time it spent on its own. timed_iter() does the same for
+the time spent pulling rows out of an iterator, which is how parsing, done
+lazily inside the insert's executemany, gets separated from the insert.
+
+all of this is a no-op until enable() is called. once it is, report() gives one
+dict per phase, and emit() logs them as json. only the calling process is
+covered, not parallel workers.
+
+with trace_sql(True), connections made by common._mk_conn log every statement
+they run and how long it took (up to the first row, for queries).
+"""
+
+from __future__ import print_function
+
+import logging
+import sqlite3
+import time
+
+from collections import OrderedDict
+
+import attr
+
+
+log = logging.getLogger(__name__)
+sql_log = logging.getLogger(__name__ + '.sql')
+
+clock = getattr(time, 'perf_counter', time.time)
+
+# the Profile while profiling is on
+_profile = None
+
+_trace_sql = False
+
+
+@attr.s
+class Phase(object):
+  name = attr.ib()
+  calls = attr.ib(default=0)
+  seconds = attr.ib(default=0.0)
+  child_seconds = attr.ib(default=0.0)
+  rows = attr.ib(default=None)
+
+  def as_dict(self):
+    d = OrderedDict([
+      ('phase', self.name),
+      ('calls', self.calls),
+      ('seconds', round(self.seconds, 6)),
+      ('self_seconds', round(self.seconds - self.child_seconds, 6)),
+    ])
+    if self.rows is not None:
+      d['rows'] = self.rows
+      d['rows_per_sec'] = round(self.rows / self.seconds, 1) if self.seconds else None
+    return d
+
+
+class _Span(object):
+  __slots__ = ('name', 'rows', 'child_seconds', '_profile', '_t0')
+
+  def __init__(self, profile, name):
+    self._profile = profile
+    self.name = name
+    self.rows = None
+    self.child_seconds = 0.0
+
+  def __enter__(self):
+    self._profile._stack.append(self)
+    self._t0 = clock()
+    return self
+
+  def __exit__(self, *exc):
+    seconds = clock() - self._t0
+    self._profile._stack.pop()
+    self._profile.add(self.name, seconds, self.rows, self.child_seconds)
+    return False
+
+
+class _NullSpan(object):
+  """what span() gives when profiling is off"""
+  __slots__ = ()
+  rows = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+  def __setattr__(self, name, value):
+    pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Profile(object):
+  def __init__(self):
+    self.phases = OrderedDict()
+    self.started = clock()
+    self._stack = []
+
+  def add(self, name, seconds, rows=None, child_seconds=0.0):
+    phase = self.phases.get(name)
+    if phase is None:
+      phase = self.phases[name] = Phase(name)
+    phase.calls += 1
+    phase.seconds += seconds
+    phase.child_seconds += child_seconds
+    if rows is not None:
+      phase.rows = (phase.rows or 0) + rows
+    self._charge(seconds)
+
+  def _charge(self, seconds):
+    if self._stack:
+      self._stack[-1].child_seconds += seconds
+
+  def timed_iter(self, name, it):
+    rows = 0
+    seconds = 0.0
+    it = iter(it)
+    try:
+      while True:
+        t0 = clock()
+        try:
+          x = next(it)
+        except StopIteration:
+          break
+        finally:
+          dt = clock() - t0
+          seconds += dt
+          self._charge(dt)
+        rows += 1
+        yield x
+    finally:
+      # already charged to whoever was pulling the rows
+      phase = self.phases.get(name)
+      if phase is None:
+        phase = self.phases[name] = Phase(name)
+      phase.calls += 1
+      phase.seconds += seconds
+      phase.rows = (phase.rows or 0) + rows
+
+  def report(self):
+    """a dict per phase, in the order they first finished, then the total"""
+    out = [p.as_dict() for p in self.phases.values()]
+    out.append(OrderedDict([('phase', 'total'), ('seconds', round(clock() - self.started, 6))]))
+    return out
+
+
+def enable():
+  global _profile
+  _profile = Profile()
+  return _profile
+
+
+def disable():
+  global _profile
+  profile, _profile = _profile, None
+  return profile
+
+
+def span(name):
+  """a context manager that times what's inside it as part of phase name. set
+  its rows attribute to the number of rows it handled"""
+  if _profile is None:
+    return _NULL_SPAN
+  return _Span(_profile, name)
+
+
+def timed_iter(name, it):
+  """it, with the time spent getting each item out of it counted towards
+  phase name"""
+  if _profile is None:
+    return it
+  return _profile.timed_iter(name, it)
+
+
+def emit(profile, logger=log):
+  import json
+  for d in profile.report():
+    logger.info(json.dumps(d))
+
+
+def trace_sql(on=True):
+  global _trace_sql
+  _trace_sql = on
+
+
+def tracing_sql():
+  return _trace_sql
+
+
+def _squash(sql):
+  return ' '.join(sql.split())
+
+
+def _traced(sql, fn, *a):
+  t0 = clock()
+  try:
+    return fn(*a)
+  finally:
+    sql_log.info("%9.3fms %s", (clock() - t0) * 1000, _squash(sql))
+
+
+class _Counted(object):
+  """an iterator that counts what comes out of it, for executemany"""
+
+  def __init__(self, it):
+    self.it = iter(it)
+    self.n = 0
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    x = next(self.it)
+    self.n += 1
+    return x
+
+  next = __next__
+
+
+class TracingCursor(sqlite3.Cursor):
+  def execute(self, sql, *a):
+    return _traced(sql, super(TracingCursor, self).execute, sql, *a)
+
+  def executemany(self, sql, rows):
+    rows = _Counted(rows)
+    t0 = clock()
+    try:
+      return super(TracingCursor, self).executemany(sql, rows)
+    finally:
+      sql_log.info("%9.3fms %s (x%d)", (clock() - t0) * 1000, _squash(sql), rows.n)
+
+  def executescript(self, sql):
+    return _traced(sql, super(TracingCursor, self).executescript, sql)
+
+
+class TracingConnection(sqlite3.Connection):
+  """logs every statement run through it, see trace_sql()"""
+
+  def cursor(self, factory=TracingCursor):
+    return super(TracingConnection, self).cursor(factory)
+
+  # the C versions of these don't go through cursor()
+  def execute(self, sql, *a):
+    return self.cursor().execute(sql, *a)
+
+  def executemany(self, sql, rows):
+    return self.cursor().executemany(sql, rows)
+
+  def executescript(self, sql):
+    return self.cursor().executescript(sql)
+
+  def commit(self):
+    if not self.in_transaction:
+      return super(TracingConnection, self).commit()
+    return _traced('COMMIT', super(TracingConnection, self).commit)
+
+  def __exit__(self, *exc):
+    if not self.in_transaction:
+      return super(TracingConnection, self).__exit__(*exc)
+    what = 'COMMIT' if exc[0] is None else 'ROLLBACK'
+    return _traced(what, super(TracingConnection, self).__exit__, *exc)
@@ -0,0 +1,180 @@
+"""`schist maintain`: keeping the db file small and the planner's stats fresh
+
+- auto_vacuum. a db has to be rebuilt (VACUUM) once to switch to incremental
+  auto_vacuum, after that incremental_vacuum() hands free pages (e.g. from
+  `schist archive`) back to the filesystem a few at a time, without rewriting
+  the whole file.
+- ANALYZE, for the tables whose row counts have drifted since they were last
+  analyzed, going by sqlite_stat1.
+- a report of where the space went.
+
+VACUUM is allowed to renumber the rowids of tables without an INTEGER PRIMARY
+KEY, which would throw off the rollups' (and the usage table's and archive's)
+watermarks and the plain layout's search indexes. sqlite doesn't do it in
+practice, but enable_incremental() checks, and fixes things up if it did.
+"""
+
+from __future__ import print_function
+
+import logging
+import sqlite3
+
+from .common import _set_watermark
+
+
+log = logging.getLogger(__name__)
+
+AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+INCREMENTAL = 2
+
+# the number of pages incremental_vacuum() frees per run, by default
+PAGE_BUDGET = 2048
+
+# ANALYZE a table when its row count is this far off what sqlite_stat1 says
+DRIFT = 0.2
+
+# the derived tables that keep a watermark on a history table's rowids
+_WATERMARKED = ('{0}_rollups', '{0}_usage', '{0}_archive')
+
+
+def _pragma(conn, name):
+  return conn.execute("PRAGMA {0}".format(name)).fetchone()[0]
+
+
+def auto_vacuum(conn):
+  return _pragma(conn, 'auto_vacuum')
+
+
+def _rowids(conn, table):
+  return tuple(conn.execute(
+    "SELECT count(*), sum(rowid), max(rowid) FROM {0}".format(table)).fetchone())
+
+
+def enable_incremental(hists):
+  """switch the db hists are open on to incremental auto_vacuum, which means a
+  VACUUM of the whole thing. returns False if it already was"""
+  conn = hists[0].conn
+  if auto_vacuum(conn) == INCREMENTAL:
+    return False
+
+  # with the watermarks all at the last rowid, there's nothing to lose if they
+  # have to be moved
+  for hist in hists:
+    hist.update_rollups()
+  before = [_rowids(conn, h.table_name) for h in hists]
+
+  conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+  conn.execute("VACUUM")
+
+  for hist, rowids in zip(hists, before):
+    if _rowids(conn, hist.table_name) != rowids:
+      log.warning("VACUUM renumbered %s, resetting what depends on its rowids", hist.table_name)
+      renumbered(hist)
+  return True
+
+
+def renumbered(hist):
+  """bring the things that refer to hist's rowids back in line with them after
+  they've changed underneath, as long as they were up to date before"""
+  conn = hist.conn
+  with conn:
+    last = conn.execute(
+      "SELECT coalesce(max(rowid), 0) FROM {0}".format(hist.table_name)).fetchone()[0]
+    for name in _WATERMARKED:
+      _set_watermark(conn, name.format(hist.table_name), last)
+
+  # the interned layout's indexes are on the commands table, whose ids are an
+  # INTEGER PRIMARY KEY and stay put
+  if not hist.is_interned():
+    if hist.fts_exists():
+      hist.build_fts()
+    if hist.trigram_exists():
+      hist.build_trigram()
+
+
+def incremental_vacuum(conn, pages=PAGE_BUDGET):
+  """give up to pages free pages back to the filesystem (all of them if pages
+  is 0), returns how many were freed. does nothing unless auto_vacuum is
+  incremental"""
+  free = _pragma(conn, 'freelist_count')
+  # it frees a page per step, and execute() only steps it once. executescript()
+  # runs it to the end
+  conn.executescript("PRAGMA incremental_vacuum({0:d});".format(pages))
+  return free - _pragma(conn, 'freelist_count')
+
+
+def _tables(conn):
+  return [r[0] for r in conn.execute("""\
+      SELECT name FROM sqlite_master
+        WHERE type = 'table' AND name NOT LIKE 'sqlite_%'
+          AND sql NOT LIKE 'CREATE VIRTUAL TABLE%'
+        ORDER BY name
+    """)]
+
+
+def _analyzed_counts(conn):
+  """table -> the row count ANALYZE recorded for it"""
+  try:
+    rows = conn.execute("SELECT tbl, stat FROM sqlite_stat1").fetchall()
+  except sqlite3.OperationalError:
+    # never analyzed
+    return {}
+
+  counts = {}
+  for tbl, stat in rows:
+    n = int(stat.split()[0]) if stat else 0
+    counts[tbl] = max(counts.get(tbl, 0), n)
+  return counts
+
+
+def drifted(conn, drift=DRIFT):
+  """(table, rows now, rows when last analyzed or None) for the tables that
+  need analyzing"""
+  then = _analyzed_counts(conn)
+  found = []
+  for table in _tables(conn):
+    now = conn.execute("SELECT count(*) FROM {0}".format(table)).fetchone()[0]
+    old = then.get(table)
+    if old is None:
+      # an empty table that's never been analyzed has nothing to tell us
+      if now:
+        found.append((table, now, None))
+    elif abs(now - old) > drift * max(old, 1):
+      found.append((table, now, old))
+  return found
+
+
+def analyze(conn, drift=DRIFT):
+  """ANALYZE the tables whose row counts drifted, returns what drifted() said"""
+  found = drifted(conn, drift)
+  with conn:
+    for table, now, old in found:
+      log.debug("analyzing %s, %d rows (was %s)", table, now, old)
+      conn.execute("ANALYZE {0}".format(table))
+  return found
+
+
+def dbstat_available(conn):
+  try:
+    conn.execute("SELECT 1 FROM dbstat LIMIT 1").fetchall()
+    return True
+  except sqlite3.OperationalError:
+    return False
+
+
+def space(conn):
+  """a dict of page_size, pages, free_pages and auto_vacuum, and with sqlite's
+  dbstat table, sizes: (table or index, bytes) biggest first"""
+  report = {
+    'page_size': _pragma(conn, 'page_size'),
+    'pages': _pragma(conn, 'page_count'),
+    'free_pages': _pragma(conn, 'freelist_count'),
+    'auto_vacuum': AUTO_VACUUM_MODES.get(auto_vacuum(conn), auto_vacuum(conn)),
+    'sizes': None,
+  }
+  if dbstat_available(conn):
+    report['sizes'] = [tuple(r) for r in conn.execute("""\
+        SELECT name, sum(pgsize) FROM dbstat GROUP BY name ORDER BY sum(pgsize) DESC, name
+      """)]
+  return report
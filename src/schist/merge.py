@@ -0,0 +1,219 @@
+"""merge the history from other schist databases into this one
+
+each source db is ATTACHed and copied over with a handful of INSERT OR IGNORE
+... SELECT statements per table, so rows never pass through python and merging
+the same db twice doesn't add anything the second time. either side can use the
+plain or the interned layout.
+
+optionally the history table gets a host column, recording which db each row
+came from: the source's own host column if it has one, otherwise the source
+file's name without its extension. elapsed times come along where both sides
+have the column.
+
+the rows in the source's archive (see archive) come along too. they go into
+the history table like any other merged row, apart from the ones already in
+this db's archive, and wait there for the next `schist archive`.
+"""
+
+from __future__ import print_function
+
+import logging
+import os.path
+
+from . import archive
+
+
+log = logging.getLogger(__name__)
+
+SRC = 'schist_merge_src'
+
+# a temp table for the rows from the source's archive
+ARCHIVED = 'schist_merge_archived'
+
+
+class MergeError(Exception):
+  pass
+
+
+def host_label(path):
+  """the host name we record for rows merged from path, e.g. 'laptop' for
+  'backups/laptop.sq3'"""
+  return os.path.splitext(os.path.basename(path))[0]
+
+
+def _has_table(conn, schema, name):
+  q = "SELECT name FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?".format(
+    schema=schema)
+  return conn.execute(q, (name,)).fetchone() is not None
+
+
+def _has_column(conn, schema, table, column):
+  return any(
+    r[1] == column
+    for r in conn.execute("PRAGMA {schema}.table_info({table})".format(schema=schema, table=table)))
+
+
+def _plain_to_interned(conn, fmt, params):
+  # hash each distinct command once, rather than once per row
+  conn.execute("""\
+      CREATE TEMP TABLE IF NOT EXISTS schist_merge_ids (
+        command text NOT NULL PRIMARY KEY,
+        id INTEGER NOT NULL
+      ) WITHOUT ROWID
+    """)
+  conn.execute("DELETE FROM temp.schist_merge_ids")
+
+  conn.execute("""\
+      INSERT OR IGNORE INTO main.{commands} (hash, command)
+        SELECT schist_hash(command), command FROM (
+          SELECT command, min(rowid) AS first FROM {src_table} GROUP BY command
+        ) ORDER BY first
+    """.format(**fmt))
+
+  conn.execute("""\
+      INSERT INTO temp.schist_merge_ids (command, id)
+        SELECT d.command, m.id FROM (SELECT DISTINCT command FROM {src_table}) d
+          JOIN main.{commands} m ON m.hash = schist_hash(d.command) AND m.command = d.command
+    """.format(**fmt))
+
+  added = conn.execute("""\
+      INSERT OR IGNORE INTO main.{table} (timestamp, command_id{host_col}{elapsed_col})
+        SELECT h.timestamp, i.id{host_val}{elapsed_val} FROM {src_table} h
+          JOIN temp.schist_merge_ids i ON i.command = h.command
+          ORDER BY h.rowid
+    """.format(**fmt), params).rowcount
+
+  conn.execute("DELETE FROM temp.schist_merge_ids")
+  return added
+
+
+def _interned_to_interned(conn, fmt, params):
+  conn.execute("""\
+      INSERT OR IGNORE INTO main.{commands} (hash, command)
+        SELECT hash, command FROM {src}.{commands} ORDER BY id
+    """.format(**fmt))
+
+  return conn.execute("""\
+      INSERT OR IGNORE INTO main.{table} (timestamp, command_id{host_col}{elapsed_col})
+        SELECT h.timestamp, m.id{host_val}{elapsed_val} FROM {src_table} h
+          JOIN {src}.{commands} c ON c.id = h.command_id
+          JOIN main.{commands} m ON m.hash = c.hash AND m.command = c.command
+          ORDER BY h.rowid
+    """.format(**fmt), params).rowcount
+
+
+def _to_plain(conn, fmt, params, src_interned):
+  if src_interned:
+    source = "{src_table} h JOIN {src}.{commands} c ON c.id = h.command_id".format(**fmt)
+    command = 'c.command'
+  else:
+    source = "{src_table} h".format(**fmt)
+    command = 'h.command'
+
+  return conn.execute("""\
+      INSERT OR IGNORE INTO main.{table} (timestamp, command{host_col}{elapsed_col})
+        SELECT h.timestamp, {command}{host_val}{elapsed_val} FROM {source}
+          ORDER BY h.rowid
+    """.format(source=source, command=command, **fmt), params).rowcount
+
+
+def _copy(conn, fmt, params, src_interned, dest_interned):
+  if not dest_interned:
+    return _to_plain(conn, fmt, params, src_interned)
+  elif src_interned:
+    return _interned_to_interned(conn, fmt, params)
+  else:
+    return _plain_to_interned(conn, fmt, params)
+
+
+def _load_archived(conn, table):
+  """copy the rows in the source's archive blocks that aren't in ours into
+  temp.ARCHIVED, returns False if the source has no archive"""
+  name = archive.archive_table(table)
+  if not _has_table(conn, SRC, name):
+    return False
+
+  conn.execute("""\
+      CREATE TEMP TABLE IF NOT EXISTS {archived} (
+        timestamp BIGINT NOT NULL,
+        command text NOT NULL,
+        elapsed INTEGER,
+        host text
+      )
+    """.format(archived=ARCHIVED))
+
+  ours = archive.exists(conn, table)
+  blocks = conn.execute(
+    "SELECT start, data FROM {src}.{name} ORDER BY start".format(src=SRC, name=name)).fetchall()
+  for start, data in blocks:
+    have = set((r[0], r[1]) for r in archive.read(conn, table, start)) if ours else set()
+    conn.executemany(
+      "INSERT INTO temp.{archived} (timestamp, command, elapsed, host) VALUES (?, ?, ?, ?)".format(
+        archived=ARCHIVED),
+      (r for r in archive.decode(data) if (r[0], r[1]) not in have))
+  return True
+
+
+def merge(hist, path, record_host=False):
+  """copy the rows for hist's table from the db at path into hist's db, returns
+  the number of rows that were new. raises MergeError if there's no db to read
+  at path"""
+  conn = hist.conn
+
+  # ATTACH would quietly create an empty db there
+  if not os.path.isfile(path) or not os.access(path, os.R_OK):
+    raise MergeError("can't read {0}".format(path))
+
+  if hist.db_path != ':memory:' and os.path.exists(hist.db_path) and \
+      os.path.samefile(path, hist.db_path):
+    log.warning("not merging %s into itself", path)
+    return 0
+
+  if record_host:
+    hist.add_host_column()
+
+  dest_interned = hist.is_interned()
+  dest_host = hist.has_host_column()
+  dest_elapsed = hist.has_elapsed_column()
+
+  conn.execute("ATTACH DATABASE ? AS {src}".format(src=SRC), (path,))
+  try:
+    if not _has_table(conn, SRC, hist.table_name):
+      log.info("%s has no %s table, skipping it", path, hist.table_name)
+      return 0
+
+    src_interned = _has_table(conn, SRC, hist.commands_table)
+    src_host = _has_column(conn, SRC, hist.table_name, 'host')
+    src_elapsed = _has_column(conn, SRC, hist.table_name, 'elapsed')
+
+    def fmt(src_table, src_host, src_elapsed):
+      if dest_host:
+        host_val = ', coalesce(h.host, :host)' if src_host else ', :host'
+      else:
+        host_val = ''
+      return {
+        'src': SRC,
+        'src_table': src_table,
+        'table': hist.table_name,
+        'commands': hist.commands_table,
+        'host_col': ', host' if dest_host else '',
+        'host_val': host_val,
+        'elapsed_col': ', elapsed' if dest_elapsed else '',
+        'elapsed_val': (', h.elapsed' if src_elapsed else ', NULL') if dest_elapsed else '',
+      }
+    params = {'host': host_label(path) if record_host else None}
+
+    with conn:
+      added = 0
+      # the archived rows are the oldest, so they go in first
+      if _load_archived(conn, hist.table_name):
+        added += _copy(
+          conn, fmt('temp.' + ARCHIVED, True, True), params, False, dest_interned)
+        conn.execute("DELETE FROM temp.{0}".format(ARCHIVED))
+      added += _copy(
+        conn, fmt('{0}.{1}'.format(SRC, hist.table_name), src_host, src_elapsed), params,
+        src_interned, dest_interned)
+  finally:
+    conn.execute("DETACH DATABASE {src}".format(src=SRC))
+
+  return added
@@ -0,0 +1,261 @@
+"""parse histfiles in parallel
+
+parsing is the expensive part of a backup, so it's spread over a pool of worker
+processes, in one of two ways:
+
+  * backup() does lots of histfiles at once, one histfile per task. workers
+    never touch the db: they send their rows back over a queue in batches, and
+    the parent process, the only writer, inserts them as they come in. that
+    keeps every core busy without anyone waiting on sqlite's write lock.
+
+    each histfile's checkpoint is worked out up front and only written once all
+    of its rows are in, so an interrupted run just parses a bit more next time.
+
+  * parse_chunked() does one big histfile, split into byte ranges that each
+    start at the beginning of a record (a line matching the shell's
+    record_start regex), so every chunk parses exactly as it would have as part
+    of the whole file. the chunks' rows come back in file order.
+"""
+
+from __future__ import print_function
+
+import itertools
+import logging
+import multiprocessing
+import os.path
+
+from collections import deque
+
+from six.moves import queue
+
+from .common import _iter_range
+
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 10000
+
+# roughly how many bytes of a histfile parse_chunked() gives each task
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# how many lines from the top of a file detect() tries to parse
+_DETECT_LINES = 64
+
+# set in each worker by _init_worker
+_queue = None
+
+
+class _Failed(object):
+  """sent in place of a batch when a worker couldn't parse a file"""
+
+  def __init__(self, error):
+    self.error = error
+
+
+def detect(path, hists):
+  """the first of hists whose history_iter_fn makes sense of the start of the
+  file at path, or None"""
+  with open(path, 'rb') as fp:
+    head = list(itertools.islice(fp, _DETECT_LINES))
+
+  for hist in hists:
+    if next(iter(hist.history_iter_fn(iter(head))), None) is not None:
+      return hist
+  return None
+
+
+def _init_worker(q):
+  global _queue
+  _queue = q
+
+
+def _parse(job):
+  i, path, history_iter_fn, range_iter_fn, offset, end, batch_size = job
+  try:
+    with open(path, 'rb') as fp:
+      rows = iter(_iter_range(fp, offset, end, history_iter_fn, range_iter_fn))
+      while True:
+        batch = [tuple(r) for r in itertools.islice(rows, batch_size)]
+        if not batch:
+          break
+        _queue.put((i, batch))
+  except Exception as e:
+    _queue.put((i, _Failed('{0}: {1}'.format(type(e).__name__, e))))
+  _queue.put((i, None))
+
+
+def _plan(hists, full):
+  """(index, hist, offset, end, checkpoint) for each of hists that has something
+  new to parse"""
+  for i, hist in enumerate(hists):
+    if not os.path.exists(hist.histfile):
+      log.info("%s doesn't exist, skipping it", hist.histfile)
+      continue
+    with hist.open_histfile() as fp:
+      pending = hist.pending(fp, full=full)
+    if pending is not None:
+      yield (i, hist) + pending
+
+
+def backup(hists, full=False, processes=None, batch_size=BATCH_SIZE):
+  """insert() each of hists, all of which have to share one open connection,
+  parsing their histfiles in up to processes worker processes (the number of
+  cpus by default). returns the number of new rows for each of hists.
+  """
+  added = [0] * len(hists)
+  if not hists:
+    return added
+
+  conn = hists[0].conn
+  with conn:
+    hists[0].create_checkpoint_table()
+
+  work = list(_plan(hists, full))
+  per_file = min(processes or multiprocessing.cpu_count(), len(work))
+
+  if per_file > 1:
+    _backup_parallel(work, added, per_file, batch_size)
+  else:
+    # zero or one files, which can still be split up if it's big
+    for i, hist, offset, end, cp in work:
+      with conn:
+        with hist.open_histfile() as fp:
+          added[i] = hist.insert_rows(hist.parse_range(fp, offset, end, processes=processes))
+        hist.write_checkpoint(cp)
+
+  updated = set()
+  for i, hist, _, _, _ in work:
+    if hist.table_name not in updated:
+      hist.update_rollups()
+      updated.add(hist.table_name)
+
+  return added
+
+
+def _backup_parallel(work, added, processes, batch_size):
+  conn = work[0][1].conn
+  hists = dict((i, hist) for i, hist, _, _, _ in work)
+  checkpoints = dict((i, cp) for i, _, _, _, cp in work)
+
+  # bounded, so workers wait for the writer rather than piling rows up in memory
+  q = multiprocessing.Queue(maxsize=processes * 4)
+  pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(q,))
+  try:
+    result = pool.map_async(
+      _parse,
+      [(i, hist.histfile, hist.history_iter_fn, hist.range_iter_fn, offset, end, batch_size)
+        for i, hist, offset, end, _ in work],
+      chunksize=1)
+
+    remaining = len(work)
+    while remaining:
+      try:
+        i, msg = q.get(timeout=1)
+      except queue.Empty:
+        if result.ready() and not result.successful():
+          result.get()
+        continue
+
+      if msg is None:
+        remaining -= 1
+        if i in checkpoints:
+          with conn:
+            hists[i].write_checkpoint(checkpoints.pop(i))
+      elif isinstance(msg, _Failed):
+        log.error("couldn't parse %s: %s", hists[i].histfile, msg.error)
+        checkpoints.pop(i, None)
+      else:
+        with conn:
+          added[i] += hists[i].insert_rows(msg)
+
+    pool.close()
+  except BaseException:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+
+def _boundary(fp, pos, end, record_start):
+  """the offset of the first record that starts at or after pos, or end. a
+  line that follows one ending in a backslash is part of the same (zsh)
+  entry, even if it looks like the start of a record"""
+  # back up one byte, so we don't skip a whole line when pos is already at
+  # the start of one
+  fp.seek(pos - 1)
+  prev = fp.readline()
+  # pos is at the start of a line, so look at how the one before it ended
+  if prev == b'\n' and pos >= 2:
+    fp.seek(pos - 2)
+    prev = fp.read(2)
+  while True:
+    at = fp.tell()
+    if at >= end:
+      return end
+    line = fp.readline()
+    if not line:
+      return end
+    if record_start.match(line) and not prev.endswith(b'\\\n'):
+      return at
+    prev = line
+
+
+def split(fp, start, end, record_start, chunk_size=CHUNK_SIZE):
+  """(start, end) byte ranges of about chunk_size that cover start to end of
+  the binary file fp, each starting with a line that matches record_start"""
+  bounds = [start]
+  pos = start + chunk_size
+  while pos < end:
+    b = _boundary(fp, pos, end, record_start)
+    bounds.append(b)
+    pos = b + chunk_size
+  if bounds[-1] < end:
+    bounds.append(end)
+  return list(zip(bounds, bounds[1:]))
+
+
+def _parse_chunk(job):
+  path, history_iter_fn, range_iter_fn, start, end = job
+  with open(path, 'rb') as fp:
+    return [tuple(r) for r in _iter_range(fp, start, end, history_iter_fn, range_iter_fn)]
+
+
+def parse_chunked(path, history_iter_fn, record_start, start=0, end=None, processes=None,
+    chunk_size=CHUNK_SIZE, range_iter_fn=None):
+  """yields the same (timestamp, command) tuples history_iter_fn would for the
+  bytes from start to end of the file at path, parsing chunks of it in up to
+  processes worker processes (the number of cpus by default). range_iter_fn
+  is used instead, if given, see HistConfig.
+  """
+  if end is None:
+    end = os.path.getsize(path)
+
+  with open(path, 'rb') as fp:
+    chunks = split(fp, start, end, record_start, chunk_size)
+  processes = min(processes or multiprocessing.cpu_count(), len(chunks))
+
+  if processes <= 1:
+    with open(path, 'rb') as fp:
+      for r in _iter_range(fp, start, end, history_iter_fn, range_iter_fn):
+        yield tuple(r)
+    return
+
+  jobs = iter([(path, history_iter_fn, range_iter_fn, s, e) for s, e in chunks])
+  pool = multiprocessing.Pool(processes)
+  try:
+    # only keep a couple of chunks per worker in flight, so a slow consumer
+    # doesn't end up with the whole file's rows in memory
+    pending = deque(
+      pool.apply_async(_parse_chunk, (job,)) for job in itertools.islice(jobs, processes * 2))
+    while pending:
+      rows = pending.popleft().get()
+      for job in itertools.islice(jobs, 1):
+        pending.append(pool.apply_async(_parse_chunk, (job,)))
+      for r in rows:
+        yield r
+    pool.close()
+  except BaseException:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
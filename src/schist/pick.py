@@ -0,0 +1,350 @@
+"""`schist pick`, an interactive fuzzy picker for a ctrl-r key binding
+
+the distinct commands are loaded once, most recently run first, and everything
+after that happens in memory. a command matches if the query's characters all
+appear in it, in order (ignoring case unless the query has capitals in it). the
+matches are ranked by score(), lower is better, with ties going to the more
+recently run command.
+
+each time the query gets longer, only the commands that matched the shorter
+query are looked at again, since nothing else can match. the earlier match sets
+are kept on a stack, so backspacing is free.
+
+the picker is drawn on /dev/tty, and the chosen command goes to stdout, which
+is what a zle or readline widget wants.
+"""
+
+from __future__ import print_function
+
+import codecs
+import heapq
+import os
+import re
+
+from contextlib import contextmanager
+
+
+# a match costs one for every character it skips over, plus this much
+# depending on where it starts
+START_OF_COMMAND = 0
+START_OF_WORD = 1
+MID_WORD = 3
+
+_WORD_SEPARATORS = frozenset(u' \t\n/\\-_.,:;=|&()[]{}<>\'"`$@')
+
+
+def _ignore_case(query):
+  return query == query.lower()
+
+
+def _pattern(query):
+  """matches the characters of query in order, anywhere, as tightly as a
+  non-greedy search can"""
+  return re.compile(u'.*?'.join(re.escape(c) for c in query), re.DOTALL)
+
+
+def score(query, command):
+  """how well command matches query, lower is better, or None if it doesn't"""
+  if _ignore_case(query):
+    command = command.lower()
+  return _score(query, command, _pattern(query).search)
+
+
+def _score(query, text, search):
+  m = search(text)
+  if m is None:
+    return None
+
+  # the regex finds the earliest match, a substring further along is tighter
+  start = text.find(query, m.start())
+  if start >= 0:
+    gaps = 0
+  else:
+    start = m.start()
+    gaps = m.end() - start - len(query)
+
+  if start == 0:
+    return gaps + START_OF_COMMAND
+  elif text[start - 1] in _WORD_SEPARATORS:
+    return gaps + START_OF_WORD
+  else:
+    return gaps + MID_WORD
+
+
+class Picker(object):
+  """the state of a pick: the query, what it matches and which one's selected.
+  commands should be most recent first"""
+
+  def __init__(self, commands, limit=15):
+    self.commands = commands
+    self.limit = limit
+    self.selected = 0
+    self._folded = None
+    # (query, [(score, index), ...]) for the query and each prefix of it we've
+    # filtered by, shortest first
+    self._stack = [(u'', [(0, i) for i in range(len(commands))])]
+    self._results = None
+
+  @property
+  def query(self):
+    return self._stack[-1][0]
+
+  def _texts(self, query):
+    if not _ignore_case(query):
+      return self.commands
+    if self._folded is None:
+      self._folded = [c.lower() for c in self.commands]
+    return self._folded
+
+  def _filter(self, query, matches):
+    # _score(), inlined, this is the loop that runs on every keystroke
+    texts = self._texts(query)
+    search = _pattern(query).search
+    n = len(query)
+    separators = _WORD_SEPARATORS
+    out = []
+    append = out.append
+    for _, i in matches:
+      text = texts[i]
+      m = search(text)
+      if m is None:
+        continue
+      start = text.find(query, m.start())
+      if start >= 0:
+        gaps = 0
+      else:
+        start = m.start()
+        gaps = m.end() - start - n
+      if start == 0:
+        append((gaps + START_OF_COMMAND, i))
+      elif text[start - 1] in separators:
+        append((gaps + START_OF_WORD, i))
+      else:
+        append((gaps + MID_WORD, i))
+    return out
+
+  def set_query(self, query):
+    stack = self._stack
+    while len(stack) > 1 and not query.startswith(stack[-1][0]):
+      stack.pop()
+    if query != stack[-1][0]:
+      stack.append((query, self._filter(query, stack[-1][1])))
+    self._results = None
+    self.selected = 0
+
+  def type(self, text):
+    self.set_query(self.query + text)
+
+  def backspace(self):
+    self.set_query(self.query[:-1])
+
+  def delete_word(self):
+    self.set_query(re.sub(u'\\S*\\s*$', u'', self.query, flags=re.UNICODE))
+
+  def clear(self):
+    self.set_query(u'')
+
+  def count(self):
+    """how many commands match the query"""
+    return len(self._stack[-1][1])
+
+  def results(self):
+    """the best limit matches, best first"""
+    if self._results is None:
+      matches = self._stack[-1][1]
+      if len(self._stack) == 1:
+        # everything scores 0 against an empty query
+        best = matches[:self.limit]
+      else:
+        best = heapq.nsmallest(self.limit, matches)
+      self._results = [self.commands[i] for _, i in best]
+    return self._results
+
+  def move(self, n):
+    self.selected = max(0, min(self.selected + n, len(self.results()) - 1))
+
+  def choice(self):
+    results = self.results()
+    return results[self.selected] if results else None
+
+
+# control characters -> (Picker method, args)
+_CONTROL = {
+  u'\x7f': ('backspace', ()),
+  u'\x08': ('backspace', ()),
+  u'\x15': ('clear', ()),  # ctrl-u
+  u'\x17': ('delete_word', ()),  # ctrl-w
+  u'\x10': ('move', (-1,)),  # ctrl-p
+  u'\x0e': ('move', (1,)),  # ctrl-n
+  u'\x12': ('move', (1,)),  # ctrl-r, for older matches like the real one
+  u'\t': ('move', (1,)),
+  u'\r': ('accept', ()),
+  u'\n': ('accept', ()),
+  u'\x03': ('cancel', ()),  # ctrl-c
+  u'\x04': ('cancel', ()),  # ctrl-d
+  u'\x07': ('cancel', ()),  # ctrl-g
+}
+
+_ESCAPES = {
+  u'[A': ('move', (-1,)),
+  u'[B': ('move', (1,)),
+  u'OA': ('move', (-1,)),
+  u'OB': ('move', (1,)),
+}
+
+
+def keys(chunks):
+  """turns the text read from the terminal into (Picker method, args) pairs,
+  plus ('accept', ()) and ('cancel', ())"""
+  for chunk in chunks:
+    i = 0
+    while i < len(chunk):
+      c = chunk[i]
+      if c == u'\x1b':
+        seq = chunk[i + 1:i + 3]
+        if seq in _ESCAPES:
+          yield _ESCAPES[seq]
+          i += 3
+        elif seq[:1] == u'[':
+          # some other csi sequence (an arrow we don't use, a function key...)
+          i += 2
+          while i < len(chunk) and not u'@' <= chunk[i] <= u'~':
+            i += 1
+          i += 1
+        elif seq[:1] == u'O':
+          i += 3
+        else:
+          # escape on its own
+          yield ('cancel', ())
+          i += 1
+      elif c in _CONTROL:
+        yield _CONTROL[c]
+        i += 1
+      elif c < u' ':
+        i += 1
+      else:
+        # a run of ordinary characters, e.g. a paste
+        j = i + 1
+        while j < len(chunk) and chunk[j] >= u' ' and chunk[j] != u'\x7f':
+          j += 1
+        yield ('type', (chunk[i:j],))
+        i = j
+
+
+def run(picker, events, draw):
+  """feed events (from keys()) to picker, calling draw(picker) after each.
+  returns the chosen command, or None if the pick was cancelled"""
+  draw(picker)
+  for action, args in events:
+    if action == 'accept':
+      return picker.choice()
+    elif action == 'cancel':
+      return None
+    getattr(picker, action)(*args)
+    draw(picker)
+  return None
+
+
+def _read(fd):
+  decoder = codecs.getincrementaldecoder('utf-8')('replace')
+  while True:
+    data = os.read(fd, 1024)
+    if not data:
+      return
+    text = decoder.decode(data)
+    if text:
+      yield text
+
+
+def _term_size(fd):
+  """(rows, columns) of the terminal on fd"""
+  try:
+    import fcntl
+    import struct
+    import termios
+    rows, cols = struct.unpack('hh', fcntl.ioctl(fd, termios.TIOCGWINSZ, b'\0' * 4))
+  except (ImportError, IOError, OSError):
+    rows = cols = 0
+  return rows or 24, cols or 80
+
+
+@contextmanager
+def _raw_tty():
+  import termios
+  import tty
+  fd = os.open('/dev/tty', os.O_RDWR)
+  try:
+    old = termios.tcgetattr(fd)
+    tty.setraw(fd)
+    try:
+      yield fd
+    finally:
+      termios.tcsetattr(fd, termios.TCSADRAIN, old)
+  finally:
+    os.close(fd)
+
+
+PROMPT = u'> '
+
+
+def _one_line(command, width):
+  command = command.replace(u'\n', u'\u21b5')
+  if len(command) > width:
+    command = command[:width - 1] + u'\u2026'
+  return command
+
+
+class Screen(object):
+  """draws a picker under the cursor: the prompt line, then a line per result"""
+
+  def __init__(self, fd, height, width):
+    self.fd = fd
+    self.height = height
+    self.width = width
+    # make room first, so the terminal scrolling doesn't move the prompt line
+    self._write(u'\n' * height + u'\x1b[{0}A'.format(height) if height else u'')
+
+  def _write(self, s):
+    os.write(self.fd, s.encode('utf-8'))
+
+  def draw(self, picker):
+    results = picker.results()
+    prompt = PROMPT + picker.query
+    out = [u'\r\x1b[J', _one_line(prompt, self.width)]
+    count = u'  {0}/{1}'.format(picker.count(), len(picker.commands))
+    if len(prompt) + len(count) < self.width:
+      out.append(u'\x1b[2m{0}\x1b[0m'.format(count))
+
+    for n, command in enumerate(results[:self.height]):
+      line = _one_line(command, self.width - 2)
+      if n == picker.selected:
+        out.append(u'\r\n\x1b[7m> {0}\x1b[0m'.format(line))
+      else:
+        out.append(u'\r\n  {0}'.format(line))
+
+    # back to the end of the query
+    shown = min(len(results), self.height)
+    if shown:
+      out.append(u'\x1b[{0}A'.format(shown))
+    out.append(u'\r')
+    col = min(len(prompt), self.width - 1)
+    if col:
+      out.append(u'\x1b[{0}C'.format(col))
+    self._write(u''.join(out))
+
+  def clear(self):
+    self._write(u'\r\x1b[J')
+
+
+def interactive(commands, query=u'', height=15):
+  """run the picker on the terminal, returns the chosen command or None"""
+  with _raw_tty() as fd:
+    rows, cols = _term_size(fd)
+    height = max(0, min(height, rows - 1))
+    picker = Picker(commands, limit=max(height, 1))
+    picker.set_query(query)
+    screen = Screen(fd, height, cols)
+    try:
+      return run(picker, keys(_read(fd)), screen.draw)
+    finally:
+      screen.clear()
@@ -0,0 +1,177 @@
+"""per-hour and per-day command counts, so stats don't have to scan the table
+
+{table}_rollups holds a count for every (period, start) bucket that has any
+commands in it, with start being the bucket's first second in unix time (UTC).
+update() folds in only the rows added since it last ran, tracked by rowid.
+
+counts for an arbitrary range are put together from whole day buckets, whole
+hour buckets at either end of those, and a scan of the history table for the
+partial hours at the very ends. that's a bounded amount of work however big the
+table gets.
+"""
+
+from __future__ import print_function
+
+import datetime
+import logging
+
+from collections import OrderedDict
+
+from .common import _watermark, _set_watermark
+
+
+log = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 86400
+
+_PERIODS = (('hour', HOUR), ('day', DAY))
+
+# stands in for "no upper bound"
+_END_OF_TIME = 1 << 62
+
+HISTOGRAM_UNITS = ('day', 'week', 'month')
+
+
+def rollup_table(table):
+  return '{0}_rollups'.format(table)
+
+
+def create(conn, table):
+  conn.execute("""\
+      CREATE TABLE IF NOT EXISTS {rollups} (
+        period text NOT NULL,
+        start BIGINT NOT NULL,
+        count BIGINT NOT NULL,
+        PRIMARY KEY (period, start)
+      ) WITHOUT ROWID
+    """.format(rollups=rollup_table(table)))
+
+
+def update(conn, table):
+  """add the rows inserted since the last update to the rollups. run it in a
+  _write_transaction, or two of these at once can both count the same rows"""
+  create(conn, table)
+
+  rollups = rollup_table(table)
+  since = _watermark(conn, rollups)
+
+  last = conn.execute(
+      "SELECT max(rowid) FROM {table}".format(table=table)).fetchone()[0]
+
+  if last is None or last <= since:
+    return
+
+  for period, secs in _PERIODS:
+    counts = conn.execute("""\
+        SELECT timestamp - timestamp % :secs AS bucket, count(*) FROM {table}
+          WHERE rowid > :since AND rowid <= :last
+          GROUP BY bucket
+      """.format(table=table),
+      {'secs': secs, 'since': since, 'last': last}).fetchall()
+
+    # not an upsert (INSERT ... ON CONFLICT), that needs sqlite 3.24
+    conn.executemany(
+      "INSERT OR IGNORE INTO {rollups} (period, start, count) VALUES (?, ?, 0)".format(
+        rollups=rollups),
+      ((period, bucket) for bucket, _ in counts))
+    conn.executemany(
+      "UPDATE {rollups} SET count = count + ? WHERE period = ? AND start = ?".format(
+        rollups=rollups),
+      ((n, period, bucket) for bucket, n in counts))
+
+  _set_watermark(conn, rollups, last)
+
+
+def _floor(ts, secs):
+  return ts - ts % secs
+
+
+def _ceil(ts, secs):
+  return _floor(ts + secs - 1, secs)
+
+
+def _scan(conn, table, lo, hi):
+  if lo >= hi:
+    return 0
+  return conn.execute(
+      "SELECT count(*) FROM {table} WHERE timestamp >= :lo AND timestamp < :hi".format(
+        table=table),
+      {'lo': lo, 'hi': hi}
+    ).fetchone()[0]
+
+
+def _sum(conn, table, period, lo, hi):
+  if lo >= hi:
+    return 0
+  return conn.execute("""\
+      SELECT coalesce(sum(count), 0) FROM {rollups}
+        WHERE period = :period AND start >= :lo AND start < :hi
+    """.format(rollups=rollup_table(table)),
+    {'period': period, 'lo': lo, 'hi': hi}
+  ).fetchone()[0]
+
+
+def count_between(conn, table, lo, hi=None):
+  """the number of commands with lo <= timestamp < hi, as of the last update()"""
+  hi = _END_OF_TIME if hi is None else hi
+
+  h0, h1 = _ceil(lo, HOUR), _floor(hi, HOUR)
+  if h0 >= h1:
+    return _scan(conn, table, lo, hi)
+
+  d0, d1 = _ceil(h0, DAY), _floor(h1, DAY)
+  if d0 >= d1:
+    hours = _sum(conn, table, 'hour', h0, h1)
+  else:
+    hours = (
+      _sum(conn, table, 'hour', h0, d0) +
+      _sum(conn, table, 'day', d0, d1) +
+      _sum(conn, table, 'hour', d1, h1))
+
+  return _scan(conn, table, lo, h0) + hours + _scan(conn, table, h1, hi)
+
+
+def _bucket(d, unit):
+  if unit == 'day':
+    return d
+  elif unit == 'week':
+    return d - datetime.timedelta(days=d.weekday())
+  elif unit == 'month':
+    return d.replace(day=1)
+  else:
+    raise ValueError("unknown histogram unit {0!r}".format(unit))
+
+
+def _next_bucket(d, unit):
+  if unit == 'day':
+    return d + datetime.timedelta(days=1)
+  elif unit == 'week':
+    return d + datetime.timedelta(days=7)
+  else:
+    return (d.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
+def histogram(conn, table, lo, hi, unit='day'):
+  """returns an OrderedDict of local date -> number of commands, with a key
+  for every day, week (starting on monday) or month from lo up to hi"""
+  counts = OrderedDict()
+
+  d = _bucket(datetime.datetime.fromtimestamp(lo).date(), unit)
+  end = datetime.datetime.fromtimestamp(hi).date()
+  while d <= end:
+    counts[d] = 0
+    d = _next_bucket(d, unit)
+
+  q = """\
+    SELECT start, count FROM {rollups}
+      WHERE period = 'hour' AND start >= :lo AND start < :hi
+  """.format(rollups=rollup_table(table))
+
+  # local days don't line up with UTC ones, so this works off the hours
+  for start, n in conn.execute(q, {'lo': _floor(lo, HOUR), 'hi': hi}):
+    key = _bucket(datetime.datetime.fromtimestamp(start).date(), unit)
+    if key in counts:
+      counts[key] += n
+
+  return counts
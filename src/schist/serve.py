@@ -0,0 +1,258 @@
+"""`schist serve`, which answers queries over a unix socket
+
+autosuggest widgets want an answer on every keystroke, which is too often to
+start python, import schist and open the db each time. the server does all
+that once, keeps the connections open, and caches its answers until the db
+changes (PRAGMA data_version notices other connections' commits, and is cheap
+to check). stats aren't cached, since their windows move with the clock, and
+the rollups make them cheap anyway.
+
+the protocol is in client.py. the verbs are:
+
+  ping                                 no rows
+  search SHELL TERM [LIMIT [RANK]]     (timestamp, command) rows, TERM is a LIKE
+                                       pattern, RANK is recent or frecency as
+                                       for `schist search`, LIMIT defaults to 25
+  regex SHELL PATTERN [LIMIT [RANK]]   the same with a python regex
+  suggest SHELL PREFIX                 the most recently run command that starts
+                                       with PREFIX, if there is one
+  stats SHELL                          (name, count) rows for the commands run in
+                                       the past hour, day and week, and in total
+
+SHELL is zsh (or z) or bash (or b).
+"""
+
+from __future__ import print_function
+
+import errno
+import functools
+import logging
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from six.moves import socketserver
+
+from .client import DEFAULT_SOCKET, decode_line, encode_line
+from .common import _mk_conn
+
+
+log = logging.getLogger(__name__)
+
+# how many answers to keep
+CACHE_SIZE = 1024
+
+# the verbs whose answers depend on the time as well as the db, so they're
+# never cached
+_UNCACHED = ('stats',)
+
+# the longest request line we'll read
+MAX_REQUEST = 64 * 1024
+
+_SHELLS = {'z': 'zsh', 'b': 'bash'}
+
+
+class RequestError(Exception):
+  pass
+
+
+def _unpack(args, required, optional=()):
+  """args, padded with None for the optional ones that are missing"""
+  if not len(required) <= len(args) <= len(required) + len(optional):
+    raise RequestError('expected {0}'.format(
+      ' '.join(list(required) + ['[{0}]'.format(o) for o in optional])))
+  return list(args) + [None] * (len(required) + len(optional) - len(args))
+
+
+def _int(s, default):
+  if s is None:
+    return default
+  try:
+    return int(s)
+  except ValueError:
+    raise RequestError('not a number: {0}'.format(s))
+
+
+class Service(object):
+  """answers requests from a set of open HistConfigs, caching the answers.
+  safe to call from any thread, one request runs at a time"""
+
+  def __init__(self, hists, cache_size=CACHE_SIZE):
+    self.hists = dict((h.table_name, h) for h in hists)
+    self.cache_size = cache_size
+    self._cache = OrderedDict()
+    self._versions = None
+    self._lock = threading.Lock()
+
+  def respond(self, line):
+    """the response to a request line, as bytes"""
+    try:
+      rows = self.answer(decode_line(line))
+    except (RequestError, re.error, sqlite3.Error) as e:
+      return u'error {0}\n'.format(' '.join(str(e).split())).encode('utf-8')
+
+    return b''.join(
+      [u'ok {0}\n'.format(len(rows)).encode('utf-8')] + [encode_line(r) for r in rows])
+
+  def answer(self, words):
+    """the rows answering a request, each a list of strings"""
+    key = tuple(words)
+    with self._lock:
+      if words and words[0] in _UNCACHED:
+        return self._run(words)
+
+      self._check_versions()
+      rows = self._cache.pop(key, None)
+      if rows is None:
+        rows = self._run(words)
+      self._cache[key] = rows
+      while len(self._cache) > self.cache_size:
+        self._cache.popitem(last=False)
+      return rows
+
+  def _check_versions(self):
+    versions = [
+      h.conn.execute("PRAGMA data_version").fetchone()[0] for h in self.hists.values()]
+    if versions != self._versions:
+      self._cache.clear()
+      self._versions = versions
+
+  def _hist(self, shell):
+    name = '{0}_history'.format(_SHELLS.get(shell, shell))
+    try:
+      return self.hists[name]
+    except KeyError:
+      raise RequestError('not serving {0}'.format(shell))
+
+  def _run(self, words):
+    verb, args = words[0], words[1:]
+    if verb == 'ping':
+      _unpack(args, ())
+      return []
+    elif verb in ('search', 'regex'):
+      shell, term, limit, rank = _unpack(args, ('SHELL', 'TERM'), ('LIMIT', 'RANK'))
+      return self.search(self._hist(shell), term, _int(limit, 25), rank or 'recent',
+        regex=verb == 'regex')
+    elif verb == 'suggest':
+      shell, prefix = _unpack(args, ('SHELL', 'PREFIX'))
+      return self.suggest(self._hist(shell), prefix)
+    elif verb == 'stats':
+      shell, = _unpack(args, ('SHELL',))
+      return self.stats(self._hist(shell))
+    else:
+      raise RequestError('unknown verb {0}'.format(verb))
+
+  def search(self, hist, term, limit, rank, regex=False):
+    if rank == 'frecency':
+      found = hist.search_frecent(term, limit, regex=regex)
+    elif rank != 'recent':
+      raise RequestError('unknown rank {0}'.format(rank))
+    elif regex:
+      found = hist.search_regex(term, limit)
+    else:
+      found = hist.search(term, limit)
+    return [[str(r.timestamp), r.command] for r in found]
+
+  def suggest(self, hist, prefix):
+    command = hist.suggest(prefix)
+    return [] if command is None else [[command]]
+
+  def stats(self, hist):
+    now = int(time.time())
+    return [
+      ['hour', str(hist.cmds_since(now - 3600))],
+      ['day', str(hist.cmds_since(now - 86400))],
+      ['week', str(hist.cmds_since(now - 7 * 86400))],
+      ['total', str(hist.total_count())],
+    ]
+
+
+class _Handler(socketserver.StreamRequestHandler):
+  # clients can keep a connection open for more requests, but not forever
+  timeout = 600
+
+  def handle(self):
+    while True:
+      try:
+        line = self.rfile.readline(MAX_REQUEST)
+      except socket.timeout:
+        return
+      if not line:
+        return
+      self.wfile.write(self.server.service.respond(line))
+
+
+def _claim(path):
+  """remove the socket at path if it's left over from a server that's gone"""
+  if not os.path.exists(path):
+    return
+
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    s.connect(path)
+  except socket.error as e:
+    if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+      raise
+    os.unlink(path)
+  else:
+    raise RuntimeError('something is already listening on {0}'.format(path))
+  finally:
+    s.close()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, path, service):
+    self.service = service
+    _claim(path)
+    # only we get to connect
+    umask = os.umask(0o077)
+    try:
+      socketserver.UnixStreamServer.__init__(self, path, _Handler)
+    finally:
+      os.umask(umask)
+
+  def server_close(self):
+    socketserver.UnixStreamServer.server_close(self)
+    try:
+      os.unlink(self.server_address)
+    except OSError:
+      pass
+
+
+@contextmanager
+def _opened(confs):
+  if not confs:
+    yield []
+    return
+  with confs[0].open() as hist:
+    with _opened(confs[1:]) as rest:
+      yield [hist] + rest
+
+
+def serve(confs, path=DEFAULT_SOCKET):
+  """serve confs on the unix socket at path until interrupted"""
+  # the connections get used from whichever thread is handling a request
+  confs = [
+    c.evolve(db_conn_factory=functools.partial(_mk_conn, check_same_thread=False))
+    for c in confs]
+
+  with _opened(confs) as hists:
+    for hist in hists:
+      hist.init_db()
+      # so the usage table suggest reads is there and up to date
+      hist.update_rollups()
+
+    server = Server(path, Service(hists))
+    log.info("serving {0} on {1}".format(', '.join(h.table_name for h in hists), path))
+    try:
+      server.serve_forever()
+    finally:
+      server.server_close()
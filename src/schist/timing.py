@@ -0,0 +1,199 @@
+"""how long commands ran for
+
+with EXTENDED_HISTORY zsh records how many seconds each command took, which is
+kept in the history table's elapsed column (NULL where it isn't known, e.g. for
+bash). there's an index on it, so the slowest commands come straight off that.
+
+tables from before the column existed get it with `schist migrate --elapsed`,
+which also fills it in for the rows that are still in the histfile.
+
+the queries here all take the FROM clause that yields timestamp, command and
+elapsed (HistConfig._source()), so they work on plain and interned tables alike,
+and do their aggregation in sql.
+"""
+
+from __future__ import print_function
+
+import datetime
+import itertools
+import logging
+
+from collections import OrderedDict
+
+from .rollup import _bucket, _next_bucket
+
+
+log = logging.getLogger(__name__)
+
+COLUMN = 'elapsed'
+
+# percentiles by_command() reports
+PERCENTILES = (50, 90, 99)
+
+# sqlite date() modifiers that take a local date to the start of its bucket
+_BUCKET_SQL = {
+  'day': "date(timestamp, 'unixepoch', 'localtime')",
+  # back to the monday on or before it
+  'week': "date(timestamp, 'unixepoch', 'localtime', '-6 days', 'weekday 1')",
+  'month': "date(timestamp, 'unixepoch', 'localtime', 'start of month')",
+}
+
+
+def has_column(conn, table):
+  return any(
+    r[1] == COLUMN for r in conn.execute("PRAGMA table_info({0})".format(table)))
+
+
+def create_index(conn, table):
+  return conn.execute(
+    "CREATE INDEX IF NOT EXISTS {table}_{col} ON {table} ({col})".format(
+      table=table, col=COLUMN))
+
+
+def add_column(conn, table):
+  if not has_column(conn, table):
+    conn.execute("ALTER TABLE {table} ADD COLUMN {col} INTEGER".format(table=table, col=COLUMN))
+  create_index(conn, table)
+
+
+def insert_columns(has_col, value='?'):
+  """bits of an INSERT for the elapsed column: {elapsed} for the column list,
+  {param} for VALUES and {value} for a SELECT. all empty if there's no column"""
+  if not has_col:
+    return {'elapsed': '', 'param': '', 'value': ''}
+  return {'elapsed': ', ' + COLUMN, 'param': ', ?', 'value': ', ' + value}
+
+
+def with_elapsed(rows, has_col):
+  """rows as 3-tuples if has_col, otherwise as 2-tuples. only the first row is
+  looked at when they're already the right shape"""
+  rows = iter(rows)
+  first = next(rows, None)
+  if first is None:
+    return iter(())
+
+  rows = itertools.chain((first,), rows)
+  if len(first) == (3 if has_col else 2):
+    return rows
+  elif has_col:
+    return ((r[0], r[1], r[2] if len(r) > 2 else None) for r in rows)
+  else:
+    return ((r[0], r[1]) for r in rows)
+
+
+def backfill(conn, table, rows, commands=None):
+  """set elapsed, where it's NULL, from rows (timestamp, command, elapsed) that
+  match on timestamp and command. commands is the commands table for an
+  interned table. returns the number of rows updated"""
+  conn.execute("""\
+      CREATE TEMP TABLE IF NOT EXISTS schist_elapsed (
+        timestamp BIGINT NOT NULL,
+        command text NOT NULL,
+        elapsed INTEGER NOT NULL,
+        PRIMARY KEY (timestamp, command)
+      ) WITHOUT ROWID
+    """)
+  conn.execute("DELETE FROM temp.schist_elapsed")
+
+  conn.executemany(
+    "INSERT OR IGNORE INTO temp.schist_elapsed (timestamp, command, elapsed) VALUES (?, ?, ?)",
+    (r[:3] for r in rows if len(r) > 2 and r[2] is not None))
+
+  if commands is None:
+    command = '{0}.command'.format(table)
+  else:
+    command = '(SELECT command FROM {commands} WHERE id = {table}.command_id)'.format(
+      commands=commands, table=table)
+
+  match = """\
+    FROM temp.schist_elapsed e WHERE e.timestamp = {table}.timestamp AND e.command = {command}
+  """.format(table=table, command=command)
+
+  updated = conn.execute("""\
+      UPDATE {table} SET elapsed = (SELECT e.elapsed {match})
+        WHERE elapsed IS NULL AND EXISTS (SELECT 1 {match})
+    """.format(table=table, match=match)).rowcount
+
+  conn.execute("DELETE FROM temp.schist_elapsed")
+  return updated
+
+
+def _where(since=None, until=None, like=None):
+  clauses = ['elapsed IS NOT NULL']
+  params = {}
+  if since is not None:
+    clauses.append('timestamp >= :since')
+    params['since'] = since
+  if until is not None:
+    clauses.append('timestamp < :until')
+    params['until'] = until
+  if like is not None:
+    clauses.append('command LIKE :like')
+    params['like'] = like
+  return 'WHERE ' + ' AND '.join(clauses), params
+
+
+def slowest(conn, source, limit=20, since=None, like=None):
+  """(timestamp, elapsed, command) for the longest running commands, longest
+  first"""
+  where, params = _where(since=since, like=like)
+  params['limit'] = int(limit)
+  q = """\
+    SELECT timestamp, elapsed, command FROM {source} {where}
+      ORDER BY elapsed DESC, timestamp DESC LIMIT :limit
+  """.format(source=source, where=where)
+  return [tuple(r) for r in conn.execute(q, params)]
+
+
+def by_command(conn, source, key='command', limit=20, since=None, like=None):
+  """(command, runs, total, p50, p90, p99, max) for the commands that took the
+  most time altogether, in seconds. key is what identifies a command in source
+  (its command_id, for an interned table)
+
+  the percentiles are nearest rank, worked out with window functions, so this
+  needs sqlite 3.25 or newer.
+  """
+  where, params = _where(since=since, like=like)
+  params['limit'] = int(limit)
+
+  percentiles = ''.join(
+    ",\n max(CASE WHEN rn = (n * {p} + 99) / 100 THEN elapsed END) AS p{p}".format(p=p)
+    for p in PERCENTILES)
+
+  q = """\
+    WITH t AS (
+      SELECT {key} AS k, command, elapsed,
+        row_number() OVER (PARTITION BY {key} ORDER BY elapsed) AS rn,
+        count(*) OVER (PARTITION BY {key}) AS n
+      FROM {source} {where}
+    )
+    SELECT command, max(n) AS runs, sum(elapsed) AS total{percentiles},
+      max(elapsed) AS worst
+      FROM t GROUP BY k ORDER BY total DESC, runs DESC LIMIT :limit
+  """.format(key=key, source=source, where=where, percentiles=percentiles)
+  return [tuple(r) for r in conn.execute(q, params)]
+
+
+def time_spent(conn, source, lo, hi, unit='day', like=None):
+  """an OrderedDict of local date -> (commands, total seconds) for every day,
+  week (starting on monday) or month from lo up to hi"""
+  spent = OrderedDict()
+
+  d = _bucket(datetime.datetime.fromtimestamp(lo).date(), unit)
+  end = datetime.datetime.fromtimestamp(hi).date()
+  while d <= end:
+    spent[d] = (0, 0)
+    d = _next_bucket(d, unit)
+
+  where, params = _where(since=lo, until=hi, like=like)
+  q = """\
+    SELECT {bucket} AS b, count(*), sum(elapsed) FROM {source} {where}
+      GROUP BY b
+  """.format(bucket=_BUCKET_SQL[unit], source=source, where=where)
+
+  for b, n, total in conn.execute(q, params):
+    key = datetime.datetime.strptime(b, '%Y-%m-%d').date()
+    if key in spent:
+      spent[key] = (n, total)
+
+  return spent
@@ -0,0 +1,165 @@
+"""keep the db up to date with a histfile as the shell appends to it
+
+`schist watch` opens the db once and then sleeps until the histfile changes,
+and each change is ingested with HistConfig.insert(), which only parses what
+was appended since its checkpoint (and falls back to a full scan when the
+shell rewrote or truncated the file).
+
+changes are noticed with inotify on linux. everywhere else, or with --poll, we
+stat the file every so often, which costs next to nothing. the histfile's
+directory is what gets watched, since zsh replaces the file when it trims it.
+"""
+
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import os.path
+import select
+import struct
+import sys
+import time
+
+
+log = logging.getLogger(__name__)
+
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct('iIII')
+
+
+def _libc():
+  if not sys.platform.startswith('linux'):
+    return None
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_init1
+  except (OSError, AttributeError):
+    return None
+  return libc
+
+
+class PollWatcher(object):
+  """notices changes by comparing the histfile's stat() from one call to the next"""
+
+  def __init__(self, path, poll_interval=1.0):
+    self.path = path
+    self.poll_interval = poll_interval
+    self._last = self._stat()
+
+  def _stat(self):
+    try:
+      st = os.stat(self.path)
+    except OSError as e:
+      if e.errno == errno.ENOENT:
+        return None
+      raise
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+  def wait(self, timeout):
+    """sleep for up to timeout seconds, returns True if the file changed"""
+    deadline = time.time() + timeout
+    while True:
+      st = self._stat()
+      if st != self._last:
+        self._last = st
+        return True
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+      time.sleep(min(remaining, self.poll_interval))
+
+  def close(self):
+    pass
+
+
+class InotifyWatcher(object):
+  """notices changes with inotify on the histfile's directory"""
+
+  _MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+
+  def __init__(self, path, libc):
+    self.name = os.path.basename(path).encode('utf-8')
+    self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    if libc.inotify_add_watch(self.fd, dirname.encode('utf-8'), self._MASK) < 0:
+      err = ctypes.get_errno()
+      os.close(self.fd)
+      raise OSError(err, "inotify_add_watch failed for {0}".format(dirname))
+
+  def _drain(self):
+    """read every pending event, returns True if any of them were for our file"""
+    hit = False
+    while True:
+      try:
+        buf = os.read(self.fd, 64 * 1024)
+      except OSError as e:
+        if e.errno == errno.EAGAIN:
+          return hit
+        raise
+      i = 0
+      while i < len(buf):
+        _, mask, _, namelen = _EVENT.unpack_from(buf, i)
+        name = buf[i + _EVENT.size:i + _EVENT.size + namelen].rstrip(b'\0')
+        if name == self.name or mask & _IN_Q_OVERFLOW:
+          hit = True
+        i += _EVENT.size + namelen
+
+  def wait(self, timeout):
+    """sleep for up to timeout seconds, returns True if the file changed"""
+    deadline = time.time() + timeout
+    while True:
+      r, _, _ = select.select([self.fd], [], [], max(0, deadline - time.time()))
+      if r and self._drain():
+        return True
+      if time.time() >= deadline:
+        return False
+
+  def close(self):
+    os.close(self.fd)
+
+
+def mk_watcher(path, poll=False, poll_interval=1.0):
+  libc = None if poll else _libc()
+  if libc is not None:
+    try:
+      return InotifyWatcher(path, libc)
+    except OSError as e:
+      log.warning("can't use inotify (%s), polling instead", e)
+  return PollWatcher(path, poll_interval=poll_interval)
+
+
+def watch(hist, watcher, interval=1.0, settle=0.05, stop=None, on_insert=None):
+  """ingest hist's histfile whenever watcher says it changed, until stop()
+  returns True (which is checked at least every interval seconds)
+
+  settle is how long to let a burst of writes finish before reading, so one
+  command's worth of writes becomes one small transaction. on_insert, if given,
+  is called with the number of rows added after each ingest.
+  """
+  stop = stop or (lambda: False)
+
+  def ingest():
+    added = hist.insert() if os.path.exists(hist.histfile) else 0
+    if on_insert is not None:
+      on_insert(added)
+
+  ingest()
+  while not stop():
+    if watcher.wait(interval):
+      time.sleep(settle)
+      # swallow the rest of the burst, it's covered by this ingest
+      watcher.wait(0)
+      ingest()
@@ -1,43 +1,139 @@
+"""zsh history files
+
+with EXTENDED_HISTORY each entry is `: <start>:<elapsed>;<command>`, and zsh
+writes each newline inside a command as a backslash-newline, so one entry can
+span several lines. it also "metafies" some bytes: 0x83 followed by the byte
+xor 0x20.
+
+the parser works on bytes, a piece (about PIECE_SIZE, cut at the end of an
+entry) at a time: one findall() finds every entry in the piece, and only the
+commands get decoded. continuation lines and metafied bytes are dealt with a
+whole piece at a time, and only in pieces that have any. history_range() reads
+the file through mmap, history_iter() takes any iterable of lines.
+"""
+
 from __future__ import print_function
 
+import functools
 import logging
+import mmap
 import os
 import re
 
 from collections import defaultdict
 
-from .common import _utf8, _mk_conn
+from .common import _mk_conn, _write_lines
 from .db import HistConfig, Row
 
-import arrow
+import six
 
 log = logging.getLogger(__name__)
 
-_ZSH_REGEX = re.compile(r"""^: (?P<ts>\d+):\d+;(?P<cmd>.*)$""")
+_ENTRY = re.compile(br"""^: (\d+):(\d+);(.*)$""", re.M)
 
+# the same, but taking the continuation lines that follow with each entry.
+# slower, it's only for the pieces that have a (metafied) NUL in them
+_MULTILINE_ENTRY = re.compile(br"""^: (\d+):(\d+);((?:.*\\\n)*.*)$""", re.M)
 
-def history_iter(fp):
-  for line in fp:
-    m = _ZSH_REGEX.match(_utf8(line))
-    if m:
+_CONTINUATION = b'\\\n'
+_NEWLINE_MARK = b'\x00'
+
+_META = b'\x83'
+
+# what the first line of a record looks like, for splitting the file up
+_RECORD_START = re.compile(br'^: \d+:\d+;')
 
-      ts = arrow.get(int(m.group('ts')))
+PIECE_SIZE = 64 * 1024
 
-      unix_ts = ts.timestamp
+# Row._make without the python level call, rows come out of here in bulk
+_mkrow = functools.partial(tuple.__new__, Row)
 
-      row = Row(
-        timestamp=ts,
-        command=_utf8(m.group('cmd'))
-      )
 
-      yield row
+def _unmetafy(b):
+  parts = b.split(_META)
+  out = [parts[0]]
+  for p in parts[1:]:
+    if p:
+      out.append(six.int2byte(six.indexbytes(p, 0) ^ 0x20) + p[1:])
+  return b''.join(out)
+
+
+def _parse_piece(piece):
+  """the Rows for every entry in piece, bytes that end at the end of an entry"""
+  # zsh only metafies NUL and 0x83 to 0xa2, so unmetafying can't make a
+  # newline or a backslash, and entries start and end where they did
+  if _META in piece:
+    piece = _unmetafy(piece)
+
+  if _CONTINUATION in piece:
+    if _NEWLINE_MARK in piece:
+      found = _MULTILINE_ENTRY.findall(piece)
+      mark = _CONTINUATION
     else:
-      log.debug("BAD LINE: %r", line)
+      # one line per entry, so the regex can stay simple
+      found = _ENTRY.findall(piece.replace(_CONTINUATION, _NEWLINE_MARK))
+      mark = _NEWLINE_MARK
+    return [
+      _mkrow((int(ts), cmd.replace(mark, b'\n').decode('utf-8', 'replace'), int(el)))
+      for ts, el, cmd in found]
+
+  found = _ENTRY.findall(piece)
+  return [_mkrow((int(ts), cmd.decode('utf-8', 'replace'), int(el))) for ts, el, cmd in found]
+
+
+def _piece_end(buf, pos, end):
+  """the offset just past the first newline at or after pos that ends an entry"""
+  while True:
+    nl = buf.find(b'\n', pos, end)
+    if nl < 0:
+      return end
+    if nl == 0 or buf[nl - 1:nl] != b'\\':
+      return nl + 1
+    pos = nl + 1
+
+
+def history_range(fp, start, end, piece_size=PIECE_SIZE):
+  """yields a Row for each entry in the bytes from start to end of fp, a
+  binary file, which should be at the start of an entry"""
+  if end <= start:
+    return
+
+  mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    pos = start
+    while pos < end:
+      stop = _piece_end(mm, min(pos + piece_size, end) - 1, end)
+      for row in _parse_piece(mm[pos:stop]):
+        yield row
+      pos = stop
+  finally:
+    mm.close()
+
+
+def history_iter(fp, piece_size=PIECE_SIZE):
+  """yields a Row for each entry in fp, an iterable of lines (bytes, or text
+  that's already been decoded)"""
+  lines = []
+  size = 0
+  for line in fp:
+    if not isinstance(line, six.binary_type):
+      line = line.encode('utf-8')
+    lines.append(line)
+    size += len(line)
+    if size >= piece_size and not line.endswith(b'\\\n'):
+      for row in _parse_piece(b''.join(lines)):
+        yield row
+      lines = []
+      size = 0
+
+  for row in _parse_piece(b''.join(lines)):
+    yield row
 
 
 def history_output(row_iter, fp):
-  for row in row_iter:
-    print(u": {ts}:0;{cmd}".format(ts=str(row.timestamp.timestamp), cmd=row.command), file=fp)
+  fmt = u": {0}:{1};{2}\n".format
+  _write_lines(fp, (
+    fmt(ts, elapsed or 0, cmd.replace(u'\n', u'\\\n')) for ts, cmd, elapsed in row_iter))
 
 
 _DEFAULT_ZSH_HIST = os.path.expanduser("~/.zsh_history")
@@ -48,4 +144,7 @@ CONFIG = HistConfig(
   db_conn_factory=_mk_conn,
   history_iter_fn=history_iter,
   output_fn=history_output,
+  record_start=_RECORD_START,
+  range_iter_fn=history_range,
+  continuation=b'\\',
 )
@@ -7,7 +7,7 @@ import sys
 from io import StringIO
 from textwrap import dedent
 
-from schist import app, common, db
+from schist import app, common, db, zsh
 
 import arrow
 import pytest
@@ -24,7 +24,7 @@ ROWS = [
 ]
 
 ZSH_HISTORY = u'\n'.join(
-    u": {r.timestamp.timestamp:d}:0;{r.command}".format(r=r) for r in ROWS
+    u": {r.timestamp:d}:0;{r.command}".format(r=r) for r in ROWS
   )
 
 
@@ -63,7 +63,7 @@ def zsh_history_db():
 def test_app_stats_cmd(monkeypatch, zsh_history_db):
   sio = StringIO()
   monkeypatch.setattr('sys.stdout', sio)
-  monkeypatch.setattr('schist.app.arrow.now', lambda: NOW)
+  monkeypatch.setattr('arrow.now', lambda: NOW)
   app.main('stats', 'zsh')
 
   value = sio.getvalue()
@@ -77,9 +77,96 @@ def test_app_stats_cmd(monkeypatch, zsh_history_db):
                     which was: {min}m {s}s ago
     """.format(
       hr=2, day=3, week=5, total=6,
-      last=ROWS[-1].timestamp.format('YYYY-MM-DD HH:mm:ss'),
+      last=ROWS[-1].arrow.format('YYYY-MM-DD HH:mm:ss'),
       min=5, s=22
     ))
 
   assert value == expected
 
+
+
+def test_app_search_fts(monkeypatch, zsh_history_db):
+  app.main('index', 'zsh')
+
+  sio = StringIO()
+  monkeypatch.setattr('sys.stdout', sio)
+  app.main('search', '--fts', '--no-date', 'zsh', 'cd')
+
+  assert sio.getvalue().splitlines() == ['cd /tmp', 'cd /var/tmp']
+
+
+def test_app_stats_histogram(monkeypatch, zsh_history_db):
+  sio = StringIO()
+  monkeypatch.setattr('sys.stdout', sio)
+  monkeypatch.setattr('arrow.now', lambda: NOW)
+  app.main('stats', 'zsh', '--histogram', 'day')
+
+  lines = sio.getvalue().splitlines()
+  assert len(lines) == 31
+  assert lines[-1].startswith(NOW.format('YYYY-MM-DD'))
+  assert sum(int(l.split()[1]) for l in lines) == 5
+
+
+def test_app_duration():
+  assert app._duration(None) == u'0s'
+  assert app._duration(59) == u'59s'
+  assert app._duration(61) == u'1m01s'
+  assert app._duration(3723) == u'1h02m03s'
+
+
+def test_app_stats_slowest_needs_migrate(monkeypatch, zsh_history_db, zsh_history_file):
+  monkeypatch.setattr('arrow.now', lambda: NOW)
+  with pytest.raises(SystemExit) as e:
+    app.main('stats', 'zsh', '--slowest')
+  assert e.value.code == 1
+
+  app.main('migrate', 'zsh', '--elapsed', '-p', os.path.expanduser('~/.zsh_history'))
+
+  sio = StringIO()
+  monkeypatch.setattr('sys.stdout', sio)
+  app.main('stats', 'zsh', '--slowest', '3')
+  lines = sio.getvalue().splitlines()
+  assert len(lines) == 3
+  assert all(l.split()[2] == '0s' for l in lines)
+
+
+def test_app_stats_timing_reports_exclude_each_other():
+  with pytest.raises(SystemExit):
+    app.main('stats', 'zsh', '--slowest', '--by-command')
+
+
+def test_app_backup_is_a_noop_while_another_runs(tmpdir):
+  db_path = str(tmpdir.join('schist.sq3'))
+  hist_path = tmpdir.join('zsh_history')
+  hist_path.write(ZSH_HISTORY + '\n')
+
+  conf = zsh.CONFIG.evolve(db_path=db_path, histfile=str(hist_path))
+  backup = ('-d', db_path, 'backup', 'zsh', '-p', str(hist_path))
+
+  with conf.backup_lock() as locked:
+    assert locked
+    app.main(*backup)
+    assert not os.path.exists(db_path)
+
+  app.main(*backup)
+  with conf.open() as hist:
+    assert hist.count() == len(ROWS)
+
+
+@pytest.mark.parametrize('args', [
+  ('import', 'zsh', os.devnull),
+  ('merge', 'zsh', os.devnull),
+  ('archive', 'zsh'),
+])
+def test_app_gives_up_while_watch_runs(tmpdir, capsys, args):
+  db_path = str(tmpdir.join('schist.sq3'))
+  conf = zsh.CONFIG.evolve(db_path=db_path, histfile='bogus')
+
+  # what `schist watch` holds the whole time
+  with conf.backup_lock() as locked:
+    assert locked
+    with pytest.raises(SystemExit) as e:
+      app.main('-d', db_path, *(args[:1] + ('--lock-wait', '0.2') + args[1:]))
+    assert e.value.code == 1
+
+  assert 'schist watch' in capsys.readouterr().err
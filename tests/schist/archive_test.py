@@ -0,0 +1,198 @@
+from __future__ import print_function
+
+import random
+
+from schist import app, archive, db
+from schist.common import _mk_conn
+
+import pytest
+
+
+START = 1514240734
+DAY = 86400
+
+rnd = random.Random(5)
+ROWS = [
+  db.Row(ts, rnd.choice([u'git status', u'make test', u'ls -la', u'vim setup.py',
+    u'echo "caf\xe9"', u'ssh host{0}'.format(rnd.randint(0, 30))]), rnd.choice([None, 0, 3]))
+  for ts in sorted(rnd.sample(range(START, START + 180 * DAY), 1500))]
+
+# about four months' worth
+BEFORE = START + 120 * DAY
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'interned'])
+def interned(request):
+  return request.param
+
+
+def hot(hist):
+  return hist.conn.execute("SELECT count(*) FROM zsh_history").fetchone()[0]
+
+
+def test_archive_encode_decode():
+  rows = [
+    (START, u'ls', None, None), (START, u'caf\xe9\n\ttab', 7, u'laptop'), (START + 9, u'x', 0, None)]
+  assert archive.decode(archive.encode(rows)) == rows
+  assert archive.decode(archive.encode(rows[:1])) == rows[:1]
+
+
+def test_archive_months():
+  assert archive.month_start(START) == 1512086400  # 2017-12-01
+  assert archive.next_month(1512086400) == 1514764800  # 2018-01-01
+  assert archive.next_month(1514764800) == 1517443200  # 2018-02-01
+
+
+def test_archive_moves_old_rows(hist):
+  expected = list(hist.rows())
+  total = hist.total_count()
+
+  moved = hist.archive(BEFORE)
+  assert moved == sum(1 for r in ROWS if r.timestamp < BEFORE)
+  assert hot(hist) == len(ROWS) - moved
+  assert hist.conn.execute(
+    "SELECT min(timestamp) FROM zsh_history").fetchone()[0] >= BEFORE
+
+  blocks = archive.blocks(hist.conn, 'zsh_history')
+  assert [b[0] for b in blocks] == sorted(set(archive.month_start(r.timestamp) for r in ROWS
+    if r.timestamp < BEFORE))
+  for start, min_ts, max_ts, count in blocks:
+    assert start <= min_ts <= max_ts < archive.next_month(start)
+  assert sum(b[3] for b in blocks) == moved
+  assert hist.archive_totals()[:2] == (len(blocks), moved)
+
+  assert hist.count() == len(ROWS)
+  assert list(hist.rows()) == expected
+  assert list(hist.rows(limit=10)) == expected[:10]
+  # the rollups counted them before they moved
+  assert hist.total_count() == total
+
+  # again is a no-op
+  assert hist.archive(BEFORE) == 0
+  assert list(hist.rows()) == expected
+
+
+def test_archive_keeps_the_newest_row(hist):
+  last = hist.conn.execute("SELECT max(rowid) FROM zsh_history").fetchone()[0]
+  assert hist.archive(START + 1000 * DAY) == len(ROWS) - 1
+  assert hot(hist) == 1
+  assert hist.conn.execute("SELECT max(rowid) FROM zsh_history").fetchone()[0] == last
+  assert hist.count() == len(ROWS)
+
+
+def test_archive_interned_drops_unused_commands(hist):
+  if not hist.is_interned():
+    pytest.skip('plain table')
+
+  with hist.conn:
+    hist.insert_rows([db.Row(START + 1, u'only once, long ago'), db.Row(BEFORE + DAY, u'ls')])
+  hist.archive(BEFORE)
+  assert hist.conn.execute(
+    "SELECT count(*) FROM zsh_history_commands WHERE command = 'only once, long ago'"
+  ).fetchone()[0] == 0
+  assert u'only once, long ago' in [r.command for r in hist.rows()]
+
+
+@pytest.mark.parametrize('since, last, unique', [
+  (None, None, False),
+  (None, None, True),
+  (None, 100, True),
+  (None, 1000, False),
+  (START + 100 * DAY, None, False),
+  (START + 100 * DAY, 50, True),
+  (START + 150 * DAY, None, True),
+])
+def test_archive_restore(hist, since, last, unique):
+  expected = list(hist.restore_rows(since=since, last=last, unique=unique))
+  hist.archive(BEFORE)
+  assert list(hist.restore_rows(since=since, last=last, unique=unique)) == expected
+
+
+def test_archive_restore_skips_old_blocks(hist, monkeypatch):
+  hist.archive(BEFORE)
+  loaded = []
+  real = archive.load
+  monkeypatch.setattr(archive, 'load', lambda conn, table, starts: loaded.extend(starts) or
+    real(conn, table, starts))
+
+  list(hist.restore_rows(since=BEFORE))
+  assert loaded == []
+  list(hist.restore_rows(since=BEFORE - DAY))
+  assert loaded == [archive.month_start(BEFORE - DAY)]
+
+
+@pytest.mark.parametrize('term, limit', [
+  (u'git status', 5),
+  (u'ssh host1%', 25),
+  (u'ssh host29', 1000),
+  (u'%caf\xe9%', 3),
+  (u'nothing like it', 10),
+])
+def test_archive_search(hist, term, limit):
+  expected = list(hist.search(term, limit))
+  hist.archive(BEFORE)
+  assert list(hist.search(term, limit)) == expected
+
+
+@pytest.mark.parametrize('pattern, limit', [
+  (u'^ssh host1\\d$', 30),
+  (u'set(up)?\\.py', 1000),
+])
+def test_archive_search_regex(hist, pattern, limit):
+  expected = list(hist.search_regex(pattern, limit))
+  hist.archive(BEFORE)
+  assert list(hist.search_regex(pattern, limit)) == expected
+
+
+def test_archive_search_stops_early(hist, monkeypatch):
+  hist.archive(BEFORE)
+  loaded = []
+  real = archive.load
+  monkeypatch.setattr(archive, 'load', lambda conn, table, starts: loaded.extend(starts) or
+    real(conn, table, starts))
+
+  # plenty of recent ones
+  assert len(list(hist.search(u'git status', 5))) == 5
+  assert loaded == []
+
+  # all of them
+  list(hist.search(u'git status', 10000))
+  assert loaded == [b[0] for b in archive.blocks(hist.conn, 'zsh_history', newest_first=True)]
+
+
+def test_archive_drops_rows_it_already_has(hist):
+  hist.archive(BEFORE)
+  n = hot(hist)
+
+  # e.g. a backup --full, or merging an older copy of the db
+  late = db.Row(START + 5, u'late arrival')
+  with hist.conn:
+    hist.insert_rows(ROWS[:100] + [late, db.Row(START + 200 * DAY, u'newest')])
+  hist.update_rollups()
+  assert hot(hist) == n + 2
+  assert hist.count() == len(ROWS) + 2
+
+  assert hist.archive(BEFORE) == 1
+  assert hot(hist) == n + 1
+  assert list(hist.rows(limit=1)) == [ROWS[0]]
+  assert late in list(hist.rows())
+  assert hist.count() == len(ROWS) + 2
+
+
+def test_archive_app(tmpdir, capsys):
+  hist_path = tmpdir.join('zsh_history')
+  hist_path.write_text(u''.join(u": {0}:{1};{2}\n".format(
+    r.timestamp, r.elapsed or 0, r.command) for r in ROWS), encoding='utf-8')
+  db_path = str(tmpdir.join('schist.sq3'))
+  app.main('-d', db_path, 'backup', 'zsh', '-p', str(hist_path))
+
+  out = tmpdir.join('before')
+  app.main('-d', db_path, 'restore', str(out), 'zsh')
+  app.main('-d', db_path, 'archive', 'zsh', '--before', '2018-03-01')
+
+  with _mk_conn(db_path) as conn:
+    assert archive.totals(conn, 'zsh_history')[0] == 3
+
+  after = tmpdir.join('after')
+  app.main('-d', db_path, 'restore', str(after), 'zsh')
+  assert after.read_binary() == out.read_binary()
@@ -109,8 +109,36 @@ def test_bash_integration(bash_fp, bash_config, memory_db):
 
     assert hist.cmds_since(ROWS[1].timestamp) == 2
 
-    assert hist.last_cmd() == ROWS[-1].timestamp
+    assert hist.last_cmd() == ROWS[-1].arrow
 
     res = [r for r in hist.search("echo%bar%")]
     assert len(res) == 1
     assert res[0] == ROWS[1]
+
+
+def test_bash_history_iter_is_not_recursive():
+  n = 10000
+  lines = ('#{0}\ncmd {1}\n'.format(1447184318 + i, i) for i in range(n))
+  rows = bash.history_iter(''.join(lines).splitlines(True))
+
+  count = 0
+  for count, row in enumerate(rows, 1):
+    pass
+
+  assert count == n
+  assert row == db.Row(1447184318 + n - 1, 'cmd {0}'.format(n - 1))
+
+
+def test_bash_history_iter_is_lazy():
+  def lines():
+    yield '#1447184318\n'
+    yield 'echo "foo"\n'
+    yield '#1447185494\n'
+    raise AssertionError("read past the second record")
+
+  assert next(bash.history_iter(lines())) == ROWS[0]
+
+
+def test_bash_history_iter_skips_empty_records():
+  lines = ['#1447184317\n', '#1447184318\n', 'echo "foo"\n', '#1447184319\n']
+  assert list(bash.history_iter(lines)) == [ROWS[0]]
@@ -1,9 +1,118 @@
 from __future__ import print_function
 
-from schist.common import _utf8
+import math
+import sqlite3
+
+from schist.common import (
+  _utf8, _advisory_lock, _compile_regex, _log2_add, _mk_conn, _regex_literals,
+  _write_transaction)
 
 import pytest
 
 def test_utf8_with_bad_input():
   with pytest.raises(TypeError):
     _utf8(object())
+
+
+@pytest.mark.parametrize('pattern,expected', [
+  (u'kubectl.*prod', [u'kubectl', u'prod']),
+  (u'^git (status|diff)', [u'git ']),
+  (u'foo\\d+bar', [u'foo', u'bar']),
+  (u'a(bc)+d?e*', [u'a', u'bc']),
+  (u'x{2}y', [u'x', u'y']),
+  (u'(abc|xyz)', []),
+  (u'(?i)kubectl', [u'kubectl']),
+  (u'(?i)k\u00fcbectl', []),
+  (u'(?i:\u00fc)\u00fc', [u'\u00fc']),
+  (u'(unclosed', []),
+])
+def test_regex_literals(pattern, expected):
+  assert _regex_literals(pattern) == expected
+
+
+def test_regexp_function(memory_db):
+  q = "SELECT ? REGEXP ?"
+  assert memory_db.execute(q, (u'git status', u'^git\\s')).fetchone()[0] == 1
+  assert memory_db.execute(q, (u'git status', u'^status')).fetchone()[0] == 0
+  assert memory_db.execute(q, (None, u'.')).fetchone()[0] == 0
+
+
+def test_regexp_caches_compiled_patterns(memory_db):
+  memory_db.execute("CREATE TABLE t (v text)")
+  memory_db.executemany("INSERT INTO t VALUES (?)", [(u'xy',), (u'xxy',), (u'z',)])
+
+  _compile_regex.cache_clear()
+  assert memory_db.execute("SELECT count(*) FROM t WHERE v REGEXP 'x+y'").fetchone()[0] == 2
+  info = _compile_regex.cache_info()
+  assert info.misses == 1
+  assert info.hits == 2
+
+
+def test_advisory_lock(tmpdir):
+  path = str(tmpdir.join('x.lock'))
+  with _advisory_lock(path) as locked:
+    assert locked
+    with _advisory_lock(path) as again:
+      assert not again
+    with _advisory_lock(path, wait=0.2, poll_interval=0.05) as again:
+      assert not again
+
+  with _advisory_lock(path) as locked:
+    assert locked
+
+
+def test_mk_conn_uses_wal(tmpdir):
+  path = str(tmpdir.join('wal.sq3'))
+  writer = _mk_conn(path)
+  reader = _mk_conn(path)
+  try:
+    assert writer.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+    with writer:
+      writer.execute("CREATE TABLE t (x)")
+      writer.execute("INSERT INTO t VALUES (1)")
+
+    # an open write transaction doesn't block readers, who see the last commit
+    writer.execute("BEGIN IMMEDIATE")
+    writer.execute("INSERT INTO t VALUES (2)")
+    assert reader.execute("SELECT count(*) FROM t").fetchone()[0] == 1
+    writer.commit()
+    assert reader.execute("SELECT count(*) FROM t").fetchone()[0] == 2
+  finally:
+    writer.close()
+    reader.close()
+
+
+def test_log2_functions(memory_db):
+  xs = [1.5, 1000.0, -3.0, 1000.0]
+  expected = math.log(sum(2.0 ** (x - 1000) for x in xs), 2) + 1000
+  assert _log2_add(_log2_add(1.5, 1000.0), _log2_add(-3.0, 1000.0)) == pytest.approx(expected)
+  assert _log2_add(None, 2.0) == 2.0
+
+  memory_db.execute("CREATE TABLE t (x REAL)")
+  memory_db.executemany("INSERT INTO t VALUES (?)", [(x,) for x in xs + [None]])
+  assert memory_db.execute("SELECT schist_log2sum(x) FROM t").fetchone()[0] == pytest.approx(expected)
+  assert memory_db.execute("SELECT schist_log2add(2, 2)").fetchone()[0] == pytest.approx(3)
+
+
+def test_write_transaction(tmpdir):
+  path = str(tmpdir.join('lock.sq3'))
+  conn, other = _mk_conn(path), _mk_conn(path, timeout=0)
+  try:
+    conn.execute("CREATE TABLE t (x)")
+    with _write_transaction(conn):
+      # the write lock is ours from the start, before anything is written
+      with pytest.raises(sqlite3.OperationalError):
+        other.execute("BEGIN IMMEDIATE")
+      conn.execute("INSERT INTO t VALUES (1)")
+    assert other.execute("SELECT count(*) FROM t").fetchone()[0] == 1
+
+    with pytest.raises(ZeroDivisionError):
+      with _write_transaction(conn):
+        conn.execute("INSERT INTO t VALUES (2)")
+        1 / 0
+    assert other.execute("SELECT count(*) FROM t").fetchone()[0] == 1
+    assert conn.isolation_level == ''
+  finally:
+    conn.close()
+    other.close()
@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import tempfile
 
+from schist import zsh
 from schist.common import _mk_conn
 
 import pytest
@@ -14,6 +15,29 @@ def memory_db():
   finally:
     conn.close()
 
+@pytest.fixture
+def interned():
+  """whether hist uses the interned layout. a test module can override this
+  with a fixture parametrized over both"""
+  return False
+
+@pytest.fixture
+def hist_conf(memory_db):
+  """the config hist opens, a zsh history on memory_db"""
+  return zsh.CONFIG.evolve(
+    db_path=':memory:', histfile='bogus', db_conn_factory=lambda _: memory_db)
+
+@pytest.fixture
+def hist(request, hist_conf, interned):
+  """hist_conf, open, with the test module's ROWS in it and the rollups up to
+  date"""
+  with hist_conf.open() as hist:
+    hist.create_table(interned=interned)
+    with hist.conn:
+      hist.insert_rows(request.module.ROWS)
+    hist.update_rollups()
+    yield hist
+
 @pytest.fixture(autouse=True)
 def bogus_HOME(tmpdir, monkeypatch):
   monkeypatch.setenv('HOME', str(tmpdir))
@@ -16,9 +16,10 @@ def test_db_Row_iter():
   now = arrow.now()
   row = db.Row(now, 'foo')
 
-  ts, cmd = row
-  assert ts == now
+  ts, cmd, elapsed = row
+  assert ts == now.timestamp
   assert cmd == 'foo'
+  assert elapsed is None
 
 
 @pytest.fixture
@@ -50,3 +51,23 @@ def test_db_HistConfig_open_when_already_open(histconfig):
 def test_db_HistConfig_fails_when_conn_called_and_no_connection(histconfig):
   with pytest.raises(db.NoConnectionError):
     histconfig.conn
+
+
+def test_db_Row_coerces_timestamp_to_int():
+  now = arrow.now()
+  assert db.Row(now, 'foo') == db.Row(now.timestamp, 'foo')
+  assert db.Row(str(now.timestamp), b'foo') == (now.timestamp, u'foo', None)
+  assert db.Row(now, 'foo', '3').elapsed == 3
+  assert db.Row(now, 'foo').arrow == now.floor('second')
+
+
+def test_db_Row_rejects_bad_command():
+  with pytest.raises(TypeError):
+    db.Row(0, object())
+
+
+def test_db_Row_make_skips_coercion():
+  row = db.Row._make((1, u'foo', 2))
+  assert isinstance(row, db.Row)
+  assert row.unix == 1
+  assert row.as_sql_dict() == {'timestamp': 1, 'command': u'foo', 'elapsed': 2}
@@ -0,0 +1,151 @@
+from __future__ import print_function
+
+import math
+import random
+
+from collections import defaultdict
+
+from schist import app, db, frecency, zsh
+
+import pytest
+
+
+START = 1514240734
+DAY = 86400
+
+rnd = random.Random(3)
+ROWS = sorted(
+  [db.Row(START + rnd.randint(0, 60 * DAY), u'git status') for _ in range(200)] +
+  [db.Row(START + rnd.randint(0, 60 * DAY), u'make test {0}'.format(i % 20)) for i in range(300)] +
+  [db.Row(START + 60 * DAY + i, u'gti statsu {0}'.format(i)) for i in range(5)])
+
+
+def brute_usage(rows):
+  runs = defaultdict(list)
+  for r in rows:
+    runs[r.command].append(r.timestamp)
+  return dict(
+    (cmd, (len(ts), min(ts), max(ts),
+      math.log(sum(2.0 ** ((t - START) / float(frecency.HALF_LIFE)) for t in ts), 2) +
+      START / float(frecency.HALF_LIFE)))
+    for cmd, ts in runs.items())
+
+
+def usage(hist):
+  return dict(
+    (r[0], tuple(r[1:])) for r in hist.conn.execute(
+      "SELECT command, count, first_seen, last_seen, score FROM zsh_history_usage"))
+
+
+def assert_usage(hist, rows):
+  found = usage(hist)
+  expected = brute_usage(rows)
+  assert sorted(found) == sorted(expected)
+  for cmd, (n, first, last, score) in expected.items():
+    assert found[cmd][:3] == (n, first, last)
+    assert found[cmd][3] == pytest.approx(score, abs=1e-6)
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'interned'])
+def interned(request):
+  return request.param
+
+
+def test_frecency_usage(hist):
+  assert_usage(hist, ROWS)
+
+
+def test_frecency_update_is_incremental(hist):
+  new = [
+    db.Row(START + 61 * DAY, u'git status'),
+    db.Row(START - DAY, u'git status'),
+    db.Row(START + 62 * DAY, u'brand new'),
+  ]
+  with hist.conn:
+    hist.insert_rows(new)
+    # rows that were already counted are not counted again
+    hist.conn.execute(
+      "UPDATE zsh_history_usage SET count = count + 1000 WHERE command = 'make test 0'")
+
+  hist.update_rollups()
+  assert usage(hist)[u'make test 0'][0] == brute_usage(ROWS)[u'make test 0'][0] + 1000
+  with hist.conn:
+    hist.conn.execute(
+      "UPDATE zsh_history_usage SET count = count - 1000 WHERE command = 'make test 0'")
+  assert_usage(hist, ROWS + new)
+
+
+def test_frecency_search(hist):
+  found = list(hist.search_frecent(u'%stat%', limit=3))
+  # the one run 200 times beats the typos, even though they're the latest
+  assert [r.command for r in found] == [u'git status', u'gti statsu 4', u'gti statsu 3']
+  assert found[0].timestamp == max(r.timestamp for r in ROWS if r.command == u'git status')
+
+  found = [r.command for r in hist.search_frecent(u'make test 1_', limit=100)]
+  assert sorted(found) == [u'make test 1{0}'.format(i) for i in range(10)]
+  scores = usage(hist)
+  assert [scores[c][3] for c in found] == sorted((scores[c][3] for c in found), reverse=True)
+
+  found = [r.command for r in hist.search_frecent(u'^make test 1[0-4]$', limit=100, regex=True)]
+  assert sorted(found) == [u'make test 1{0}'.format(i) for i in range(5)]
+
+
+def test_frecency_search_reads_the_score_index(hist):
+  plan = u' '.join(r[-1] for r in hist.conn.execute(
+    u'EXPLAIN QUERY PLAN ' + frecency.search_sql(hist.table_name),
+    {'term': u'%x%', 'limit': 10}))
+  assert 'zsh_history_usage_score' in plan
+  assert 'TEMP B-TREE' not in plan
+
+
+def test_frecency_recent_beats_old(hist):
+  # the same number of runs, but a month apart
+  with hist.conn:
+    hist.insert_rows(
+      [db.Row(START + i, u'old thing') for i in range(10)] +
+      [db.Row(START + 30 * DAY + i, u'new thing') for i in range(10)])
+  hist.update_rollups()
+  assert [r.command for r in hist.search_frecent(u'% thing')] == [u'new thing', u'old thing']
+
+
+def test_frecency_search_without_usage_table(memory_db):
+  conf = zsh.CONFIG.evolve(
+    db_path=':memory:', histfile='bogus', db_conn_factory=lambda _: memory_db)
+  with conf.open() as hist:
+    hist.create_table()
+    with hist.conn:
+      hist.insert_rows(ROWS)
+    assert not frecency.exists(hist.conn, hist.table_name)
+    assert [r.command for r in hist.search_frecent(u'git%', limit=1)] == [u'git status']
+
+
+def test_frecency_app_search(tmpdir, capsys):
+  hist_path = tmpdir.join('zsh_history')
+  hist_path.write(u''.join(u": {0}:0;{1}\n".format(r.timestamp, r.command) for r in ROWS))
+  db_path = str(tmpdir.join('schist.sq3'))
+  app.main('-d', db_path, 'backup', 'zsh', '-p', str(hist_path))
+  capsys.readouterr()
+
+  app.main('-d', db_path, 'search', '--no-date', '--rank', 'frecency', 'zsh', '--limit', '2',
+    '%stat%')
+  assert capsys.readouterr().out == u'git status\ngti statsu 4\n'
+
+  with pytest.raises(SystemExit):
+    app.main('-d', db_path, 'search', '--fts', '--rank', 'frecency', 'zsh', 'git')
+  assert "--rank can't be used" in capsys.readouterr().err
+
+
+def test_frecency_suggest(hist):
+  top = u'\U0010ffff'
+  with hist.conn:
+    hist.insert_rows([
+      db.Row(START + 70 * DAY, u'echo ' + top + u' done'),
+      db.Row(START + 71 * DAY, u'echo ' + top),
+      # after it, and the latest, but doesn't start with it
+      db.Row(START + 72 * DAY, u'echp'),
+    ])
+  hist.update_rollups()
+
+  assert hist.suggest(u'git st') == u'git status'
+  assert hist.suggest(u'echo ' + top) == u'echo ' + top + u' done'
+  assert hist.suggest(u'echo ' + top + u' done') is None
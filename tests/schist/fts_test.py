@@ -0,0 +1,187 @@
+from __future__ import print_function
+
+import re
+import sqlite3
+
+from schist import app, db, fts
+
+import pytest
+
+
+ROWS = [
+  db.Row(1514240734, 'kubectl get pods -n prod'),
+  db.Row(1514240857, 'git status'),
+  db.Row(1514240860, 'kubectl logs -f web-1 -n prod'),
+  db.Row(1514240862, 'git commit -m "fix prod config"'),
+  db.Row(1514241010, 'kubectl kubectl describe pod web-1'),
+]
+
+
+@pytest.fixture
+def hist(hist):
+  if not fts.fts5_available(hist.conn):
+    pytest.skip("sqlite was built without FTS5")
+  return hist
+
+
+def test_fts_match_query():
+  assert fts.match_query(u'kubectl-prod  a"b') == u'"kubectl-prod" "a""b"'
+  assert fts.match_query(u'kube* *') == u'"kube"*'
+
+
+def test_fts_build_indexes_existing_rows(hist):
+  assert not hist.fts_exists()
+  hist.build_fts()
+  assert hist.fts_exists()
+
+  found = [row for row, _ in hist.search_fts(u'prod')]
+  assert sorted(found) == sorted([ROWS[0], ROWS[2], ROWS[3]])
+
+
+def test_fts_ranks_and_highlights(hist):
+  hist.build_fts()
+
+  found = list(hist.search_fts(u'kubectl', hl_open=u'[', hl_close=u']'))
+  assert [row for row, _ in found][0] == ROWS[4]
+  assert found[0][1] == u'[kubectl] [kubectl] describe pod web-1'
+
+
+def test_fts_stays_in_sync(hist):
+  hist.build_fts()
+
+  with hist.conn:
+    hist.insert_rows([db.Row(1514241020, 'terraform apply -target=prod')])
+    hist.conn.execute("DELETE FROM zsh_history WHERE command = 'git status'")
+
+  assert [row.command for row, _ in hist.search_fts(u'terraform')] == [
+    u'terraform apply -target=prod']
+  assert list(hist.search_fts(u'status')) == []
+
+
+def test_fts_prefix_match(hist):
+  hist.build_fts()
+  assert [row for row, _ in hist.search_fts(u'stat*')] == [ROWS[1]]
+
+
+def test_fts_falls_back_to_like(hist):
+  found = list(hist.search_fts(u'kubectl prod'))
+  assert found == [(ROWS[2], ROWS[2].command), (ROWS[0], ROWS[0].command)]
+
+
+@pytest.mark.parametrize('indexed', [True, False], ids=['fts', 'like'])
+@pytest.mark.parametrize('term', [u'', u'  ', u'*', u'** *'])
+def test_fts_empty_query(hist, indexed, term):
+  assert fts.match_query(term) == u''
+  if indexed:
+    hist.build_fts()
+  assert list(hist.search_fts(term)) == []
+
+
+def test_fts_app_bad_query(hist, tmpdir, capsys, monkeypatch):
+  db_path = str(tmpdir.join('schist.sq3'))
+  app.main('-d', db_path, 'index', 'zsh')
+
+  with pytest.raises(SystemExit) as e:
+    app.main('-d', db_path, 'search', '--fts', 'zsh', '*')
+  assert e.value.code == 1
+  assert 'no results' in capsys.readouterr().err
+
+  def bad(self, term, *args, **kw):
+    raise sqlite3.OperationalError('fts5: syntax error near ""')
+    yield
+  monkeypatch.setattr(db.HistConfig, 'search_fts', bad)
+  with pytest.raises(SystemExit) as e:
+    app.main('-d', db_path, 'search', '--fts', 'zsh', 'x')
+  assert e.value.code == 2
+  assert 'bad full text query' in capsys.readouterr().err
+
+
+def test_fts_drop(hist):
+  hist.build_fts()
+  hist.drop_fts()
+  assert not hist.fts_exists()
+
+  # the triggers went with it
+  with hist.conn:
+    hist.insert_rows([db.Row(1514241020, 'ls')])
+
+
+def test_fts_literal_runs():
+  assert fts.literal_runs(u'%kubectl%prod%') == [u'kubectl', u'prod']
+  assert fts.literal_runs(u'git_st%s') == [u'git']
+  assert fts.literal_runs(u'%ls%') == []
+
+
+def test_fts_trigram_query():
+  assert fts.trigram_query([u'kubectl', u'a"b c']) == u'"kubectl" AND "a""b c"'
+
+
+@pytest.fixture
+def trigram_hist(hist):
+  if not hist.trigram_available():
+    pytest.skip("sqlite has no trigram tokenizer")
+  hist.build_trigram()
+  yield hist
+
+
+@pytest.mark.parametrize('term', [
+  u'%kubectl%prod%',
+  u'%KUBECTL%',
+  u'kubectl%',
+  u'%web-_%',
+  u'git%',
+  u'%pod%',
+  u'%t%',
+  u'%prod"%',
+  u'%nope%',
+])
+def test_fts_trigram_search_matches_like(trigram_hist, term):
+  expected = list(trigram_hist._select_rows(
+    "SELECT timestamp, command FROM zsh_history WHERE command LIKE ? ORDER BY timestamp DESC",
+    (term,)))
+  assert list(trigram_hist.search(term)) == expected
+
+
+def test_fts_trigram_search_uses_index(trigram_hist):
+  plan = trigram_hist.conn.execute(
+      "EXPLAIN QUERY PLAN " + fts.trigram_search_sql('zsh_history'),
+      {'query': u'"kubectl"', 'term': u'%kubectl%', 'limit': 25}
+    ).fetchall()
+  assert any('zsh_history_trigram VIRTUAL TABLE' in r[-1] for r in plan)
+
+
+def test_fts_trigram_stays_in_sync(trigram_hist):
+  with trigram_hist.conn:
+    trigram_hist.insert_rows([db.Row(1514241020, 'terraform apply -target=prod')])
+  assert list(trigram_hist.search(u'%form%target%')) == [
+    db.Row(1514241020, 'terraform apply -target=prod')]
+
+
+REGEXES = [
+  u'kubectl.*-n prod',
+  u'^git (status|commit)',
+  u'web-\\d',
+  u'(?i)KUBECTL\\s+logs',
+  u'"[a-z]+ prod',
+  u'nope',
+]
+
+
+def _python_regex_search(pattern):
+  r = re.compile(pattern)
+  return sorted((row for row in ROWS if r.search(row.command)), reverse=True)
+
+
+@pytest.mark.parametrize('pattern', REGEXES)
+def test_regex_search(hist, pattern):
+  assert list(hist.search_regex(pattern)) == _python_regex_search(pattern)
+
+
+@pytest.mark.parametrize('pattern', REGEXES)
+def test_regex_search_with_trigram(trigram_hist, pattern):
+  assert list(trigram_hist.search_regex(pattern)) == _python_regex_search(pattern)
+
+
+def test_regex_search_bad_pattern(hist):
+  with pytest.raises(re.error):
+    list(hist.search_regex(u'(unclosed'))
@@ -0,0 +1,63 @@
+from __future__ import print_function
+
+from schist import db, zsh
+
+import pytest
+
+
+def zsh_lines(rows):
+  return u''.join(u": {0}:{2};{1}\n".format(*r) for r in rows)
+
+
+OLD = [db.Row(1400000000 + i, u'cmd {0}'.format(i % 7), i % 3) for i in range(250)]
+NEW = OLD[200:] + [db.Row(1500000000 + i, u'new {0}'.format(i), 0) for i in range(100)]
+
+
+@pytest.fixture
+def histfiles(tmpdir):
+  old, new = tmpdir.join('old_history'), tmpdir.join('new_history')
+  old.write(zsh_lines(OLD))
+  new.write(zsh_lines(NEW))
+  return [str(old), str(new)]
+
+
+@pytest.fixture
+def hist(tmpdir):
+  conf = zsh.CONFIG.evolve(db_path=str(tmpdir.join('schist.sq3')), histfile='bogus')
+  with conf.open() as hist:
+    hist.init_db()
+    yield hist
+
+
+def test_bulk_import(hist, histfiles):
+  calls = []
+  added = hist.bulk_import(
+      histfiles, batch_size=40, progress=lambda *a: calls.append(a))
+
+  assert added == 350
+  assert list(hist.rows()) == sorted(set(OLD + NEW))
+  assert hist.total_count() == 350
+
+  assert [c[0] for c in calls][-1] == len(OLD) + len(NEW)
+  assert calls[-1][1] == 350
+  assert len(calls) == 7 + 4
+
+
+def test_bulk_import_restores_pragmas(hist, histfiles):
+  hist.bulk_import(histfiles)
+  assert hist.conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+  assert hist.conn.execute("PRAGMA synchronous").fetchone()[0] == 2
+
+
+def test_bulk_import_rebuilds_indexes(hist, histfiles):
+  hist.migrate_to_interned()
+  if hist.trigram_available():
+    hist.build_trigram()
+
+  hist.bulk_import(histfiles, rebuild_indexes=True)
+
+  assert sorted(name for name, _ in hist._secondary_indexes()) == [
+    'zsh_history_command_id', 'zsh_history_elapsed']
+  assert len(list(hist.search(u'%new 9%', limit=100))) == 11
+  if hist.trigram_available():
+    assert hist.trigram_exists()
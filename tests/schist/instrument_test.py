@@ -0,0 +1,127 @@
+from __future__ import print_function
+
+import json
+import logging
+import pstats
+import time
+
+from schist import app, instrument
+from schist.common import _mk_conn
+
+import pytest
+
+
+@pytest.fixture
+def profile():
+  p = instrument.enable()
+  try:
+    yield p
+  finally:
+    instrument.disable()
+
+
+def phases(profile):
+  return dict((d['phase'], d) for d in profile.report())
+
+
+def test_instrument_off_by_default():
+  assert instrument._profile is None
+  with instrument.span('nothing') as sp:
+    sp.rows = 10
+  it = iter([1, 2])
+  assert instrument.timed_iter('nothing', it) is it
+
+
+def test_instrument_nested_spans(profile):
+  with instrument.span('outer') as outer:
+    with instrument.span('inner') as inner:
+      time.sleep(0.02)
+      inner.rows = 5
+    with instrument.span('inner'):
+      pass
+    outer.rows = 7
+
+  found = phases(profile)
+  assert found['inner']['calls'] == 2
+  assert found['inner']['rows'] == 5
+  assert found['outer']['rows'] == 7
+  assert found['outer']['seconds'] >= found['inner']['seconds'] >= 0.02
+  assert found['outer']['self_seconds'] < 0.02
+  assert found['total']['seconds'] >= found['outer']['seconds']
+
+
+def test_instrument_timed_iter_is_charged_to_its_consumer(profile):
+  def slow():
+    for i in range(3):
+      time.sleep(0.01)
+      yield i
+
+  with instrument.span('consume'):
+    assert list(instrument.timed_iter('produce', slow())) == [0, 1, 2]
+
+  found = phases(profile)
+  assert found['produce']['rows'] == 3
+  assert found['produce']['seconds'] >= 0.03
+  assert found['consume']['self_seconds'] < found['produce']['seconds']
+
+
+def test_instrument_backup_profile(tmpdir, capsys):
+  hist_path = tmpdir.join('zsh_history')
+  hist_path.write(u''.join(u": {0}:0;cmd {1}\n".format(1500000000 + i, i % 9) for i in range(500)))
+  out = str(tmpdir.join('backup.prof'))
+
+  app.main(
+    '--profile', '--profile-out', out, '-d', str(tmpdir.join('schist.sq3')),
+    'backup', 'zsh', '-p', str(hist_path))
+
+  found = {}
+  for line in capsys.readouterr().err.splitlines():
+    if line.startswith('{'):
+      d = json.loads(line)
+      found[d['phase']] = d
+
+  assert set(['pending', 'parse', 'insert_rows', 'commit', 'rollups', 'optimize', 'total']) <= set(found)
+  assert found['parse']['rows'] == 500
+  assert found['insert_rows']['rows'] == 500
+  assert found['insert_rows']['rows_per_sec'] > 0
+
+  assert pstats.Stats(out).total_calls > 0
+  assert instrument._profile is None
+
+
+def test_instrument_trace_sql(tmpdir, caplog):
+  caplog.set_level(logging.INFO, logger='schist.instrument.sql')
+  instrument.trace_sql()
+  try:
+    conn = _mk_conn(str(tmpdir.join('trace.sq3')))
+  finally:
+    instrument.trace_sql(False)
+
+  with conn:
+    conn.execute("CREATE TABLE t (x)")
+    conn.executemany("INSERT INTO t (x)\n  VALUES (?)", ((i,) for i in range(3)))
+  cur = conn.cursor()
+  cur.execute("SELECT count(*) FROM t")
+  assert cur.fetchone()[0] == 3
+  conn.close()
+
+  logged = [r.getMessage().split('ms ', 1)[1] for r in caplog.records]
+  assert logged == [
+    'PRAGMA auto_vacuum = INCREMENTAL',
+    'PRAGMA journal_mode=WAL',
+    'CREATE TABLE t (x)',
+    'INSERT INTO t (x) VALUES (?) (x3)',
+    'COMMIT',
+    'SELECT count(*) FROM t',
+  ]
+
+  assert not isinstance(_mk_conn(':memory:'), instrument.TracingConnection)
+
+
+def test_instrument_trace_sql_logs(tmpdir, capsys):
+  app.main('--trace-sql', '-d', str(tmpdir.join('schist.sq3')), 'stats', 'zsh', '--histogram', 'day')
+
+  err = capsys.readouterr().err
+  assert 'ms PRAGMA journal_mode=WAL' in err
+  assert 'ms SELECT' in err
+  assert not instrument.tracing_sql()
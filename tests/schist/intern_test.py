@@ -0,0 +1,150 @@
+from __future__ import print_function
+
+import os
+
+from io import StringIO
+
+from schist import db, zsh
+from schist.common import _mk_conn
+
+import pytest
+
+
+ROWS = [
+  db.Row(1514240734 + i, cmd)
+  for i, cmd in enumerate(
+    ['tox', 'git status', 'kubectl get pods -n prod', 'git status', 'tox', 'ls'] * 3)
+]
+
+
+def mk_config(conn):
+  return zsh.CONFIG.evolve(
+      db_path=":memory:",
+      histfile="bogus",
+      db_conn_factory=lambda _: conn,
+    )
+
+
+@pytest.fixture
+def plain(memory_db):
+  with mk_config(memory_db).open() as hist:
+    hist.create_table()
+    with hist.conn:
+      hist.insert_rows(ROWS)
+    yield hist
+
+
+@pytest.fixture
+def interned():
+  conn = _mk_conn(":memory:")
+  try:
+    with mk_config(conn).open() as hist:
+      hist.migrate_to_interned()
+      with hist.conn:
+        hist.insert_rows(ROWS)
+      yield hist
+  finally:
+    conn.close()
+
+
+def restored(hist):
+  sio = StringIO()
+  hist.restore(sio)
+  return sio.getvalue()
+
+
+def test_interned_storage(interned):
+  assert interned.is_interned()
+  assert interned.count() == len(ROWS)
+  assert interned.conn.execute(
+    "SELECT count(*) FROM zsh_history_commands").fetchone()[0] == 4
+
+
+def test_interned_insert_is_idempotent(interned):
+  with interned.conn:
+    assert interned.insert_rows(ROWS) == 0
+    assert interned.insert_rows([db.Row(1, 'tox'), db.Row(2, 'new')]) == 2
+  assert interned.count() == len(ROWS) + 2
+
+
+def test_interned_matches_plain(plain, interned):
+  assert list(interned.rows()) == list(plain.rows()) == ROWS
+  assert list(interned.rows(limit=2)) == ROWS[:2]
+  assert restored(interned) == restored(plain)
+  assert list(interned.search(u'%git%')) == list(plain.search(u'%git%'))
+  assert list(interned.search_regex(u'^k.*prod$')) == list(plain.search_regex(u'^k.*prod$'))
+
+
+def test_interned_search_indexes(plain, interned):
+  for hist in (plain, interned):
+    if not hist.trigram_available():
+      pytest.skip("sqlite has no trigram tokenizer")
+    hist.build_fts()
+    hist.build_trigram()
+
+  assert list(interned.search(u'%ubectl%')) == list(plain.search(u'%ubectl%'))
+  assert sorted(interned.search_fts(u'git')) == sorted(plain.search_fts(u'git'))
+
+  with interned.conn:
+    interned.insert_rows([db.Row(1514250000, 'terraform plan')])
+  assert [r.command for r in interned.search(u'%terraform%')] == [u'terraform plan']
+
+
+def test_migrate_to_interned(plain):
+  before = list(plain.rows())
+  rowids = plain.conn.execute("SELECT rowid FROM zsh_history ORDER BY rowid").fetchall()
+
+  if plain.trigram_available():
+    plain.build_trigram()
+
+  plain.migrate_to_interned()
+
+  assert plain.is_interned()
+  assert list(plain.rows()) == before
+  assert plain.conn.execute(
+    "SELECT rowid FROM zsh_history ORDER BY rowid").fetchall() == rowids
+
+  if plain.trigram_available():
+    assert plain.trigram_exists()
+    assert list(plain.search(u'%kubectl%')) == [r for r in reversed(ROWS) if 'kubectl' in r.command]
+
+  # and a second time is a no-op
+  plain.migrate_to_interned()
+  assert list(plain.rows()) == before
+
+
+def test_migrate_to_interned_keeps_hosts(plain):
+  plain.add_host_column()
+  with plain.conn:
+    plain.conn.execute("UPDATE zsh_history SET host = 'laptop' WHERE command = 'tox'")
+  hosts = plain.conn.execute(
+    "SELECT rowid, host FROM zsh_history ORDER BY rowid").fetchall()
+
+  plain.migrate_to_interned()
+
+  assert plain.has_host_column()
+  assert plain.conn.execute(
+    "SELECT rowid, host FROM zsh_history ORDER BY rowid").fetchall() == hosts
+  assert plain.conn.execute(
+    "SELECT count(*) FROM zsh_history WHERE host = 'laptop'").fetchone()[0] == 6
+
+
+def test_interned_db_is_smaller(tmpdir):
+  cmd = u'docker run --rm -it -v "$PWD":/src -w /src python:3.6 python -m pytest {0}'
+  rows = [db.Row(1514240734 + i, cmd.format(i % 50)) for i in range(5000)]
+
+  sizes = {}
+  for interned in (False, True):
+    path = str(tmpdir.join('{0}.sq3'.format(interned)))
+    conn = _mk_conn(path)
+    try:
+      with mk_config(conn).open() as hist:
+        hist.create_table(interned=interned)
+        with hist.conn:
+          hist.insert_rows(rows)
+        hist.conn.execute("VACUUM")
+    finally:
+      conn.close()
+    sizes[interned] = os.path.getsize(path)
+
+  assert sizes[True] * 3 < sizes[False]
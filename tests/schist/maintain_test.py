@@ -0,0 +1,139 @@
+from __future__ import print_function
+
+import json
+
+from schist import app, db, maintain, zsh
+
+import pytest
+
+
+START = 1514240734
+DAY = 86400
+
+ROWS = [db.Row(START + i * 600, u'make test {0}'.format(i % 50)) for i in range(5000)]
+
+
+def open_hist(path):
+  return zsh.CONFIG.evolve(db_path=path, histfile='bogus').open()
+
+
+@pytest.fixture
+def db_path(tmpdir):
+  path = str(tmpdir.join('schist.sq3'))
+  with open_hist(path) as hist:
+    hist.init_db()
+    with hist.conn:
+      hist.insert_rows(ROWS)
+    hist.update_rollups()
+  return path
+
+
+def test_maintain_new_dbs_are_incremental(db_path):
+  with open_hist(db_path) as hist:
+    assert maintain.auto_vacuum(hist.conn) == maintain.INCREMENTAL
+
+
+def test_maintain_enable_incremental(db_path):
+  with open_hist(db_path) as hist:
+    # what a db from before looks like
+    hist.conn.execute("PRAGMA auto_vacuum = NONE")
+    hist.conn.execute("VACUUM")
+    assert maintain.auto_vacuum(hist.conn) == 0
+
+    if hist.trigram_available():
+      hist.build_trigram()
+    with hist.conn:
+      hist.insert_rows([db.Row(START + 100 * DAY, u'not rolled up yet')])
+    hist.archive(START + 20 * DAY)
+    assert hist.conn.execute("PRAGMA freelist_count").fetchone()[0] > 0
+
+    found = list(hist.search(u'make test 1%', 100))
+    total = hist.total_count()
+
+    assert maintain.enable_incremental([hist])
+    assert maintain.auto_vacuum(hist.conn) == maintain.INCREMENTAL
+    assert hist.conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    assert list(hist.search(u'make test 1%', 100)) == found
+    assert hist.total_count() == total == len(ROWS) + 1
+
+    assert not maintain.enable_incremental([hist])
+
+
+def test_maintain_renumbered(db_path):
+  with open_hist(db_path) as hist:
+    if hist.trigram_available():
+      hist.build_trigram()
+
+    with hist.conn:
+      hist.conn.execute("UPDATE zsh_history SET rowid = rowid + 100000")
+    maintain.renumbered(hist)
+
+    with hist.conn:
+      hist.insert_rows([db.Row(START + 100 * DAY, u'make test new')])
+    hist.update_rollups()
+    # not counted twice
+    assert hist.total_count() == len(ROWS) + 1
+    assert [r.command for r in hist.search(u'make test n%', 1)] == [u'make test new']
+    assert len(list(hist.search(u'make test 1_', 1000))) == 1000
+
+
+def test_maintain_incremental_vacuum(db_path):
+  with open_hist(db_path) as hist:
+    hist.archive(START + 30 * DAY)
+    free = hist.conn.execute("PRAGMA freelist_count").fetchone()[0]
+    assert free > 5
+
+    assert maintain.incremental_vacuum(hist.conn, 5) == 5
+    assert maintain.incremental_vacuum(hist.conn, 0) == free - 5
+    assert hist.conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+
+
+def test_maintain_analyze_on_drift(db_path):
+  with open_hist(db_path) as hist:
+    found = maintain.analyze(hist.conn)
+    assert ('zsh_history', len(ROWS), None) in found
+    assert maintain.drifted(hist.conn) == []
+
+    with hist.conn:
+      hist.insert_rows([db.Row(START - i, u'older') for i in range(1, 500)])
+    assert 'zsh_history' not in [t for t, _, _ in maintain.drifted(hist.conn)]
+
+    with hist.conn:
+      hist.insert_rows([db.Row(START - i, u'older') for i in range(500, 2000)])
+    assert ('zsh_history', len(ROWS) + 1999, len(ROWS)) in maintain.drifted(hist.conn)
+
+
+def test_maintain_space(db_path):
+  with open_hist(db_path) as hist:
+    report = maintain.space(hist.conn)
+    assert report['auto_vacuum'] == 'incremental'
+    assert report['pages'] > report['free_pages'] >= 0
+    if not maintain.dbstat_available(hist.conn):
+      assert report['sizes'] is None
+    else:
+      sizes = dict(report['sizes'])
+      assert sizes['zsh_history'] > 0
+      # less the pointer map pages auto_vacuum keeps
+      assert sum(sizes.values()) <= (report['pages'] - report['free_pages']) * report['page_size']
+
+
+def test_maintain_app(db_path, capsys):
+  app.main('-d', db_path, 'maintain', 'all')
+  out = capsys.readouterr().out
+  assert 'auto_vacuum' in out and 'incremental' in out
+
+  app.main('-d', db_path, 'maintain', 'zsh', '--report')
+  assert 'free pages' in capsys.readouterr().out
+
+
+def test_maintain_no_optimize_on_reads(db_path, capsys):
+  def phases(*args):
+    capsys.readouterr()
+    app.main('--profile', '-d', db_path, *args)
+    return set(
+      json.loads(line)['phase'] for line in capsys.readouterr().err.splitlines()
+      if line.startswith('{'))
+
+  assert 'optimize' not in phases('search', 'zsh', 'make%')
+  assert 'optimize' not in phases('restore', '-', 'zsh')
+  assert 'optimize' in phases('archive', 'zsh', '--before', '2018-01-01')
@@ -0,0 +1,117 @@
+from __future__ import print_function
+
+import os.path
+
+from schist import app, db, merge, zsh
+from schist.common import _mk_conn
+
+import pytest
+
+
+LAPTOP = [db.Row(1514240734 + i, u'cmd {0}'.format(i % 5), i % 4) for i in range(20)]
+DESKTOP = LAPTOP[10:] + [db.Row(1514250000 + i, u'desk {0}'.format(i % 3)) for i in range(10)]
+
+
+def mk_db(path, rows, interned=False):
+  conf = zsh.CONFIG.evolve(db_path=str(path), histfile='bogus')
+  with conf.open() as hist:
+    hist.create_table(interned=interned)
+    with hist.conn:
+      hist.insert_rows(rows)
+  return str(path)
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'interned'])
+def sources(request, tmpdir):
+  return [
+    mk_db(tmpdir.join('laptop.sq3'), LAPTOP, interned=request.param),
+    mk_db(tmpdir.join('desktop.sq3'), DESKTOP, interned=not request.param),
+  ]
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'interned'])
+def hist(request, tmpdir):
+  conf = zsh.CONFIG.evolve(db_path=str(tmpdir.join('main.sq3')), histfile='bogus')
+  with conf.open() as hist:
+    hist.create_table(interned=request.param)
+    yield hist
+
+
+def test_merge(hist, sources):
+  assert hist.merge(sources[0]) == len(LAPTOP)
+  assert hist.merge(sources[1]) == len(DESKTOP) - 10
+
+  assert sorted(hist.rows()) == sorted(set(LAPTOP + DESKTOP))
+  assert list(hist.rows())[:len(LAPTOP)] == LAPTOP
+  assert hist.total_count() == len(LAPTOP) + len(DESKTOP) - 10
+
+  # and it's safe to run again
+  assert hist.merge(sources[0]) == 0
+  assert hist.merge(sources[1]) == 0
+  assert hist.count() == len(LAPTOP) + len(DESKTOP) - 10
+
+
+def test_merge_record_host(hist, sources, tmpdir):
+  with hist.conn:
+    hist.insert_rows([db.Row(1, u'local')])
+
+  hist.merge(sources[0], record_host=True)
+  hist.merge(sources[1], record_host=True)
+
+  hosts = dict(hist.conn.execute(
+    "SELECT host, count(*) FROM zsh_history GROUP BY host").fetchall())
+  assert hosts == {None: 1, u'laptop': len(LAPTOP), u'desktop': len(DESKTOP) - 10}
+
+  # merging a merged db keeps the hosts it recorded
+  other = zsh.CONFIG.evolve(db_path=str(tmpdir.join('other.sq3')), histfile='bogus')
+  with other.open() as o:
+    o.init_db()
+    o.merge(hist.db_path, record_host=True)
+    hosts = dict(o.conn.execute(
+      "SELECT host, count(*) FROM zsh_history GROUP BY host").fetchall())
+  assert hosts == {u'main': 1, u'laptop': len(LAPTOP), u'desktop': len(DESKTOP) - 10}
+
+
+def test_merge_skips_missing_table(hist, tmpdir):
+  path = str(tmpdir.join('empty.sq3'))
+  _mk_conn(path).close()
+  assert hist.merge(path) == 0
+
+
+def test_merge_into_itself(hist):
+  with hist.conn:
+    hist.insert_rows(LAPTOP)
+  assert hist.merge(hist.db_path) == 0
+
+
+def test_merge_missing_source(hist, tmpdir, capsys):
+  path = str(tmpdir.join('nope.sq3'))
+  with pytest.raises(merge.MergeError):
+    hist.merge(path)
+  assert not os.path.exists(path)
+
+  with pytest.raises(SystemExit) as e:
+    app.main('-d', hist.db_path, 'merge', 'zsh', path)
+  assert e.value.code == 1
+  assert "can't read" in capsys.readouterr().err
+  assert not os.path.exists(path)
+
+
+def test_merge_archived_source(hist, sources):
+  path = sources[0]
+  with zsh.CONFIG.evolve(db_path=path, histfile='bogus').open() as src:
+    src.update_rollups()
+    src.archive(LAPTOP[15].timestamp)
+    assert src.archive_totals()[1] == 15
+    expected = list(src.rows())
+
+  assert hist.merge(path) == len(LAPTOP)
+  assert hist.count() == hist.total_count() == len(LAPTOP)
+  assert list(hist.rows()) == expected
+
+  assert hist.merge(path) == 0
+  # nor the ones we've archived ourselves since
+  hist.archive(LAPTOP[10].timestamp)
+  assert hist.merge(path) == 0
+  assert hist.count() == hist.total_count() == len(LAPTOP)
+  assert list(hist.rows()) == expected
@@ -0,0 +1,196 @@
+from __future__ import print_function
+
+import os.path
+
+from schist import app, bash, parallel, zsh
+from schist.common import _mk_conn
+
+import pytest
+
+
+def zsh_lines(host, n, start=1514240734):
+  return u''.join(u": {0}:0;echo {1} {2}\n".format(start + i, host, i) for i in range(n))
+
+
+def bash_lines(host, n, start=1514240734):
+  return u''.join(u"#{0}\necho {1} {2}\n".format(start + i, host, i) for i in range(n))
+
+
+@pytest.fixture
+def histdir(tmpdir):
+  d = tmpdir.mkdir('hist')
+  for i in range(4):
+    d.join('zsh_{0}'.format(i)).write(zsh_lines('z{0}'.format(i), 500))
+  for i in range(3):
+    d.join('bash_{0}'.format(i)).write(bash_lines('b{0}'.format(i), 300))
+  d.join('notes.txt').write(u'not a history file\n')
+  return d
+
+
+@pytest.fixture
+def hists(memory_db):
+  confs = [
+    c.evolve(db_path=':memory:', db_conn_factory=lambda _: memory_db)
+    for c in (zsh.CONFIG, bash.CONFIG)
+  ]
+  with confs[0].open() as z:
+    b = confs[1].evolve(conn=z.conn)
+    z.create_table()
+    b.create_table()
+    yield z, b
+
+
+def commands(hist):
+  return sorted(r.command for r in hist.rows())
+
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_backup_many_files(histdir, hists, processes):
+  z, b = hists
+  files = (
+    [z.evolve(histfile=str(histdir.join('zsh_{0}'.format(i)))) for i in range(4)] +
+    [b.evolve(histfile=str(histdir.join('bash_{0}'.format(i)))) for i in range(3)])
+
+  added = parallel.backup(files, processes=processes, batch_size=128)
+  assert added == [500] * 4 + [300] * 3
+  assert z.count() == 2000
+  assert b.count() == 900
+  assert z.total_count() == 2000
+  assert 'echo z3 499' in commands(z)
+  assert 'echo b2 299' in commands(b)
+
+  # checkpoints were written, so nothing gets parsed again
+  assert parallel.backup(files, processes=processes) == [0] * 7
+
+  histdir.join('zsh_2').write(zsh_lines('more', 10, start=1600000000), mode='a')
+  assert parallel.backup(files, processes=processes) == [0, 0, 10, 0, 0, 0, 0]
+  assert z.count() == 2010
+
+
+def test_backup_matches_serial_insert(histdir, hists, tmpdir):
+  z, _ = hists
+  path = str(histdir.join('zsh_0'))
+  parallel.backup([z.evolve(histfile=path)], processes=4)
+
+  conn = _mk_conn(':memory:')
+  try:
+    with zsh.CONFIG.evolve(
+        db_path=':memory:', histfile=path, db_conn_factory=lambda _: conn).open() as serial:
+      serial.init_db()
+      serial.insert()
+      assert list(serial.rows()) == list(z.rows())
+  finally:
+    conn.close()
+
+
+def test_backup_skips_missing_files(hists, tmpdir):
+  z, _ = hists
+  assert parallel.backup([z.evolve(histfile=str(tmpdir.join('nope')))]) == [0]
+
+
+def test_detect(histdir, hists):
+  z, b = hists
+  assert parallel.detect(str(histdir.join('zsh_1')), [z, b]) is z
+  assert parallel.detect(str(histdir.join('bash_1')), [z, b]) is b
+  assert parallel.detect(str(histdir.join('notes.txt')), [z, b]) is None
+
+
+def test_backup_all_glob(histdir, tmpdir):
+  db_path = str(tmpdir.join('schist.sq3'))
+  app.main(
+    '-d', db_path, 'backup', 'all', '--glob', os.path.join(str(histdir), '*'), '-j', '2')
+
+  conn = _mk_conn(db_path)
+  try:
+    assert conn.execute("SELECT count(*) FROM zsh_history").fetchone()[0] == 2000
+    assert conn.execute("SELECT count(*) FROM bash_history").fetchone()[0] == 900
+  finally:
+    conn.close()
+
+
+def bash_with_multiline(n):
+  lines = []
+  for i in range(n):
+    lines.append(u"#{0}\n".format(1514240734 + i))
+    lines.append(u"echo {0}\n".format(i))
+    if i % 7 == 0:
+      lines.append(u"  | grep {0}\n".format(i))
+    if i % 11 == 0:
+      # a timestamp with no command, which is skipped
+      lines.append(u"#{0}\n".format(1514240734 + i))
+  return u''.join(lines)
+
+
+@pytest.mark.parametrize('mod, text', [
+  (zsh, zsh_lines('big', 3000)),
+  (bash, bash_with_multiline(3000)),
+], ids=['zsh', 'bash'])
+@pytest.mark.parametrize('chunk_size', [1, 100, 4096, 1 << 20])
+def test_parse_chunked_matches_serial(tmpdir, mod, text, chunk_size):
+  path = tmpdir.join('hist')
+  path.write(text)
+
+  with open(str(path), 'rb') as fp:
+    serial = [tuple(r) for r in mod.history_iter(fp)]
+
+  chunked = list(parallel.parse_chunked(
+    str(path), mod.history_iter, mod._RECORD_START, processes=3, chunk_size=chunk_size))
+  assert chunked == serial
+
+
+def test_split_aligns_on_records(tmpdir):
+  path = tmpdir.join('hist')
+  path.write(bash_with_multiline(200))
+  size = path.size()
+
+  with open(str(path), 'rb') as fp:
+    chunks = parallel.split(fp, 0, size, bash._RECORD_START, chunk_size=500)
+    assert chunks[0][0] == 0
+    assert chunks[-1][1] == size
+    assert all(a[1] == b[0] for a, b in zip(chunks, chunks[1:]))
+    for start, _ in chunks:
+      fp.seek(start)
+      assert bash._RECORD_START.match(fp.readline())
+
+    assert parallel.split(fp, 10, 10, bash._RECORD_START) == []
+
+
+def zsh_with_continuations(n):
+  # the second line of each entry looks like the start of one
+  return u''.join(
+    u": {0}:0;echo {1} \\\n: {0}:0;not an entry {1}\n".format(1514240734 + i, i)
+    for i in range(n))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100, 4096])
+def test_split_skips_continuation_lines(tmpdir, chunk_size):
+  path = tmpdir.join('hist')
+  path.write(zsh_with_continuations(300))
+  size = path.size()
+
+  with open(str(path), 'rb') as fp:
+    for start, _ in parallel.split(fp, 0, size, zsh._RECORD_START, chunk_size=chunk_size):
+      fp.seek(start)
+      assert b'not an entry' not in fp.readline()
+
+    fp.seek(0)
+    serial = [tuple(r) for r in zsh.history_iter(fp)]
+  assert len(serial) == 300
+
+  chunked = list(parallel.parse_chunked(
+    str(path), zsh.history_iter, zsh._RECORD_START, processes=3, chunk_size=chunk_size,
+    range_iter_fn=zsh.history_range))
+  assert chunked == serial
+
+
+def test_insert_splits_big_files(tmpdir, memory_db, monkeypatch):
+  monkeypatch.setattr(parallel, 'CHUNK_SIZE', 1024)
+  path = tmpdir.join('zsh_history')
+  path.write(zsh_lines('big', 2000))
+
+  conf = zsh.CONFIG.evolve(
+    db_path=':memory:', histfile=str(path), db_conn_factory=lambda _: memory_db)
+  with conf.open() as hist:
+    hist.init_db()
+    assert hist.insert(processes=2) == 2000
+    assert [r.command for r in hist.rows(limit=2)] == [u'echo big 0', u'echo big 1']
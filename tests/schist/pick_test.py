@@ -0,0 +1,178 @@
+from __future__ import print_function
+
+import random
+
+from schist import app, db, pick, zsh
+from schist.common import _mk_conn
+
+import pytest
+
+
+COMMANDS = [
+  u'git status',
+  u'grep -r TODO src',
+  u'git stash pop',
+  u'vim setup.py',
+  u'python -m pytest tests/schist/pick_test.py',
+  u'kubectl get pods -n prod',
+  u'cat /etc/hosts',
+  u'echo résumé',
+  u'for f in *.py; do\n  echo $f\ndone',
+]
+
+
+def test_pick_score():
+  assert pick.score(u'gst', u'git status') is not None
+  assert pick.score(u'gst', u'git stash') is not None
+  assert pick.score(u'sg', u'git status') is None
+  assert pick.score(u'', u'anything') == 0
+
+  # start of the command beats the start of a word beats the middle of one
+  assert pick.score(u'sta', u'status') < pick.score(u'sta', u'git status')
+  assert pick.score(u'sta', u'git status') < pick.score(u'sta', u'restart')
+  # and a substring beats the same letters spread out
+  assert pick.score(u'stat', u'git status') < pick.score(u'stat', u'git stash at')
+  # even when the spread out ones come first
+  assert pick.score(u'ab', u'a-x-b ab') == pick.score(u'ab', u'xx ab')
+
+
+def test_pick_smart_case():
+  assert pick.score(u'todo', u'grep -r TODO src') is not None
+  assert pick.score(u'TODO', u'grep -r TODO src') is not None
+  assert pick.score(u'Todo', u'grep -r TODO src') is None
+
+
+def test_pick_ranking():
+  p = pick.Picker(COMMANDS, limit=3)
+  assert p.results() == COMMANDS[:3]
+  assert p.count() == len(COMMANDS)
+
+  p.set_query(u'gst')
+  # both score the same, so the more recent one wins
+  assert p.results()[:2] == [u'git status', u'git stash pop']
+
+  p.set_query(u'pods')
+  assert p.results()[0] == u'kubectl get pods -n prod'
+
+  p.set_query(u'sumé')
+  assert p.results() == [u'echo résumé']
+
+  p.set_query(u'do echo')
+  assert p.results() == [COMMANDS[-1]]
+
+  p.set_query(u'zzz')
+  assert p.results() == []
+  assert p.count() == 0
+  assert p.choice() is None
+
+
+def test_pick_incremental_matches_from_scratch():
+  rng = random.Random(7)
+  words = [u'git', u'status', u'stash', u'push', u'pytest', u'kubectl', u'Make', u'ls', u'-la']
+  commands = [u' '.join(rng.choice(words) for _ in range(rng.randint(1, 4))) for _ in range(500)]
+
+  p = pick.Picker(commands, limit=10)
+  for key in [u'g', u'i', u't', u' ', u's', None, None, u'p', u'M', None, None, None, u'k', u'l']:
+    if key is None:
+      p.backspace()
+    else:
+      p.type(key)
+    fresh = pick.Picker(commands, limit=10)
+    fresh.set_query(p.query)
+    assert (p.query, p.count(), p.results()) == (fresh.query, fresh.count(), fresh.results())
+
+  assert p.query == u'gikl'
+  assert [q for q, _ in p._stack] == [u'', u'g', u'gi', u'gik', u'gikl']
+
+
+def test_pick_only_refilters_previous_matches(monkeypatch):
+  p = pick.Picker(COMMANDS)
+  seen = []
+  real = p._filter
+  monkeypatch.setattr(p, '_filter', lambda q, matches: seen.append(len(matches)) or real(q, matches))
+
+  p.type(u'g')
+  matched = p.count()
+  p.type(u'i')
+  p.backspace()
+  assert seen == [len(COMMANDS), matched]
+  assert matched < len(COMMANDS)
+
+
+def test_pick_editing():
+  p = pick.Picker(COMMANDS)
+  p.type(u'git sta')
+  p.delete_word()
+  assert p.query == u'git '
+  p.delete_word()
+  assert p.query == u''
+  p.type(u'x')
+  p.clear()
+  assert p.query == u''
+
+
+def test_pick_keys():
+  chunks = [u'gi', u't\x7f\x1b[Bé\x1b[A\x1b[1;5C\x1bOB', u'\x01\x15\r']
+  assert list(pick.keys(chunks)) == [
+    ('type', (u'gi',)),
+    ('type', (u't',)),
+    ('backspace', ()),
+    ('move', (1,)),
+    ('type', (u'é',)),
+    ('move', (-1,)),
+    ('move', (1,)),
+    ('clear', ()),
+    ('accept', ()),
+  ]
+  assert list(pick.keys([u'ab\x1b'])) == [('type', (u'ab',)), ('cancel', ())]
+
+
+def test_pick_run():
+  drawn = []
+  p = pick.Picker(COMMANDS, limit=5)
+  events = pick.keys([u'gst', u'\x0e\x0e\x0e', u'\r'])
+  assert pick.run(p, events, lambda p: drawn.append(p.query)) == u'git stash pop'
+  assert drawn == [u'', u'gst', u'gst', u'gst', u'gst']
+
+  p = pick.Picker(COMMANDS)
+  assert pick.run(p, pick.keys([u'git\x03']), lambda p: None) is None
+  # running out of input is a cancel too
+  assert pick.run(pick.Picker(COMMANDS), iter([]), lambda p: None) is None
+
+
+ROWS = [db.Row(1514240734 + i, cmd) for i, cmd in enumerate(
+  [u'tox', u'git status', u'ls', u'tox', u'git status', u'vim', u'tox'])]
+
+
+@pytest.mark.parametrize('interned', [False, True])
+def test_pick_recent_commands(interned):
+  conn = _mk_conn(':memory:')
+  conf = zsh.CONFIG.evolve(db_path=':memory:', histfile='bogus', db_conn_factory=lambda _: conn)
+  with conf.open() as hist:
+    hist.create_table(interned=interned)
+    with hist.conn:
+      hist.insert_rows(ROWS)
+    assert hist.recent_commands() == [u'tox', u'vim', u'git status', u'ls']
+
+    # an import of older history doesn't put it ahead of what was just run
+    with hist.conn:
+      hist.insert_rows([db.Row(1000000000, u'make'), db.Row(1000000001, u'ls')])
+    assert hist.recent_commands() == [u'tox', u'vim', u'git status', u'ls', u'make']
+
+
+def test_pick_filter(tmpdir, capsys):
+  hist_path = tmpdir.join('zsh_history')
+  hist_path.write(u''.join(u": {0}:0;{1}\n".format(r.timestamp, r.command) for r in ROWS))
+  db_path = str(tmpdir.join('schist.sq3'))
+  app.main('-d', db_path, 'backup', 'zsh', '-p', str(hist_path))
+  capsys.readouterr()
+
+  app.main('-d', db_path, 'pick', 'zsh', '--filter', 'st')
+  assert capsys.readouterr().out == u'git status\n'
+
+  app.main('-d', db_path, 'pick', 'zsh', '--filter', '', '--limit', '2')
+  assert capsys.readouterr().out == u'tox\nvim\n'
+
+  with pytest.raises(SystemExit):
+    app.main('-d', db_path, 'pick', 'zsh', '--filter', 'nope')
+  assert 'no results' in capsys.readouterr().err
@@ -0,0 +1,84 @@
+from __future__ import print_function
+
+from io import StringIO
+
+from schist import db
+from schist.common import _write_lines
+
+import pytest
+
+
+CMDS = ['tox', 'git status', 'ls', 'git status', 'tox', 'make', 'ls']
+
+ROWS = [db.Row(1514240734 + i, cmd) for i, cmd in enumerate(CMDS)]
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'interned'])
+def interned(request):
+  return request.param
+
+
+def restored(hist, **kw):
+  return [r.command for r in hist.restore_rows(**kw)]
+
+
+def test_restore_everything(hist):
+  assert list(hist.restore_rows()) == ROWS
+
+
+def test_restore_unique_keeps_latest(hist):
+  assert restored(hist, unique=True) == ['git status', 'tox', 'make', 'ls']
+  assert list(hist.restore_rows(unique=True))[0] == ROWS[3]
+
+
+def test_restore_last(hist):
+  assert restored(hist, last=3) == ['tox', 'make', 'ls']
+  assert restored(hist, last=2, unique=True) == ['make', 'ls']
+  assert restored(hist, last=100) == CMDS
+
+
+def test_restore_since(hist):
+  assert restored(hist, since=ROWS[4].timestamp) == ['tox', 'make', 'ls']
+  assert restored(hist, since=ROWS[2].arrow, unique=True) == ['git status', 'tox', 'make', 'ls']
+  assert restored(hist, since=ROWS[2].timestamp, last=1) == ['ls']
+
+
+@pytest.mark.parametrize('archived', [False, True], ids=['hot', 'archived'])
+def test_restore_latest_goes_by_time(hist, archived):
+  # e.g. an import of an old histfile, after the recent rows
+  old = [db.Row(1000000100, u'ancient y'), db.Row(1000000200, u'git status')]
+  with hist.conn:
+    hist.insert_rows(old)
+  hist.update_rollups()
+  if archived:
+    hist.archive(ROWS[2].timestamp)
+
+  assert list(hist.restore_rows())[:2] == old
+  assert restored(hist, last=2) == ['make', 'ls']
+  assert restored(hist, unique=True) == ['ancient y', 'git status', 'tox', 'make', 'ls']
+  assert list(hist.restore_rows(unique=True))[1] == ROWS[3]
+  assert restored(hist, last=5, unique=True) == ['ancient y', 'git status', 'tox', 'make', 'ls']
+  assert restored(hist, last=4, unique=True) == ['git status', 'tox', 'make', 'ls']
+
+
+def test_restore_writes_format(hist):
+  sio = StringIO()
+  hist.restore(sio, last=2)
+  assert sio.getvalue() == u": 1514240739:0;make\n: 1514240740:0;ls\n"
+
+
+def test_write_lines_chunks():
+  class Recorder(object):
+    def __init__(self):
+      self.writes = []
+
+    def write(self, s):
+      self.writes.append(s)
+
+  fp = Recorder()
+  _write_lines(fp, (u'{0}\n'.format(i) for i in range(10)), chunk_size=4)
+  assert fp.writes == [u'0\n1\n2\n3\n', u'4\n5\n6\n7\n', u'8\n9\n']
+
+  fp = Recorder()
+  _write_lines(fp, [])
+  assert fp.writes == []
@@ -0,0 +1,81 @@
+from __future__ import print_function
+
+import datetime
+import random
+
+from schist import db, rollup
+
+
+START = 1514240734
+
+rnd = random.Random(7)
+ROWS = sorted(
+  db.Row(START + rnd.randint(0, 90 * rollup.DAY), 'cmd {0}'.format(i)) for i in range(2000))
+
+
+def brute_count(lo, hi=None):
+  return sum(1 for r in ROWS if r.timestamp >= lo and (hi is None or r.timestamp < hi))
+
+
+def test_rollup_count_between(hist):
+  r = random.Random(1)
+  end = START + 91 * rollup.DAY
+  for _ in range(200):
+    lo, hi = sorted(r.randint(START - rollup.DAY, end) for _ in range(2))
+    assert rollup.count_between(hist.conn, hist.table_name, lo, hi) == brute_count(lo, hi)
+
+
+def test_rollup_bucket_edges(hist):
+  day = START - START % rollup.DAY + rollup.DAY
+  for lo, hi in [(day, day + rollup.DAY), (day - 1, day + 1), (day, day), (day + 1, day + 3600)]:
+    assert rollup.count_between(hist.conn, hist.table_name, lo, hi) == brute_count(lo, hi)
+
+
+def test_rollup_stats_methods(hist):
+  assert hist.total_count() == len(ROWS)
+  assert hist.cmds_since(ROWS[100].timestamp) == brute_count(ROWS[100].timestamp + 1)
+
+
+def test_rollup_update_is_incremental(hist):
+  new = [db.Row(START + 100 * rollup.DAY, 'late'), db.Row(START + 100 * rollup.DAY + 5, 'later')]
+  with hist.conn:
+    hist.insert_rows(new)
+    # rows the rollups have already counted are not counted again
+    bumped = hist.conn.execute(
+      "UPDATE zsh_history_rollups SET count = count + 1000 WHERE period = 'day'").rowcount
+
+  hist.update_rollups()
+  assert hist.total_count() == len(ROWS) + 1000 * bumped + len(new)
+
+
+def test_rollup_update_sql(hist):
+  statements = []
+  hist.conn.set_trace_callback(statements.append)
+  try:
+    with hist.conn:
+      hist.insert_rows([db.Row(START + 100 * rollup.DAY, 'new')])
+    hist.update_rollups()
+  finally:
+    hist.conn.set_trace_callback(None)
+
+  # the watermark is read under the write lock, and there's no upsert, which
+  # older sqlites don't have
+  begin = statements.index('BEGIN IMMEDIATE')
+  assert begin < min(i for i, s in enumerate(statements) if 'schist_watermarks' in s)
+  assert not [s for s in statements if 'ON CONFLICT' in s]
+  assert hist.total_count() == len(ROWS) + 1
+
+
+def test_rollup_histogram(hist):
+  counts = hist.histogram(START, START + 90 * rollup.DAY, 'week')
+  keys = list(counts)
+
+  assert all(k.weekday() == 0 for k in keys)
+  assert keys == sorted(keys)
+  assert keys[1] - keys[0] == datetime.timedelta(days=7)
+  assert sum(counts.values()) == brute_count(START - START % 3600, START + 90 * rollup.DAY)
+
+
+def test_rollup_histogram_months(hist):
+  counts = hist.histogram(START, START + 90 * rollup.DAY, 'month')
+  assert [d.strftime('%Y-%m') for d in counts] == ['2017-12', '2018-01', '2018-02', '2018-03']
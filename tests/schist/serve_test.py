@@ -0,0 +1,179 @@
+from __future__ import print_function
+
+import io
+import os
+import socket
+import threading
+import time
+
+from schist import client, db, serve, zsh
+from schist.common import _mk_conn
+
+import pytest
+
+
+NOW = int(time.time())
+
+ROWS = [
+  db.Row(NOW - 10 * 86400, u'git stash'),
+  db.Row(NOW - 5 * 86400, u'git status'),
+  db.Row(NOW - 2 * 3600, u'git stash pop'),
+  db.Row(NOW - 60, u'ls -la'),
+  db.Row(NOW - 30, u'git status'),
+  db.Row(NOW - 20, u'echo "a\ttab"\necho b'),
+]
+
+
+@pytest.fixture
+def hist_conf(tmpdir):
+  # a file, so another connection can write to it, and usable from the
+  # server's threads
+  return zsh.CONFIG.evolve(
+    db_path=str(tmpdir.join('schist.sq3')), histfile='bogus',
+    db_conn_factory=lambda p: _mk_conn(p, check_same_thread=False))
+
+
+@pytest.fixture
+def service(hist):
+  return serve.Service([hist])
+
+
+def ask(service, *words):
+  return service.respond(client.encode_line(words))
+
+
+@pytest.mark.parametrize('s', [u'plain', u'a\tb', u'a\nb\r', u'back\\slash\\n', u'', u'\\'])
+def test_serve_escaping(s):
+  assert client.unescape(client.escape(s)) == s
+  assert u'\t' not in client.escape(s) and u'\n' not in client.escape(s)
+  assert client.decode_line(client.encode_line([s, s])) == [s, s]
+
+
+def test_serve_search(service):
+  assert ask(service, 'search', 'zsh', 'git st%', '2') == (
+    u'ok 2\n{0}\tgit status\n{1}\tgit stash pop\n'.format(NOW - 30, NOW - 2 * 3600).encode('utf-8'))
+
+  rows = client.read_response(io.BytesIO(ask(service, 'search', 'z', '%tab%')))
+  assert rows == [[str(NOW - 20), u'echo "a\ttab"\necho b']]
+
+  rows = client.read_response(io.BytesIO(ask(service, 'regex', 'zsh', '^git st[a-z]+$', '5', 'frecency')))
+  assert [r[1] for r in rows] == [u'git status', u'git stash']
+
+
+def test_serve_suggest(service):
+  assert ask(service, 'suggest', 'zsh', 'git st') == b'ok 1\ngit status\n'
+  assert ask(service, 'suggest', 'zsh', 'git stash') == b'ok 1\ngit stash pop\n'
+  assert ask(service, 'suggest', 'zsh', 'git stash pop') == b'ok 0\n'
+  assert ask(service, 'suggest', 'zsh', 'nope') == b'ok 0\n'
+  assert ask(service, 'suggest', 'zsh', '') == b'ok 0\n'
+
+
+def test_serve_stats(service):
+  rows = client.read_response(io.BytesIO(ask(service, 'stats', 'zsh')))
+  assert rows == [[u'hour', u'3'], [u'day', u'4'], [u'week', u'5'], [u'total', u'6']]
+
+
+def test_serve_stats_move_with_the_clock(service, monkeypatch):
+  ask(service, 'stats', 'zsh')
+  monkeypatch.setattr(time, 'time', lambda: NOW + 86400 + 3600)
+  rows = client.read_response(io.BytesIO(ask(service, 'stats', 'zsh')))
+  assert rows == [[u'hour', u'0'], [u'day', u'0'], [u'week', u'5'], [u'total', u'6']]
+
+
+@pytest.mark.parametrize('words, message', [
+  (('frob', 'zsh'), b'unknown verb'),
+  (('search', 'bash', 'x'), b'not serving bash'),
+  (('search', 'zsh'), b'expected SHELL TERM [LIMIT] [RANK]'),
+  (('search', 'zsh', 'x', 'lots'), b'not a number'),
+  (('search', 'zsh', 'x', '5', 'best'), b'unknown rank'),
+  (('regex', 'zsh', '(unclosed'), b'error missing'),
+])
+def test_serve_errors(service, words, message):
+  response = ask(service, *words)
+  assert response.startswith(b'error ') and response.endswith(b'\n')
+  assert message in response
+  with pytest.raises(client.ServerError):
+    client.read_response(io.BytesIO(response))
+
+
+def test_serve_caches_until_the_db_changes(service, hist, tmpdir, monkeypatch):
+  calls = []
+  real = service._run
+  monkeypatch.setattr(service, '_run', lambda words: calls.append(words) or real(words))
+
+  first = ask(service, 'search', 'zsh', '%', '1')
+  assert ask(service, 'search', 'zsh', '%', '1') == first
+  assert len(calls) == 1
+
+  # a backup, from another connection
+  other = zsh.CONFIG.evolve(db_path=hist.db_path, histfile='bogus')
+  with other.open() as h:
+    with h.conn:
+      h.insert_rows([db.Row(NOW, u'brand new')])
+
+  assert ask(service, 'search', 'zsh', '%', '1') == u'ok 1\n{0}\tbrand new\n'.format(
+    NOW).encode('utf-8')
+  assert len(calls) == 2
+
+
+def test_serve_cache_size(hist):
+  service = serve.Service([hist], cache_size=2)
+  for term in ('a%', 'b%', 'c%'):
+    ask(service, 'search', 'zsh', term)
+  assert list(service._cache) == [('search', 'zsh', 'b%'), ('search', 'zsh', 'c%')]
+
+
+@pytest.fixture
+def server(service, tmpdir):
+  path = str(tmpdir.join('schist.sock'))
+  srv = serve.Server(path, service)
+  t = threading.Thread(target=srv.serve_forever)
+  t.daemon = True
+  t.start()
+  try:
+    yield path
+  finally:
+    srv.shutdown()
+    srv.server_close()
+    t.join()
+  assert not os.path.exists(path)
+
+
+def test_serve_over_the_socket(server, capsys):
+  with client.Client(server) as c:
+    assert c.request('ping') == []
+    assert c.request('suggest', 'zsh', u'ls') == [[u'ls -la']]
+    # more than one request per connection
+    assert c.request('search', 'zsh', u'%\n%') == [[str(NOW - 20), u'echo "a\ttab"\necho b']]
+
+  assert client.request('suggest', 'zsh', u'git s', path=server) == [[u'git status']]
+
+  assert client.main(['-s', server, 'suggest', 'zsh', 'git stash']) == 0
+  assert capsys.readouterr().out == u'git stash pop\n'
+  assert client.main(['-s', server, 'suggest', 'zsh', 'nope']) == 1
+  assert client.main(['-s', server, 'frob']) == 2
+  assert 'unknown verb' in capsys.readouterr().err
+
+
+def test_serve_refuses_to_start_twice(server, service):
+  with pytest.raises(RuntimeError):
+    serve.Server(server, service)
+
+
+def test_serve_replaces_a_stale_socket(service, tmpdir):
+  path = str(tmpdir.join('stale.sock'))
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  s.bind(path)
+  s.close()
+  assert os.path.exists(path)
+
+  srv = serve.Server(path, service)
+  try:
+    assert oct(os.stat(path).st_mode & 0o777) == oct(0o700)
+  finally:
+    srv.server_close()
+
+
+def test_serve_client_without_server(tmpdir, capsys):
+  assert client.main(['-s', str(tmpdir.join('nothing.sock')), 'ping']) == 2
+  assert "can't talk to" in capsys.readouterr().err
@@ -0,0 +1,95 @@
+"""schist search/restore get run from prompt hooks and key bindings, so they
+have to start quickly. these check what they import, using -X importtime"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+import schist
+
+import pytest
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 7), reason='needs -X importtime')
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(schist.__file__)))
+
+# what schist can't do without, the imports on top of these are what it adds
+DEPENDENCIES = 'import argparse, logging, sqlite3, attr, six'
+
+# modules that search and restore have no need for
+HEAVY = [
+  'arrow',
+  'dateutil',
+  'logging.config',
+  'multiprocessing',
+  'cProfile',
+  'ctypes.util',
+  'json',
+  'schist.merge',
+  'schist.parallel',
+  'schist.watch',
+]
+
+# ms that the imports on top of DEPENDENCIES may take, per -X importtime, best
+# of a few runs. it was about 10 when this was written, and 50 before arrow and
+# friends were made lazy
+BUDGET_MS = 25
+
+
+def importtime(tmpdir, *args):
+  """{module: self time in us} for everything python imports to run args"""
+  env = dict(os.environ, PYTHONPATH=SRC, HOME=str(tmpdir),
+    PYTHONPYCACHEPREFIX=str(tmpdir.join('pycache')))
+  # measure imports from .pyc, like an installed schist would
+  env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+  cmd = [sys.executable, '-X', 'importtime'] + list(args)
+  p = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  _, err = p.communicate()
+
+  found = {}
+  for line in err.decode('utf-8').splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    us, _, name = line[len('import time:'):].split('|')
+    found[name.strip()] = int(us)
+  return found
+
+
+def schist_imports(tmpdir, *args):
+  """importtime() for running `schist args`, the way the console script does"""
+  found = importtime(
+    tmpdir, '-c', 'import sys; from schist.app import main; main(*sys.argv[1:])', *args)
+  assert 'schist.app' in found
+  return found
+
+
+@pytest.mark.parametrize('shell, args', [
+  ('zsh', ('search', 'zsh', 'x')),
+  ('bash', ('search', '--no-date', 'bash', 'x')),
+  ('zsh', ('restore', os.devnull, 'zsh')),
+])
+def test_startup_skips_heavy_imports(tmpdir, shell, args):
+  found = schist_imports(tmpdir, *args)
+  assert [m for m in HEAVY if m in found] == []
+  # and only the one shell
+  other = 'bash' if shell == 'zsh' else 'zsh'
+  assert 'schist.' + shell in found
+  assert 'schist.' + other not in found
+
+
+def test_startup_importtime_budget(tmpdir):
+  # the first run writes the .pyc files
+  schist_imports(tmpdir, 'search', 'zsh', 'x')
+
+  deps = importtime(tmpdir, '-c', DEPENDENCIES)
+  best = None
+  for _ in range(3):
+    found = schist_imports(tmpdir, 'search', 'zsh', 'x')
+    ms = sum(us for name, us in found.items() if name not in deps) / 1000.0
+    best = ms if best is None else min(best, ms)
+
+  assert best < BUDGET_MS, sorted(
+    ((us, name) for name, us in found.items() if name not in deps), reverse=True)[:10]
@@ -0,0 +1,131 @@
+from __future__ import print_function
+
+import datetime
+import random
+
+from schist import db, timing, zsh
+
+import pytest
+
+
+START = 1514240734
+DAY = 24 * 60 * 60
+
+rnd = random.Random(17)
+ROWS = sorted(
+  db.Row(START + i * 600, 'cmd {0}'.format(i % 5), rnd.randint(0, 300)) for i in range(1000))
+# bash rows and the like, which should be left out of everything
+UNKNOWN = [db.Row(START + i * 600 + 1, 'cmd {0}'.format(i % 5)) for i in range(50)]
+
+
+@pytest.fixture(params=['plain', 'interned'])
+def hist(request, memory_db, tmpdir):
+  conf = zsh.CONFIG.evolve(
+      db_path=":memory:",
+      histfile=str(tmpdir.join('zsh_history')),
+      db_conn_factory=lambda _: memory_db,
+    )
+
+  with conf.open() as hist:
+    hist.init_db()
+    if request.param == 'interned':
+      hist.migrate_to_interned()
+    with hist.conn:
+      hist.insert_rows(ROWS + UNKNOWN)
+    yield hist
+
+
+def nearest_rank(values, p):
+  values = sorted(values)
+  return values[(len(values) * p + 99) // 100 - 1]
+
+
+def test_timing_slowest(hist):
+  expected = sorted(ROWS, key=lambda r: (r.elapsed, r.timestamp), reverse=True)[:10]
+  assert hist.slowest(10) == [(r.timestamp, r.elapsed, r.command) for r in expected]
+
+  since = ROWS[500].timestamp
+  assert all(ts >= since for ts, _, _ in hist.slowest(10, since=since))
+  assert set(cmd for _, _, cmd in hist.slowest(10, like='cmd 3')) == set(['cmd 3'])
+
+
+def test_timing_by_command_percentiles(hist):
+  found = hist.by_command(limit=10)
+  assert len(found) == 5
+
+  totals = [total for _, _, total, _, _, _, _ in found]
+  assert totals == sorted(totals, reverse=True)
+
+  for command, runs, total, p50, p90, p99, worst in found:
+    elapsed = [r.elapsed for r in ROWS if r.command == command]
+    assert runs == len(elapsed)
+    assert total == sum(elapsed)
+    assert (p50, p90, p99) == tuple(nearest_rank(elapsed, p) for p in timing.PERCENTILES)
+    assert worst == max(elapsed)
+
+
+def test_timing_by_command_like(hist):
+  assert [r[0] for r in hist.by_command(like='cmd 1')] == ['cmd 1']
+
+
+def test_timing_time_spent(hist):
+  lo, hi = START, ROWS[-1].timestamp + 1
+  spent = hist.time_spent(lo, hi, 'day')
+
+  assert list(spent) == sorted(spent)
+  assert sum(n for n, _ in spent.values()) == len(ROWS)
+  assert sum(t for _, t in spent.values()) == sum(r.elapsed for r in ROWS)
+
+  for d, (n, total) in spent.items():
+    today = [r for r in ROWS if datetime.datetime.fromtimestamp(r.timestamp).date() == d]
+    assert (n, total) == (len(today), sum(r.elapsed for r in today))
+
+
+def test_timing_time_spent_weeks_start_on_monday(hist):
+  spent = hist.time_spent(START, ROWS[-1].timestamp + 1, 'week')
+  assert all(d.weekday() == 0 for d in spent)
+  assert sum(t for _, t in spent.values()) == sum(r.elapsed for r in ROWS)
+
+
+def test_timing_migrate_backfills_from_histfile(memory_db, tmpdir):
+  histfile = tmpdir.join('zsh_history')
+  histfile.write(u''.join(
+    u": {0}:{2};{1}\n".format(*r) for r in ROWS[500:]))
+
+  # a table from before there was an elapsed column
+  with memory_db:
+    memory_db.execute("""\
+      CREATE TABLE zsh_history (
+        timestamp BIGINT NOT NULL,
+        command text NOT NULL,
+        PRIMARY KEY (timestamp, command)
+      )""")
+    memory_db.executemany(
+      "INSERT INTO zsh_history (timestamp, command) VALUES (?, ?)",
+      ((r.timestamp, r.command) for r in ROWS))
+
+  conf = zsh.CONFIG.evolve(
+      db_path=":memory:", histfile=str(histfile), db_conn_factory=lambda _: memory_db)
+  with conf.open() as hist:
+    assert not hist.has_elapsed_column()
+    # still works, the new rows just don't keep their elapsed time
+    with hist.conn:
+      hist.insert_rows([db.Row(START - 10, 'early', 5)])
+
+    assert hist.add_elapsed_column() == 500
+    assert hist.has_elapsed_column()
+    assert hist.add_elapsed_column() == 0
+
+    assert hist.slowest(1000) == [
+      (r.timestamp, r.elapsed, r.command)
+      for r in sorted(ROWS[500:], key=lambda r: (r.elapsed, r.timestamp), reverse=True)]
+
+    with hist.conn:
+      hist.insert_rows([db.Row(START - 20, 'late', 7)])
+    assert hist.slowest(1, like='late') == [(START - 20, 7, 'late')]
+
+
+def test_timing_restore_keeps_elapsed(hist):
+  with hist.conn:
+    rows = list(hist.restore_rows())
+  assert [r for r in rows if r.elapsed is not None] == ROWS
@@ -0,0 +1,97 @@
+from __future__ import print_function
+
+import threading
+import time
+
+from schist import watch, zsh
+
+import pytest
+
+
+ZSH_HISTORY = u"""\
+: 1514240734:0;tox
+: 1514240857:0;git status
+"""
+
+
+@pytest.fixture(params=['poll', 'inotify'])
+def mk_watcher(request):
+  if request.param == 'inotify' and watch._libc() is None:
+    pytest.skip("no inotify here")
+
+  def mk(path):
+    if request.param == 'poll':
+      return watch.PollWatcher(path, poll_interval=0.01)
+    return watch.InotifyWatcher(path, watch._libc())
+  return mk
+
+
+def test_watcher_sees_appends_and_replacements(tmpdir, mk_watcher):
+  path = tmpdir.join('zsh_history')
+  path.write(ZSH_HISTORY)
+
+  w = mk_watcher(str(path))
+  try:
+    assert not w.wait(0.05)
+
+    path.write(u": 1514240860:0;ls\n", mode='a')
+    assert w.wait(1)
+    w.wait(0)
+    assert not w.wait(0.05)
+
+    # what zsh does when it trims the file
+    new = tmpdir.join('zsh_history.new')
+    new.write(u": 1514240870:0;pwd\n")
+    new.rename(path)
+    assert w.wait(1)
+
+    # other files in the same directory don't count
+    w.wait(0)
+    tmpdir.join('unrelated').write(u'x')
+    assert not w.wait(0.05)
+  finally:
+    w.close()
+
+
+def test_watch_ingests_appends(tmpdir, mk_watcher):
+  path = tmpdir.join('zsh_history')
+  path.write(ZSH_HISTORY)
+  conf = zsh.CONFIG.evolve(db_path=str(tmpdir.join('schist.sq3')), histfile=str(path))
+
+  stop = threading.Event()
+  ingests = []
+  started = threading.Event()
+
+  def on_insert(added):
+    ingests.append(added)
+    started.set()
+
+  def run():
+    with conf.open() as hist:
+      hist.init_db()
+      w = mk_watcher(str(path))
+      try:
+        watch.watch(hist, w, interval=0.02, settle=0.01, stop=stop.is_set,
+          on_insert=on_insert)
+      finally:
+        w.close()
+
+  t = threading.Thread(target=run)
+  t.start()
+  try:
+    started.wait(5)
+    path.write(u": 1514240860:0;ls\n", mode='a')
+
+    deadline = time.time() + 5
+    while sum(ingests) < 3 and time.time() < deadline:
+      time.sleep(0.01)
+  finally:
+    stop.set()
+    t.join(5)
+
+  assert not t.is_alive()
+  assert ingests[0] == 2
+  assert sum(ingests) == 3
+
+  with conf.open() as hist:
+    assert [r.command for r in hist.rows()] == [u'tox', u'git status', u'ls']
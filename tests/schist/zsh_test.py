@@ -19,11 +19,11 @@ ZSH_HISTORY = """\
 """
 
 ROWS = [
-  db.Row(arrow.get(1514240734), 'tox'),
-  db.Row(arrow.get(1514240857), 'git rm tests/schist/__init__.py'),
-  db.Row(arrow.get(1514240860), 'rm tests/schist/__init__.py'),
-  db.Row(arrow.get(1514240862), 'tox'),
-  db.Row(arrow.get(1514241010), 'tail -n5 ~/.zshhistory'),
+  db.Row(arrow.get(1514240734), 'tox', 0),
+  db.Row(arrow.get(1514240857), 'git rm tests/schist/__init__.py', 0),
+  db.Row(arrow.get(1514240860), 'rm tests/schist/__init__.py', 0),
+  db.Row(arrow.get(1514240862), 'tox', 0),
+  db.Row(arrow.get(1514241010), 'tail -n5 ~/.zshhistory', 0),
 ]
 
 
@@ -96,4 +96,183 @@ def test_zsh_integration(zsh_fp, zsh_config, memory_db):
 
     assert hist.cmds_since(ROWS[2].timestamp) == 2
 
-    assert hist.last_cmd() == ROWS[-1].timestamp
+    assert hist.last_cmd() == ROWS[-1].arrow
+
+
+@pytest.fixture
+def zsh_path(tmpdir):
+  path = tmpdir.join('zsh_history')
+  path.write(ZSH_HISTORY)
+  return path
+
+
+@pytest.fixture
+def seen_lines():
+  return []
+
+
+@pytest.fixture
+def recording_config(zsh_path, memory_db, seen_lines):
+  def history_iter(fp):
+    def record(fp):
+      for line in fp:
+        seen_lines.append(line)
+        yield line
+    return zsh.history_iter(record(fp))
+
+  yield zsh.CONFIG.evolve(
+      db_path=":memory:",
+      histfile=str(zsh_path),
+      db_conn_factory=lambda _: memory_db,
+      history_iter_fn=history_iter,
+      # so the lines go through history_iter above
+      range_iter_fn=None,
+    )
+
+
+def test_zsh_insert_resumes_from_checkpoint(zsh_path, recording_config, seen_lines):
+  with recording_config.open() as hist:
+    hist.init_db()
+    hist.insert()
+    assert len(seen_lines) == len(ROWS)
+
+    del seen_lines[:]
+    hist.insert()
+    assert seen_lines == []
+
+    zsh_path.write(": 1514241020:0;git status\n", mode='a')
+    hist.insert()
+    assert seen_lines == [b": 1514241020:0;git status\n"]
+    assert hist.count() == len(ROWS) + 1
+
+
+def test_zsh_insert_full_scan_when_rewritten(zsh_path, recording_config, seen_lines):
+  with recording_config.open() as hist:
+    hist.init_db()
+    hist.insert()
+
+    # rewritten in place, so the inode is the same but the bytes before the
+    # checkpoint are not
+    zsh_path.write(ZSH_HISTORY.replace('tox', 'ls ') + ": 1514241020:0;git status\n")
+
+    del seen_lines[:]
+    hist.insert()
+    assert len(seen_lines) == len(ROWS) + 1
+
+    zsh_path.write(": 1514241030:0;make\n")
+    del seen_lines[:]
+    hist.insert()
+    assert seen_lines == [b": 1514241030:0;make\n"]
+
+
+def test_zsh_insert_partial_last_line(zsh_path, recording_config, seen_lines):
+  with recording_config.open() as hist:
+    hist.init_db()
+    zsh_path.write(": 1514241020:0;git sta", mode='a')
+    hist.insert()
+    assert hist.count() == len(ROWS)
+
+    zsh_path.write("tus\n", mode='a')
+    del seen_lines[:]
+    hist.insert()
+    assert seen_lines == [b": 1514241020:0;git status\n"]
+    assert hist.count() == len(ROWS) + 1
+
+
+def test_zsh_insert_partial_multiline_entry(zsh_path, recording_config, seen_lines):
+  with recording_config.open() as hist:
+    hist.init_db()
+    zsh_path.write(": 1514241020:0;echo a\\\n", mode='a')
+    hist.insert()
+    assert hist.count() == len(ROWS)
+
+    zsh_path.write("line2\\\n", mode='a')
+    hist.insert()
+    assert hist.count() == len(ROWS)
+
+    zsh_path.write("line3\n", mode='a')
+    del seen_lines[:]
+    hist.insert()
+    assert seen_lines == [b": 1514241020:0;echo a\\\n", b"line2\\\n", b"line3\n"]
+    assert hist.count() == len(ROWS) + 1
+    assert list(hist.rows())[-1].command == u'echo a\nline2\nline3'
+
+
+def test_zsh_insert_full(zsh_path, recording_config, seen_lines):
+  with recording_config.open() as hist:
+    hist.init_db()
+    hist.insert()
+    del seen_lines[:]
+    hist.insert(full=True)
+    assert len(seen_lines) == len(ROWS)
+
+
+def test_zsh_config_busy_timeout(tmpdir):
+  conf = zsh.CONFIG.evolve(db_path=str(tmpdir.join('x.sq3')), busy_timeout=2.5)
+  with conf.open() as hist:
+    assert hist.conn.execute("PRAGMA busy_timeout").fetchone()[0] == 2500
+
+
+def test_zsh_backup_lock(tmpdir):
+  conf = zsh.CONFIG.evolve(db_path=str(tmpdir.join('x.sq3')))
+  with conf.backup_lock() as locked:
+    assert locked
+    with conf.backup_lock() as again:
+      assert not again
+    # other tables have their own lock
+    with conf.evolve(table_name='other_history').backup_lock() as other:
+      assert other
+
+
+MULTILINE = (
+  b": 1514240734:0;for f in *.py; do\\\n"
+  b"  echo $f\\\n"
+  b"done\n"
+  b": 1514240740:3;echo \xc5\x83\xa4\n"
+  b"not an entry\n"
+  b": 1514240745:0;tail -f log\n"
+)
+
+MULTILINE_ROWS = [
+  db.Row(1514240734, u'for f in *.py; do\n  echo $f\ndone', 0),
+  db.Row(1514240740, u'echo ń', 3),
+  db.Row(1514240745, u'tail -f log', 0),
+]
+
+
+def test_zsh_history_iter_multiline_and_metafied():
+  assert list(zsh.history_iter(MULTILINE.splitlines(True))) == MULTILINE_ROWS
+
+
+def test_zsh_metafied_nul_in_multiline_entry():
+  # a NUL is metafied as 0x83 0x20, and stays a NUL, not a newline
+  lines = [b": 1514240734:0;printf 'a\x83\x20b' \\\n", b"  | od -c\n"]
+  assert list(zsh.history_iter(lines)) == [db.Row(1514240734, u"printf 'a\x00b' \n  | od -c", 0)]
+
+
+@pytest.mark.parametrize('piece_size', [1, 7, 40, 1 << 16])
+def test_zsh_history_range_matches_iter(tmpdir, piece_size):
+  path = tmpdir.join('zsh_history')
+  data = (MULTILINE + ZSH_HISTORY.encode('utf-8')) * 20
+  path.write_binary(data)
+
+  with open(str(path), 'rb') as fp:
+    expected = list(zsh.history_iter(fp, piece_size=piece_size))
+    assert expected == (MULTILINE_ROWS + ROWS) * 20
+
+    assert list(zsh.history_range(fp, 0, len(data), piece_size=piece_size)) == expected
+
+    # starting part way in, and stopping before the end
+    start = len(MULTILINE)
+    end = len(data) - len(ZSH_HISTORY)
+    assert list(zsh.history_range(fp, start, end, piece_size=piece_size)) == \
+      expected[len(MULTILINE_ROWS):-len(ROWS)]
+
+    assert list(zsh.history_range(fp, 10, 10)) == []
+
+
+def test_zsh_history_output_multiline():
+  sio = StringIO()
+  zsh.history_output(iter(MULTILINE_ROWS[:1]), sio)
+  assert sio.getvalue().encode('utf-8') == MULTILINE.split(b'\n: ')[0] + b'\n'
+  assert list(zsh.history_iter(sio.getvalue().splitlines(True))) == MULTILINE_ROWS[:1]